@@ -0,0 +1,155 @@
+# Lambda Trigger
+# EventBridge Scheduler: ide-ann-build-nightly
+# Schedule: rate(1 day)   (or invoke manually after a bulk ingest)
+# Details
+# Memory: 4096 MB (raise for corpora above ~500k chunks)
+# Timeout: 15 min
+# Also runnable offline: python ide-ann-build.py
+
+# Layers
+# numpy, faiss-cpu
+
+# Package with: ide_retrieval.py   (segmented corpus scan shared with ide-query / ide-answer)
+
+# Environment variables
+# ANN_BUCKET: ide-bd-eu-west-2
+# ANN_EVAL_QUERIES: 200
+# ANN_KIND: ivf          (ivf = IVF-Flat, hnsw = HNSW32, flat = exact)
+# ANN_PREFIX: ann/
+# ANN_RECALL_K: 10
+# EMBED_DIM: 1024   (must match the indexers' model; rows of another size are left out of the snapshot)
+# SCAN_SEGMENTS: 8   (max parallel scan segments)
+# TABLE_NAME: ide-rag
+
+# Builds an approximate nearest-neighbour snapshot of every chunk vector in the ide-rag table:
+#   s3://ANN_BUCKET/ANN_PREFIX/<version>/index.faiss   faiss index over L2-normalized float32 vectors
+#   s3://ANN_BUCKET/ANN_PREFIX/<version>/keys.json     row i → [docId, chunkId]
+#   s3://ANN_BUCKET/ANN_PREFIX/<version>/report.json   recall@k vs exact search per nprobe/efSearch
+#   s3://ANN_BUCKET/ANN_PREFIX/LATEST.json             pointer read by ide-query / ide-answer (SEARCH_BACKEND=ANN)
+# Snapshots are immutable; a new build only moves the LATEST pointer.
+
+import os, json, math, time, tempfile, boto3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+
+from ide_retrieval import (EMBED_DIM, SCAN_SEGMENTS, SCAN_ROWS_PER_SEGMENT, MANIFEST_DOC, _scan_segment,
+                           query_doc_items)
+
+ANN_BUCKET   = os.environ["ANN_BUCKET"]
+ANN_PREFIX   = os.environ.get("ANN_PREFIX", "ann/")
+ANN_KIND     = os.environ.get("ANN_KIND", "ivf").lower()
+EVAL_QUERIES = int(os.environ.get("ANN_EVAL_QUERIES", "200"))
+RECALL_K     = int(os.environ.get("ANN_RECALL_K", "10"))
+
+s3 = boto3.client("s3")
+
+def load_vectors():
+    """
+    Parallel segmented scan of keys + vectors (ide_retrieval's cold-load path) →
+    (L2-normalized float32 matrix, [[docId, chunkId], ...]). Rows that are not EMBED_DIM wide,
+    or are all zero, are left out and counted in the log.
+    """
+    expected = sum(int(it.get("chunks", 0)) for it in query_doc_items(MANIFEST_DOC))
+    segments = min(SCAN_SEGMENTS, max(1, expected // SCAN_ROWS_PER_SEGMENT)) if expected else SCAN_SEGMENTS
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        parts = list(pool.map(lambda seg: _scan_segment(seg, segments, expected // segments + 64), range(segments)))
+
+    n = sum(int(valid.sum()) for _, valid, _, _, _ in parts)
+    mat, keys = np.empty((n, EMBED_DIM), dtype=np.float32), []
+    scanned = mismatched = 0
+    while parts:
+        seg_mat, valid, seg_keys, _, seg_mismatched = parts.pop(0)   # each segment buffer is freed once copied
+        rows = np.flatnonzero(valid)
+        mat[len(keys):len(keys) + rows.size] = seg_mat[rows]
+        keys += [list(seg_keys[i]) for i in rows]
+        scanned, mismatched = scanned + len(seg_keys), mismatched + seg_mismatched
+    if scanned > n:
+        print(f"[IDE] ANN build: skipped {scanned - n} of {scanned} rows "
+              f"({mismatched} not {EMBED_DIM}-dim (EMBED_DIM), {scanned - n - mismatched} zero vectors)")
+    return mat, keys
+
+def build_index(mat):
+    import faiss   # faiss-cpu layer; imported here so load_vectors runs without it
+    n, dim = mat.shape
+    if ANN_KIND == "flat" or n < 10_000:   # small corpora: exact search is already fast
+        desc = "Flat"
+    elif ANN_KIND == "hnsw":
+        desc = "HNSW32,Flat"
+    else:
+        desc = f"IVF{int(min(65536, max(16, 4 * math.sqrt(n))))},Flat"
+    index = faiss.index_factory(dim, desc, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        nlist = faiss.extract_index_ivf(index).nlist
+        sample = mat[rng.choice(n, size=min(n, 256 * nlist), replace=False)]
+        index.train(sample)
+    index.add(mat)
+    return index, desc
+
+def recall_report(index, desc, mat):
+    """recall@k of the ANN index against exact inner-product search, per tuning knob value."""
+    import faiss
+    n = mat.shape[0]
+    k = min(RECALL_K, n)
+    if not n or not k:
+        return {"index": desc, "rows": n, "k": k, "curve": []}
+    rng = np.random.default_rng(1)
+    queries = mat[rng.choice(n, size=min(n, EVAL_QUERIES), replace=False)]
+    exact = faiss.IndexFlatIP(mat.shape[1])
+    exact.add(mat)
+    _, truth = exact.search(queries, k)
+
+    if desc.startswith("IVF"):
+        nlist = faiss.extract_index_ivf(index).nlist
+        knob, values = "nprobe", [v for v in (1, 2, 4, 8, 16, 32, 64, 128) if v <= nlist]
+    elif desc.startswith("HNSW"):
+        knob, values = "efSearch", [16, 32, 64, 128, 256]
+    else:
+        knob, values = None, [None]
+
+    params = faiss.ParameterSpace()
+    curve = []
+    for v in values:
+        if knob:
+            params.set_index_parameter(index, knob, v)
+        t0 = time.time()
+        _, got = index.search(queries, k)
+        ms = (time.time() - t0) * 1000 / len(queries)
+        recall = float(np.mean([len(set(g) & set(t)) / k for g, t in zip(got, truth)]))
+        curve.append({"knob": knob, "value": v, "recall": round(recall, 4), "ms_per_query": round(ms, 3)})
+        print(f"[IDE] ANN recall@{k} {knob}={v}: {recall:.4f} ({ms:.3f} ms/query)")
+    return {"index": desc, "rows": n, "k": k, "queries": len(queries), "curve": curve}
+
+def _put_json(key, obj):
+    s3.put_object(Bucket=ANN_BUCKET, Key=key, Body=json.dumps(obj).encode("utf-8"),
+                  ContentType="application/json")
+
+def lambda_handler(event, context):
+    import faiss
+    t0 = time.time()
+    mat, keys = load_vectors()
+    print(f"[IDE] ANN build: loaded {len(keys)} vectors dim={mat.shape[1]} in {time.time() - t0:.1f}s")
+    if not keys:
+        return {"ok": False, "error": "no vectors in table"}
+
+    index, desc = build_index(mat)
+    report = recall_report(index, desc, mat)
+
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    base = f"{ANN_PREFIX}{version}/"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.faiss")
+        faiss.write_index(index, path)
+        s3.upload_file(path, ANN_BUCKET, base + "index.faiss")
+    _put_json(base + "keys.json", keys)
+    _put_json(base + "report.json", report)
+    latest = {"version": version, "prefix": base, "index": desc, "rows": len(keys),
+              "dim": int(mat.shape[1]), "built_at": datetime.now(timezone.utc).isoformat()}
+    _put_json(f"{ANN_PREFIX}LATEST.json", latest)   # written last: readers never see a partial snapshot
+
+    print(f"[IDE] ANN snapshot s3://{ANN_BUCKET}/{base} ({desc}, {len(keys)} rows) in {time.time() - t0:.1f}s")
+    return {"ok": True, **latest, "report": report}
+
+if __name__ == "__main__":
+    print(json.dumps(lambda_handler({}, None), indent=2))
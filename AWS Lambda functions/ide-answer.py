@@ -13,41 +13,74 @@
 # Service principal: apigateway.amazonaws.com
 # Stage: $default
 # Statement ID: d2186751-1452-520c-92cb-e611d749a9f8
+#
+# Function URL (optional, streaming /answer): InvokeMode RESPONSE_STREAM, handler stream_handler
+# Runtime: custom runtime (provided.al2023) posting streamed responses to the Runtime API, or the
+# Lambda Web Adapter layer with AWS_LWA_INVOKE_MODE=response_stream; the managed Python runtimes
+# buffer responses (see README, Deployment Steps, "Streaming /answer")
+
+# Layers
+# numpy (e.g. AWSSDKPandas-Python311, or a custom numpy layer)
+# faiss-cpu (only for SEARCH_BACKEND=ANN)
+
+# Package with: ide_retrieval.py, ide_sentences.py   (retrieval stack shared with ide-query, sentence rules with the indexers)
 
 # Environment variables
+# ANN_BUCKET: ide-bd-eu-west-2   (SEARCH_BACKEND=ANN)
+# ANN_CHECK_SECONDS: 300
+# ANN_EF_SEARCH: 64
+# ANN_NPROBE: 16
+# ANN_PREFIX: ann/
+# ANSWER_BUDGET_MS: 8000   (per-request latency budget; polish is cut off / skipped when it runs out)
+# ANSWER_CACHE_SIZE: 256   (0 disables the answer cache)
+# ANSWER_CACHE_TABLE: ide-answer-cache   (optional shared tier, partition key "k" String, TTL on "expiresAt")
+# ANSWER_CACHE_TTL_SECONDS: 86400
+# ANSWER_DEBUG: false   (true = always return the "debug" timing field; requests can ask with "debug": true)
 # ANSWER_SCOPE: best_doc
 # BEDROCK_MODEL_ID: amazon.titan-embed-text-v2:0
 # BEDROCK_REGION: eu-west-2
+# CORPUS_REFRESH_SECONDS: 30
+# EMBED_DIM: 1024   (must match the indexers' model; rows of another size are not searched)
+# EMBED_CACHE_TABLE: ide-embed-cache   (optional, shared query-embedding tier)
+# INDEX_TTL_SECONDS: 3600
 # MAX_ANSWER_CHARS: 800
 # MAX_SNIPPETS: 2
 # MIN_SCORE: 0.35
 # OS_ENDPOINT: https://<YOUR_OPENSEARCH_ENDPOINT>.aoss.amazonaws.com
 # OS_INDEX: ide-rag
 # OS_NUM_CANDIDATES: 100
-# OS_SIGV4_SERVICE: aoss
+# OS_SIGV4_SERVICE: aoss   ("none" disables SigV4, e.g. for a local OpenSearch)
+# POLISH_MIN_MS: 300   (do not start the LLM polish with less budget left than this)
 # QA_LLM_ENABLE: true
 # QA_LLM_MAX_TOKENS: 400
 # QA_LLM_MODEL_ID: amazon.titan-text-express-v1
 # QA_LLM_TEMP: 0.15
-# SEARCH_BACKEND: DDB
+# QUERY_CACHE_SIZE: 512
+# QUERY_CACHE_TTL_SECONDS: 3600
+# SCAN_SEGMENTS: 8   (max parallel scan segments for a full corpus load)
+# SEARCH_BACKEND: DDB   (DDB|MEMORY = in-memory index, DDB_SCAN = per-request scan, OPENSEARCH = k-NN, ANN = faiss snapshot)
+# SEM_CACHE_SIZE: 512   (semantic answer cache entries per settings combination; 0 disables)
+# SEM_CACHE_THRESHOLD: 0.92   (cosine between query vectors needed to reuse a cached answer)
+# SENT_MIN_SCORE: 0.2   (sentence-vector rerank: weaker sentences are not used)
+# SENT_RERANK: true   (rank sentences by their stored vectors when the indexers ran with SENT_EMBED)
+# SENT_VEC_TABLE: ide-rag-sentvecs   (the indexers' sentence-vector store; unset = keyword sentence ranking)
 # TABLE_NAME: ide-rag
 # TOP_K: 5
 
-import os, json, math, boto3, base64, re
+import os, json, time, hashlib, boto3, base64, re, queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
 from decimal import Decimal
+import numpy as np
+from boto3.dynamodb.types import Binary
+from botocore.config import Config
 
-import urllib3
-from botocore.awsrequest import AWSRequest
-from botocore.auth import SigV4Auth
-from botocore.session import Session
-
-# ---------- HTTP + SigV4 (for OpenSearch Serverless if/when used) ----------
-_http = urllib3.PoolManager()
-_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "eu-west-2"))
-_os_endpoint = os.environ["OS_ENDPOINT"].rstrip("/") if os.environ.get("OS_ENDPOINT") else ""
-_os_index = os.environ.get("OS_INDEX", "ide-rag")
-_sigv4_service = os.environ.get("OS_SIGV4_SERVICE", "aoss")
-_creds = Session().get_credentials().get_frozen_credentials()
+from ide_retrieval import (ddb, table, MODEL_ID, EMBED_DIM, SEARCH_BACKEND, OS_NUM_CANDIDATES, ANN_NPROBE,
+                           ANN_EF_SEARCH, _CORPUS, _READS, _get_index, _load_ann, batch_get, embed_query,
+                           parse_filters, retrieve)
+from ide_sentences import SENT_VERSION, SENT_NOISE, split_sentences, is_heading_or_noise
 
 # ---------- LLM polish config ----------
 QA_LLM_ENABLE   = os.environ.get("QA_LLM_ENABLE","false").lower() == "true"
@@ -81,14 +114,32 @@ ANSWER_SCOPE  = os.environ.get("ANSWER_SCOPE", "best_doc")  # best_doc | all_doc
 MIN_SCORE     = float(os.environ.get("MIN_SCORE", "0.25"))  # drop weak chunks
 MAX_SNIPPETS  = int(os.environ.get("MAX_SNIPPETS", "4"))    # sentences in answer
 MAX_ANSWER    = int(os.environ.get("MAX_ANSWER_CHARS", "800"))
+SENT_VEC_TABLE = os.environ.get("SENT_VEC_TABLE", "")
+SENT_RERANK   = os.environ.get("SENT_RERANK", "true").lower() == "true" and bool(SENT_VEC_TABLE)
+SENT_MIN_SCORE = float(os.environ.get("SENT_MIN_SCORE", "0.2"))
 
-# ---------- Bedrock / DDB ----------
-ddb = boto3.resource("dynamodb")
-table = ddb.Table(os.environ["TABLE_NAME"])
-bedrock = boto3.client("bedrock-runtime", region_name=os.environ["BEDROCK_REGION"])
+# ---------- Request pipeline / latency budget ----------
+ANSWER_BUDGET_MS = int(os.environ.get("ANSWER_BUDGET_MS", "8000"))
+POLISH_MIN_MS    = int(os.environ.get("POLISH_MIN_MS", "300"))
+ANSWER_DEBUG     = os.environ.get("ANSWER_DEBUG", "false").lower() == "true"
 
-MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "amazon.titan-embed-text-v2:0")
-TOP_K    = int(os.environ.get("TOP_K", "5"))
+# ---------- Bedrock / DDB ----------
+# polish calls get their own client: a socket read never outlives the request budget and a
+# timed-out call is not retried, so an abandoned polish worker frees itself
+bedrock_llm = boto3.client("bedrock-runtime", region_name=os.environ["BEDROCK_REGION"],
+                           config=Config(read_timeout=max(1.0, ANSWER_BUDGET_MS / 1000),
+                                         connect_timeout=2, retries={"max_attempts": 1}))
+
+TOP_K      = int(os.environ.get("TOP_K", "5"))
+CORPUS_DOC = "__corpus__"     # chunkId="version": counter bumped on every index / delete
+
+# ---------- Answer cache ----------
+ANSWER_CACHE_SIZE  = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL   = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "86400"))
+ANSWER_CACHE_TABLE = os.environ.get("ANSWER_CACHE_TABLE", "")
+answer_cache_table = ddb.Table(ANSWER_CACHE_TABLE) if ANSWER_CACHE_TABLE else None
+SEM_CACHE_SIZE      = int(os.environ.get("SEM_CACHE_SIZE", "512"))
+SEM_CACHE_THRESHOLD = float(os.environ.get("SEM_CACHE_THRESHOLD", "0.92"))
 
 def enforce_summary_line(md: str) -> str:
     lines = [ln for ln in (md or "").splitlines()]
@@ -137,16 +188,12 @@ def sanitize_markdown(md: str) -> str:
     return "\n".join(res2).strip()
 
 # ---------- LLM polish ----------
-def polish_with_llm(raw_answer: str, citations: list) -> str:
-    """
-    Uses Titan Text (amazon.titan-text-*) if selected; supports Anthropic if you switch later.
-    """
+def polish_request(raw_answer: str, citations: list):
+    """Bedrock request body for the polish model, or None for an unknown provider."""
     ctx = {"answer": raw_answer, "citations": citations}
     mid = QA_LLM_MODEL_ID
-
-    # Titan Text request/response
     if mid.startswith("amazon.titan-text"):
-        body = {
+        return {
             "inputText": (
                     SYSTEM_PROMPT
                     + "\n\nJSON CONTEXT (use only this content):\n"
@@ -159,7 +206,28 @@ def polish_with_llm(raw_answer: str, citations: list) -> str:
                 "stopSequences": []
             }
         }
-        resp = bedrock.invoke_model(
+    if mid.startswith("anthropic."):
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "system": SYSTEM_PROMPT,
+            "messages": [
+                {"role":"user","content":[{"type":"text","text": json.dumps(ctx, ensure_ascii=False)}]}
+            ],
+            "max_tokens": QA_LLM_MAXTOK,
+            "temperature": QA_LLM_TEMP
+        }
+    return None
+
+def polish_with_llm(raw_answer: str, citations: list) -> str:
+    """
+    Uses Titan Text (amazon.titan-text-*) if selected; supports Anthropic if you switch later.
+    """
+    mid = QA_LLM_MODEL_ID
+    body = polish_request(raw_answer, citations)
+
+    # Titan Text request/response
+    if mid.startswith("amazon.titan-text"):
+        resp = bedrock_llm.invoke_model(
             modelId=mid,
             contentType="application/json",
             accept="application/json",
@@ -176,16 +244,7 @@ def polish_with_llm(raw_answer: str, citations: list) -> str:
 
     # Anthropic (fallback)
     if mid.startswith("anthropic."):
-        body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "system": SYSTEM_PROMPT,
-            "messages": [
-                {"role":"user","content":[{"type":"text","text": json.dumps(ctx, ensure_ascii=False)}]}
-            ],
-            "max_tokens": QA_LLM_MAXTOK,
-            "temperature": QA_LLM_TEMP
-        }
-        resp = bedrock.invoke_model(
+        resp = bedrock_llm.invoke_model(
             modelId=mid,
             contentType="application/json",
             accept="application/json",
@@ -202,96 +261,334 @@ def polish_with_llm(raw_answer: str, citations: list) -> str:
     # Unknown provider → raw
     return raw_answer
 
-def maybe_polish_answer(raw_answer: str, citations: list) -> str:
-    if not QA_LLM_ENABLE:
-        return raw_answer
-    if not raw_answer or not isinstance(raw_answer, str) or not raw_answer.strip():
-        return raw_answer  # nothing to rewrite
+def polish_stream(raw_answer: str, citations: list):
+    """Yields the polish model's raw text deltas as they arrive (invoke_model_with_response_stream)."""
+    body = polish_request(raw_answer, citations)
+    if body is None:
+        return
+    resp = bedrock_llm.invoke_model_with_response_stream(
+        modelId=QA_LLM_MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps(body).encode("utf-8")
+    )
+    for event in resp["body"]:
+        chunk = json.loads(event.get("chunk", {}).get("bytes") or b"{}")
+        # Titan Text: {"outputText": ...}; Anthropic messages: content_block_delta / text_delta
+        text = chunk.get("outputText") or (chunk.get("delta") or {}).get("text") or ""
+        if text:
+            yield text
+
+# ---------- Request pipeline: latency budget + stage timings ----------
+# Background work runs on small pools kept warm across invocations: corpus prefetch on _POOL,
+# LLM polish on _POLISH_POOL, so polish calls stuck on Bedrock can never starve the prefetch.
+# A polish call that outlives the budget is abandoned, not cancelled: its result is discarded,
+# and bedrock_llm's read timeout bounds how long it keeps its worker.
+_POOL = ThreadPoolExecutor(max_workers=4)
+_POLISH_POOL = ThreadPoolExecutor(max_workers=4)
+
+class _Deadline:
+    """Per-request latency budget; stage() records how long each pipeline stage took (ms)."""
+
+    def __init__(self, budget_ms):
+        self.t0, self.budget_ms, self.stages = time.perf_counter(), budget_ms, {}
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.t0) * 1000
+
+    def remaining_ms(self):
+        return self.budget_ms - self.elapsed_ms()
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round((time.perf_counter() - t) * 1000, 1)
+
+    def timed(self, name, fn, *args):
+        with self.stage(name):
+            return fn(*args)
+
+def request_budget_ms(context):
+    budget = ANSWER_BUDGET_MS
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        budget = min(budget, context.get_remaining_time_in_millis() - 500)   # keep time to respond
+    return budget
+
+def polish_within(raw_answer, citations, deadline):
+    """Polish bounded by the remaining budget → (markdown, status: ok|disabled|skipped|timeout|failed)."""
+    if not QA_LLM_ENABLE or not (raw_answer or "").strip():
+        return raw_answer, "disabled"
+    left = deadline.remaining_ms()
+    if left < POLISH_MIN_MS:
+        print(f"[IDE] LLM polish skipped: {left:.0f} ms of budget left")
+        return raw_answer, "skipped"
+    fut = _POLISH_POOL.submit(polish_with_llm, raw_answer, citations)
     try:
-        return polish_with_llm(raw_answer, citations)
+        return fut.result(timeout=left / 1000), "ok"
+    except FutureTimeout:
+        print(f"[IDE] LLM polish timed out after {left:.0f} ms, returning answer_raw")
+        return raw_answer, "timeout"
     except Exception as e:
+        # a failed polish falls back to answer_raw but must not be cached as a good answer
         print("[IDE] LLM polish failed, falling back:", repr(e))
-        return raw_answer
-
-# ---------- OpenSearch helper (kept for later wiring) ----------
-def _es(method: str, path: str, body=None, params: str=""):
-    if not _os_endpoint:
-        raise RuntimeError("OS_ENDPOINT not configured")
-    url = f"{_os_endpoint}{path}{('?' + params) if params else ''}"
-    data = json.dumps(body).encode("utf-8") if isinstance(body, dict) else (body or None)
-    headers = {"host": _os_endpoint.replace("https://","").replace("http://",""),
-               "content-type": "application/json"}
-    req = AWSRequest(method=method, url=url, data=data, headers=headers)
-    SigV4Auth(_creds, _sigv4_service, _region).add_auth(req)
-    r = _http.request(method, url, body=data, headers=dict(req.headers))
-    if r.status >= 300:
-        raise RuntimeError(f"OS {method} {path} -> {r.status} {r.data[:400]!r}")
-    if r.data and r.headers.get("content-type","").startswith("application/json"):
-        return json.loads(r.data.decode("utf-8"))
-    return None
-
-# ---------- Embeddings & utils ----------
-def embed(text: str):
-    body = json.dumps({"inputText": text})
-    resp = bedrock.invoke_model(modelId=MODEL_ID,
-                                contentType="application/json",
-                                accept="application/json",
-                                body=body)
-    payload = json.loads(resp["body"].read())
-    return payload.get("embedding") or payload.get("embeddings") or []
-
-def cosine(a, b):
-    if not a or not b or len(a) != len(b): return -1.0
-    num = sum(x*y for x,y in zip(a,b))
-    da  = math.sqrt(sum(x*x for x in a))
-    db  = math.sqrt(sum(y*y for y in b))
-    return (num/(da*db)) if da and db else -1.0
-
-def to_float_list(vec):
-    return [float(x) for x in vec]
-
-def scan_all_items():
-    items, resp = [], table.scan()
-    items.extend(resp.get("Items", []))
-    while "LastEvaluatedKey" in resp:
-        resp = table.scan(ExclusiveStartKey=resp["LastEvaluatedKey"])
-        items.extend(resp.get("Items", []))
-    return items
-
-# ---------- Text heuristics ----------
-EXCLUDE_PREFIXES = ("contents","glossary","faq","ingredients","serves","prep","cook")
-
-def split_sentences(text):
-    return [s.strip() for s in re.split(r"(?<=[.!?])\s+", text or "") if s and s.strip()]
-
-def is_heading_or_noise(s: str) -> bool:
-    ls = (s or "").lower().strip()
+        return raw_answer, "failed"
 
-    # obvious headings / sections
-    if any(ls.startswith(p) for p in EXCLUDE_PREFIXES):
-        return True
+_STREAM_END = object()
 
-    # drop question-only stubs like "Tips Too thin?"
-    if ls.endswith("?") and (ls.startswith("tips") or len(ls.split()) <= 4):
-        return True
+def stream_within(items, deadline):
+    """
+    Re-yields a generator that runs on _POLISH_POOL, waiting at most the remaining budget for each
+    item: a stalled Bedrock read raises TimeoutError here instead of holding the response open
+    until bedrock_llm's read timeout. The abandoned worker stops at its next item.
+    """
+    q, stop = queue.Queue(), threading.Event()
 
-    # lines that contain section meta very early (e.g., "... Serves 4 Prep 10 ...")
-    if re.search(r"\b(serves|prep|cook|ingredients)\b", ls[:60] or ""):
-        return True
+    def pump():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                q.put(item)
+            q.put(_STREAM_END)
+        except Exception as e:
+            q.put(e)
 
-    # enumerated section headers like "3) Weeknight Chicken Curry ..."
-    if re.match(r"^\d+\)\s+[A-Za-z]", ls or ""):
-        return True
+    _POLISH_POOL.submit(pump)
+    try:
+        while True:
+            left = deadline.remaining_ms()
+            try:
+                if left <= 0:
+                    raise queue.Empty
+                item = q.get(timeout=left / 1000)
+            except queue.Empty:
+                raise TimeoutError(f"polish stream did not finish within the {deadline.budget_ms} ms budget")
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+# ---------- Answer cache: in-process LRU + optional shared DynamoDB tier ----------
+# Keyed by (normalized query, top_k, ANSWER_SCOPE, MIN_SCORE, polish model, backend, corpus version).
+# The corpus version is the CORPUS_DOC counter (read consistently once per request), so an index
+# or delete anywhere makes every older entry unreachable; TTL only reclaims space. Answers whose
+# polish was skipped or timed out are not cached.
+_ACACHE = OrderedDict()   # key -> (expires_at, payload)
+_ACACHE_STATS = {"lru": 0, "ddb": 0, "miss": 0}
+
+def corpus_version():
+    it = table.get_item(Key={"docId": CORPUS_DOC, "chunkId": "version"}, ConsistentRead=True).get("Item") or {}
+    version = str(int(it.get("version", 0)))
+    if SEARCH_BACKEND == "ANN":
+        version += f"/ann:{_load_ann()['version']}"   # ANN results change with the snapshot, not the table
+    return version
+
+def answer_settings_key(top_k, version, filters=None):
+    """
+    Everything besides the question that shapes an answer (shared by the exact and semantic caches):
+    retrieval, extraction (including the sentence rules' SENT_VERSION) and polish settings, the
+    corpus version and the request's filters. Changing any of them misses the old entries.
+    """
+    retrieval = [SEARCH_BACKEND, MODEL_ID, EMBED_DIM, OS_NUM_CANDIDATES, ANN_NPROBE, ANN_EF_SEARCH]
+    extraction = [ANSWER_SCOPE, MIN_SCORE, MAX_SNIPPETS, MAX_ANSWER, SENT_RERANK, SENT_MIN_SCORE, SENT_VERSION]
+    polish = [QA_LLM_MODEL_ID, QA_LLM_TEMP, QA_LLM_MAXTOK, SYSTEM_PROMPT] if QA_LLM_ENABLE else None
+    parts = [top_k, retrieval, extraction, polish, version, filters]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def answer_cache_key(query, settings):
+    norm = re.sub(r"\s+", " ", (query or "").lower()).strip()
+    return hashlib.sha256(f"{settings}\n{norm}".encode("utf-8")).hexdigest()
+
+def _acache_remember(key, payload, expires_at):
+    _ACACHE[key] = (expires_at, payload)
+    _ACACHE.move_to_end(key)
+    while len(_ACACHE) > ANSWER_CACHE_SIZE:
+        _ACACHE.popitem(last=False)
+
+def answer_cache_get(key):
+    """→ (payload, tier) with tier "lru" / "ddb", or (None, "miss")."""
+    now = time.time()
+    hit = _ACACHE.get(key)
+    if hit and hit[0] > now:
+        _ACACHE.move_to_end(key)
+        return hit[1], "lru"
+    if answer_cache_table is not None:
+        try:
+            it = answer_cache_table.get_item(Key={"k": key}).get("Item")
+            if it and int(it.get("expiresAt", now + 1)) > now:
+                payload = json.loads(it["payload"])
+                _acache_remember(key, payload, int(it["expiresAt"]))
+                return payload, "ddb"
+        except Exception as e:
+            print("[IDE] answer cache read failed:", repr(e))
+    return None, "miss"
 
-    # raw "Ingredients ..." lists or lines with lots of commas (likely ingredient enumerations)
-    if "ingredients" in ls or (ls.count(",") >= 6 and "tip" not in ls):
-        return True
+def answer_cache_put(key, payload):
+    expires_at = int(time.time() + ANSWER_CACHE_TTL)
+    _acache_remember(key, dict(payload), expires_at)
+    if answer_cache_table is not None:
+        try:
+            answer_cache_table.put_item(Item={"k": key, "payload": json.dumps(payload, default=_json_default),
+                                              "expiresAt": expires_at})
+        except Exception as e:
+            print("[IDE] answer cache write failed:", repr(e))
 
-    # very short / formatting noise
-    if len(ls) < 5:
-        return True
+def cached_answer(query, top_k, filters=None):
+    """
+    → (cache key, settings key, cached payload or None, tier); both keys are None when caching
+    is off or the corpus version could not be read.
+    """
+    if ANSWER_CACHE_SIZE <= 0 and SEM_CACHE_SIZE <= 0:
+        return None, None, None, "off"
+    try:
+        version = corpus_version()
+    except Exception as e:
+        print("[IDE] corpus version read failed, answer cache bypassed:", repr(e))
+        return None, None, None, "off"
+    if _CORPUS.get("stamp") != version:
+        # the corpus changed since the warm index was last checked: refresh it before answering,
+        # or a fresh answer built from the old index would be cached under the new version
+        _CORPUS["stamp"] = version
+        _CORPUS["checked_at"] = 0.0
+    settings = answer_settings_key(top_k, version, filters)
+    if _SEM["version"] != version:
+        _SEM.update(version=version, blocks={})   # entries of older corpus versions can never match again
+    key = answer_cache_key(query, settings)
+    payload, tier = answer_cache_get(key) if ANSWER_CACHE_SIZE > 0 else (None, "miss")
+    _ACACHE_STATS[tier] += 1
+    hits = _ACACHE_STATS["lru"] + _ACACHE_STATS["ddb"]
+    print(f"[IDE] answer cache {tier}: version={version} hit_ratio={hits / (hits + _ACACHE_STATS['miss']):.2f} "
+          f"lru={_ACACHE_STATS['lru']} ddb={_ACACHE_STATS['ddb']} miss={_ACACHE_STATS['miss']}")
+    return key, settings, payload, tier
+
+# ---------- Semantic answer cache: reuse answers for near-duplicate questions ----------
+# Per settings key (see answer_settings_key, which includes the corpus version) a ring buffer of
+# up to SEM_CACHE_SIZE L2-normalized query vectors + their responses, in process only. A lookup
+# is one matrix-vector product; the best match is reused when its cosine is >= SEM_CACHE_THRESHOLD.
+# The best similarity of every lookup is also counted against SEM_THRESHOLDS, so the logs show
+# how the hit rate would move with the threshold.
+SEM_THRESHOLDS = (0.80, 0.85, 0.90, 0.92, 0.95, 0.98)
+_SEM = {"version": None, "blocks": {}}   # settings -> {"mat", "n", "next", "queries", "payloads"}
+_SEM_STATS = {"hit": 0, "miss": 0, "would_hit": {t: 0 for t in SEM_THRESHOLDS}}
+
+def _unit(qv):
+    q = np.asarray(qv, dtype=np.float32)
+    n = float(np.linalg.norm(q))
+    return q / n if n else None
+
+def semantic_cache_get(qv, settings):
+    """→ (payload or None, best cosine, matched query or None)."""
+    block, q = _SEM["blocks"].get(settings), _unit(qv)
+    best, match = -1.0, None
+    if block and block["n"] and q is not None and q.size == block["mat"].shape[1]:
+        sims = block["mat"][:block["n"]] @ q
+        match = int(np.argmax(sims))
+        best = float(sims[match])
+    hit = best >= SEM_CACHE_THRESHOLD
+    _SEM_STATS["hit" if hit else "miss"] += 1
+    for t in SEM_THRESHOLDS:
+        _SEM_STATS["would_hit"][t] += best >= t
+    lookups = _SEM_STATS["hit"] + _SEM_STATS["miss"]
+    print(f"[IDE] semantic cache {'hit' if hit else 'miss'}: best_sim={best:.3f} threshold={SEM_CACHE_THRESHOLD} "
+          f"hit_ratio={_SEM_STATS['hit'] / lookups:.2f} would_hit="
+          + " ".join(f"{t}:{n / lookups:.2f}" for t, n in _SEM_STATS["would_hit"].items()))
+    if not hit:
+        return None, best, None
+    return block["payloads"][match], best, block["queries"][match]
+
+def semantic_cache_put(qv, settings, query, payload):
+    q = _unit(qv)
+    if q is None:
+        return
+    block = _SEM["blocks"].get(settings)
+    if block is None or block["mat"].shape[1] != q.size:
+        block = _SEM["blocks"][settings] = {"mat": np.zeros((SEM_CACHE_SIZE, q.size), dtype=np.float32),
+                                            "n": 0, "next": 0, "queries": [None] * SEM_CACHE_SIZE,
+                                            "payloads": [None] * SEM_CACHE_SIZE}
+    i = block["next"]   # ring buffer: the oldest entry is overwritten once full
+    block["mat"][i], block["queries"][i], block["payloads"][i] = q, query, dict(payload)
+    block["next"] = (i + 1) % SEM_CACHE_SIZE
+    block["n"] = min(block["n"] + 1, SEM_CACHE_SIZE)
+
+def semantic_answer(query, qv, key, settings):
+    """Semantic cache lookup after an exact miss → (payload or None, debug info or None)."""
+    if settings is None or SEM_CACHE_SIZE <= 0:
+        return None, None
+    payload, best, matched = semantic_cache_get(qv, settings)
+    info = {"similarity": round(best, 4), "threshold": SEM_CACHE_THRESHOLD}
+    if payload is None:
+        return None, info
+    if ANSWER_CACHE_SIZE > 0:
+        answer_cache_put(key, payload)   # the exact question is now a plain cache hit as well
+    return payload, {**info, "matched_query": matched}
+
+def remember_answer(key, settings, qv, payload):
+    if key and ANSWER_CACHE_SIZE > 0:
+        answer_cache_put(key, payload)
+    if settings and SEM_CACHE_SIZE > 0:
+        semantic_cache_put(qv, settings, payload["query"], payload)
+
+# Corpus work that can overlap with the query-embedding call (backends that keep a warm index)
+_PREFETCH = {"DDB": _get_index, "MEMORY": _get_index, "ANN": _load_ann}
 
-    return False
+# ---------- Text heuristics ----------
+# Sentence index written by the indexers: "sents" holds packed uint16 (start, end, flags) triples
+# per sentence of the chunk text, flag SENT_NOISE = is_heading_or_noise(). Items without it, or
+# with another "sentVer" (rules changed since they were indexed), are split here per request.
+# The rules live in ide_sentences.py so both sides always agree on them.
+
+SENT_ATTRS = ("sents", "sentVer")   # fetched with the top-k winners (OpenSearch hits carry neither)
+# With SENT_RERANK the winners also bring "embHash" and the "sentEmb" marker; the sentence vectors
+# themselves stay in SENT_VEC_TABLE and are read only for the chunks the answer is built from.
+SENT_VEC_ATTRS = ("embHash", "sentEmb")
+
+def sent_index(it):
+    sents = it.get("sents")
+    if sents is None or it.get("sentVer") != SENT_VERSION:
+        return None
+    raw = sents.value if isinstance(sents, Binary) else sents
+    return np.frombuffer(raw, dtype="<u2").reshape(-1, 3)
+
+def sent_vecs(it):
+    # SENT_EMBED on the indexers: packed float16, one row per usable sentence (flat; rows checked later)
+    raw = it.get("sentVecs")
+    if raw is None or not SENT_RERANK:
+        return None
+    return np.frombuffer(raw.value if isinstance(raw, Binary) else raw, dtype="<f2")
+
+def fetch_sent_vecs(refs):
+    """
+    {(docId, chunkId): (embHash, sentEmb)} of the chunks an answer is built from → {key: flat
+    float16 vectors}, one BatchGetItem on SENT_VEC_TABLE. Nothing is read unless every chunk was
+    indexed with sentence vectors of this model (the rerank needs all of them); a store row whose
+    embHash differs from the chunk's belongs to an older text and is ignored.
+    """
+    if not SENT_RERANK or not refs or any(emb != MODEL_ID for _, emb in refs.values()):
+        return {}
+    rows = batch_get(SENT_VEC_TABLE, list(refs), "docId, chunkId, embHash, sentEmb, sentVecs", phase="sents")
+    out = {k: sent_vecs(row) for k, row in rows.items()
+           if row.get("embHash") == refs[k][0] and row.get("sentEmb") == MODEL_ID}
+    print(f"[IDE] sentence vectors: {len(out)}/{len(refs)} chunks, {_READS['sents']['bytes']} bytes")
+    return out
+
+def sentence_rows(vecs, n, dim):
+    """Flat stored sentence vectors → (n, dim) float32, or None when they do not match the sentences."""
+    if vecs is None or not dim or vecs.size != n * dim:
+        return None
+    return vecs.reshape(n, dim).astype(np.float32)
+
+def chunk_sentences(text, index=None):
+    """Usable (non-noise) sentences of a chunk, sliced by its stored sentence index when present."""
+    text = text or ""
+    if index is not None:
+        return [text[s:e] for s, e, flags in index.tolist() if not flags & SENT_NOISE]
+    return [s for s in split_sentences(text) if not is_heading_or_noise(s)]
 
 def expand_terms(q: str):
     ql = (q or "").lower(); adds = set()
@@ -310,7 +607,8 @@ def needs_focus_gate(query: str) -> bool:
     ql = (query or "").lower()
     return ("thicken" in ql) or ("thin" in ql and "sauce" in ql)
 
-def pick_sentences_focus(query, texts, limit_chars=800):
+def pick_sentences_focus(query, sentences, limit_chars=800):
+    # sentences: the chunks' non-noise sentences in order (chunk_sentences)
     # tokenize query and drop stopwords
     q_terms  = {t for t in re.findall(r"[A-Za-z0-9]+", (query or "").lower()) if t not in STOPWORDS}
     syn_terms = expand_terms(query)
@@ -328,27 +626,34 @@ def pick_sentences_focus(query, texts, limit_chars=800):
 
     # collect candidates
     cand = []
-    for t in texts:
-        for s in split_sentences(t):
-            if is_heading_or_noise(s):
-                continue
-            r = relevance(s)
-            if r > 0:
-                cand.append((r, len(s), s))
+    for s in sentences:
+        r = relevance(s)
+        if r > 0:
+            cand.append((r, len(s), s))
 
     if not cand:
-        for t in texts:
-            for s in split_sentences(t):
-                if not is_heading_or_noise(s):
-                    return s[:limit_chars]
-        return (texts[0] or "")[:limit_chars] if texts else ""
+        # first usable sentence; with none at all the handler falls back to the raw chunk text
+        return sentences[0][:limit_chars] if sentences else ""
 
     # sort: higher relevance first, then shorter sentences preferred
     cand.sort(key=lambda x: (x[0], -x[1]), reverse=True)
-
+    return compose_answer([s for _, _, s in cand], limit_chars)
+
+def pick_sentences_semantic(qv, sentences, mat, limit_chars=800):
+    """Ranks sentences by cosine between their stored vectors (rows of mat) and the query vector."""
+    q = np.asarray(qv, dtype=np.float32)
+    qn = float(np.linalg.norm(q))
+    if not qn or mat.shape != (len(sentences), q.size):
+        return ""
+    norms = np.linalg.norm(mat, axis=1)
+    scores = (mat @ (q / qn)) / np.where(norms > 0, norms, 1.0)
+    order = np.argsort(-scores, kind="stable")
+    return compose_answer([sentences[i] for i in order if scores[i] >= SENT_MIN_SCORE], limit_chars)
+
+def compose_answer(ranked, limit_chars):
     # build output with simple de-duplication (case/space-insensitive)
     out, used, count, seen = [], 0, 0, set()
-    for r, ln, s in cand:
+    for s in ranked:
         norm = re.sub(r"\s+", " ", s.strip().lower())
         if norm in seen:
             continue
@@ -361,6 +666,8 @@ def pick_sentences_focus(query, texts, limit_chars=800):
 
     return " ".join(out)
 
+_SENT_STATS = {"semantic": 0, "keyword": 0}   # which sentence ranking produced answer_raw
+
 # ---------- HTTP response ----------
 def respond(status, body):
     return {
@@ -372,120 +679,296 @@ def respond(status, body):
         "body": json.dumps(body, default=_json_default)
     }
 
+def ndjson_line(event):
+    return (json.dumps(event, default=_json_default) + "\n").encode("utf-8")
+
+def respond_ndjson(status, events):
+    # API Gateway cannot stream: the events are buffered into one application/x-ndjson body
+    return {
+        "statusCode": status,
+        "headers": {
+            "content-type": "application/x-ndjson",
+            "access-control-allow-origin": "*"
+        },
+        "body": b"".join(ndjson_line(e) for e in events).decode("utf-8")
+    }
+
+# ---------- Answer pipeline ----------
+def embed_with_prefetch(query, deadline):
+    """Step 1: embed the question while the corpus cache is checked / (re)loaded in the background."""
+    prefetch = _PREFETCH.get(SEARCH_BACKEND)
+    corpus = _POOL.submit(deadline.timed, "corpus", prefetch) if prefetch else None
+    with deadline.stage("embed"):
+        qv = embed_query(query)
+    return qv, corpus
+
+def prepare_answer(query, qv, corpus, top_k, deadline, filters=None):
+    """Steps 2-4: retrieve, focus, extract → (answer_raw, citations, top_k hits, ranking)."""
+    if corpus is not None:
+        # retrieval needs the index either way; errors surface here. A load that outlives the
+        # budget keeps running in the background (the next request finds it warm).
+        try:
+            corpus.result(timeout=max(0.0, deadline.remaining_ms()) / 1000)
+        except FutureTimeout:
+            raise TimeoutError(f"corpus load did not finish within the {deadline.budget_ms} ms budget")
+
+    # 2) Retrieve + score (default: warm in-memory index, refreshed incrementally)
+    with deadline.stage("retrieve"):
+        top = retrieve(qv, top_k, filters, SENT_ATTRS + (SENT_VEC_ATTRS if SENT_RERANK else ()))
+    # stored sentence indexes / vector references are only used for extraction, not returned
+    sent_idx = {(t["docId"], t["chunkId"]): (sent_index(t), (t.get("embHash"), t.get("sentEmb"))) for t in top}
+    for t in top:
+        for attr in (*SENT_ATTRS, *SENT_VEC_ATTRS):
+            t.pop(attr, None)
+
+    # --- DEBUG: top-k overview ---
+    try:
+        print("[IDE] top_k count:", len(top))
+        print("[IDE] top_k scores:", [round(float(t.get("score",0.0)), 4) for t in top])
+        print("[IDE] top_k docIds:", list({t.get("docId") for t in top}))
+    except Exception as e:
+        print("[IDE] debug(top) failed:", repr(e))
+
+    # 3) Focus on the *best* document (cleaner answers)
+    best_doc = top[0]["docId"] if top else None
+    if ANSWER_SCOPE == "best_doc" and best_doc:
+        filtered = [t for t in top if t["docId"] == best_doc and t["score"] >= MIN_SCORE]
+        if not filtered:
+            filtered = top[:1]
+    else:
+        filtered = [t for t in top if t["score"] >= MIN_SCORE] or top[:1]
+
+    # --- DEBUG: filtered view ---
+    try:
+        print("[IDE] best_doc:", best_doc)
+        print("[IDE] filtered_count:", len(filtered))
+        print("[IDE] filtered_scores:", [round(float(t.get("score",0.0)), 4) for t in filtered])
+    except Exception as e:
+        print("[IDE] debug(filtered) failed:", repr(e))
+
+    # 4) Build focused extractive answer + citations
+    keys = [(t["docId"], t["chunkId"]) for t in filtered]
+    if SENT_RERANK and all(sent_idx[k][0] is not None for k in keys):
+        with deadline.stage("sent_vecs"):
+            stored = fetch_sent_vecs({k: sent_idx[k][1] for k in keys})
+    else:
+        stored = {}
+    extract_t0 = time.perf_counter()
+    sentences, rows = [], []
+    for t, key in zip(filtered, keys):
+        index, vecs = sent_idx[key][0], stored.get(key)
+        sents = chunk_sentences(t["text"], index)
+        sentences += sents
+        rows.append(sentence_rows(vecs, len(sents), len(qv)) if index is not None else None)
+    answer, ranking = "", "keyword"
+    if SENT_RERANK and sentences and all(r is not None for r in rows):
+        # every winner has sentence vectors: one matrix-vector product against the query vector
+        answer = pick_sentences_semantic(qv, sentences, np.concatenate(rows), limit_chars=MAX_ANSWER)
+        ranking = "semantic" if answer else ranking
+    if not answer:
+        answer = pick_sentences_focus(query, sentences, limit_chars=MAX_ANSWER)
+    _SENT_STATS[ranking] += 1
+    citations = [
+        {"source": t["source"], "page": t["page"], "chunkId": t["chunkId"], "score": t["score"]}
+        for t in filtered
+    ]
+
+    # --- guarantee a non-empty answer_raw (thematic fallback) ---
+    if not isinstance(answer, str) or not answer.strip():
+        answer = ""
+        thick_kw = re.compile(
+            r"\b(thicken|thickened|slurry|corn\s*flour|cornflour|cornstarch|arrowroot|roux|reduce|simmer\s+uncovered)\b",
+            re.I,
+        )
+        answer = next((s for s in sentences if thick_kw.search(s)), "")
+        if not answer and filtered:
+            answer = (filtered[0].get("text") or "")[:MAX_ANSWER]
+    deadline.stages["extract"] = round((time.perf_counter() - extract_t0) * 1000, 1)
+
+    # --- DEBUG: answer + LLM status ---
+    try:
+        print("[IDE] LLM:", QA_LLM_MODEL_ID, "enabled:", QA_LLM_ENABLE)
+        print("[IDE] answer_raw_len:", len(answer or ""), "ranking:", ranking, _SENT_STATS)
+        print("[IDE] citations(min):", [{"p": c.get("page"), "chunk": c.get("chunkId")} for c in citations])
+    except Exception as e:
+        print("[IDE] debug(answer) failed:", repr(e))
+    return answer or "", citations, top, ranking
+
+def _debug_field(deadline, polish, ranking, cache, semantic=None):
+    print(f"[IDE] stages_ms={deadline.stages} total_ms={deadline.elapsed_ms():.0f} "
+          f"budget_ms={deadline.budget_ms} polish={polish} cache={cache}")
+    info = {"budget_ms": deadline.budget_ms, "total_ms": round(deadline.elapsed_ms(), 1),
+            "stages_ms": deadline.stages, "polish": polish, "ranking": ranking, "cache": cache}
+    if semantic is not None:
+        info["semantic"] = semantic
+    return info
+
+def lookup_answer(query, top_k, deadline, filters=None):
+    """
+    Exact cache, then (after embedding the question) the semantic cache →
+    (cached payload or None, qv, corpus prefetch future, key, settings, cache tier, semantic info).
+    """
+    with deadline.stage("cache"):
+        key, settings, hit, cache = cached_answer(query, top_k, filters)
+    if hit is not None:
+        return hit, None, None, key, settings, cache, None
+    qv, corpus = embed_with_prefetch(query, deadline)
+    with deadline.stage("semantic_cache"):
+        hit, semantic = semantic_answer(query, qv, key, settings)
+    return hit, qv, corpus, key, settings, ("semantic" if hit is not None else cache), semantic
+
+CACHEABLE_POLISH = ("ok", "disabled")   # degraded (skipped / timed-out / failed) answers are not cached
+
+# ---------- Streaming answers ----------
+# NDJSON events, in order:
+#   {"type": "answer", "query", "answer_raw", "citations", "top_k"}   as soon as extraction is done
+#   {"type": "delta", "text"}                                        polish tokens as Bedrock streams them
+#   {"type": "done", "answer_md", "polish"[, "debug"]}               final, sanitized Markdown
+# Deltas are the model's raw output; clients should replace them with "done".answer_md, which
+# falls back to answer_raw when polish is disabled, fails or runs out of budget. A corpus load
+# that exceeds the budget ends the stream with a single {"type": "error", "error"} instead.
+def stream_events(query, top_k, deadline, debug=False, filters=None):
+    hit, qv, corpus, key, settings, cache, semantic = lookup_answer(query, top_k, deadline, filters)
+    if hit is not None:
+        yield {"type": "answer", "query": query, "answer_raw": hit["answer_raw"],
+               "citations": hit["citations"], "top_k": hit["top_k"]}
+        done = {"type": "done", "answer_md": hit["answer_md"], "polish": "cached"}
+        info = _debug_field(deadline, "cached", None, cache, semantic)
+        if debug:
+            done["debug"] = info
+        yield done
+        return
+
+    try:
+        answer, citations, top, ranking = prepare_answer(query, qv, corpus, top_k, deadline, filters)
+    except TimeoutError as e:
+        print("[IDE]", e)
+        yield {"type": "error", "error": str(e)}
+        return
+    yield {"type": "answer", "query": query, "answer_raw": answer, "citations": citations, "top_k": top}
+
+    md, polish = answer, "disabled"
+    if QA_LLM_ENABLE and answer.strip():
+        polish = "skipped" if deadline.remaining_ms() < POLISH_MIN_MS else "ok"
+    if polish == "ok":
+        parts, t0 = [], time.perf_counter()
+        try:
+            for delta in stream_within(polish_stream(answer, citations), deadline):
+                parts.append(delta)
+                yield {"type": "delta", "text": delta}
+        except TimeoutError as e:
+            print(f"[IDE] LLM {e}, returning answer_raw")
+            polish = "timeout"
+        except Exception as e:
+            print("[IDE] LLM polish stream failed, falling back:", repr(e))
+            polish = "failed"
+        if polish == "ok":
+            md = enforce_summary_line(sanitize_markdown("".join(parts))) or answer
+        deadline.stages["polish"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    if polish in CACHEABLE_POLISH:
+        remember_answer(key, settings, qv, {"query": query, "answer_raw": answer, "answer_md": md,
+                                            "citations": citations, "top_k": top})
+    done = {"type": "done", "answer_md": md, "polish": polish}
+    info = _debug_field(deadline, polish, ranking, cache, semantic)
+    if debug:
+        done["debug"] = info
+    yield done
+
+def _parse_request(event):
+    """API Gateway v2.0 / Function URL event → (data, None) or (None, error response body)."""
+    body = event.get("body") or "{}"
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode("utf-8")
+    try:
+        data = json.loads(body)
+    except Exception:
+        return None, {"error": "Body must be JSON"}
+    if not (data.get("query") or "").strip():
+        return None, {"error": "Provide JSON body: {\"query\":\"...\"}"}
+    try:
+        data["top_k"] = int(data.get("top_k", TOP_K))
+    except (TypeError, ValueError):
+        return None, {"error": "top_k must be an integer"}
+    try:
+        data["filters"] = parse_filters(data)   # normalized in place
+    except (TypeError, ValueError) as e:
+        return None, {"error": f"Invalid filters: {e}"}
+    return data, None
+
+def stream_handler(event, response_stream, context):
+    """
+    Response-streaming entry point: a Function URL with InvokeMode RESPONSE_STREAM, served by a
+    custom runtime or the Lambda Web Adapter that hands the handler a writable
+    `response_stream` (.write(bytes)); managed Python runtimes cannot stream.
+    Each NDJSON event is written as soon as it is ready; lambda_handler stays the JSON entry point.
+    """
+    data, error = _parse_request(event)
+    if error:
+        response_stream.write(ndjson_line({"type": "error", **error}))
+        return
+    deadline = _Deadline(request_budget_ms(context))
+    for ev in stream_events(data["query"].strip(), data["top_k"], deadline,
+                            debug=ANSWER_DEBUG or bool(data.get("debug")), filters=data["filters"]):
+        response_stream.write(ndjson_line(ev))
+
 # ---------- Handler ----------
 def lambda_handler(event, context):
     # HTTP (API Gateway v2.0)
     if "requestContext" in event and "http" in event["requestContext"]:
-        body = event.get("body") or "{}"
-        if event.get("isBase64Encoded"):
-            body = base64.b64decode(body).decode("utf-8")
-        try:
-            data = json.loads(body)
-        except Exception:
-            return respond(400, {"error": "Body must be JSON"})
-
-        query = (data.get("query") or "").strip()
-        top_k = int(data.get("top_k", TOP_K))
-        if not query:
-            return respond(400, {"error": "Provide JSON body: {\"query\":\"...\"}"})
-
-        # 1) Embed the question
-        qv = embed(query)
-
-        # 2) Retrieve all chunks and score (small corpora → full table scan)
-        items = scan_all_items()
-        scored = []
-        for it in items:
-            vec = it.get("vec")
-            if not vec:
-                continue
-            score = cosine(qv, to_float_list(vec))
-            scored.append({
-                "score": float(score),
-                "docId": it["docId"],
-                "chunkId": it["chunkId"],
-                "page": int(it.get("page")) if it.get("page") is not None else None,
-                "text": it.get("text",""),
-                "source": it.get("source")
-            })
-        top = sorted(scored, key=lambda x: x["score"], reverse=True)[:top_k]
-
-        # --- DEBUG: top-k overview ---
+        data, error = _parse_request(event)
+        if error:
+            return respond(400, error)
+
+        query = data["query"].strip()
+        top_k = data["top_k"]
+        filters = data["filters"]
+        deadline = _Deadline(request_budget_ms(context))
+        debug = ANSWER_DEBUG or bool(data.get("debug"))
+
+        # "stream": true → the streaming event sequence, buffered into one NDJSON body
+        if data.get("stream"):
+            return respond_ndjson(200, stream_events(query, top_k, deadline, debug, filters))
+
+        # 0-1) Answer cache (same query/settings against the same corpus version), then embed the
+        # question and look for a near-duplicate one in the semantic cache
+        hit, qv, corpus, key, settings, cache, semantic = lookup_answer(query, top_k, deadline, filters)
+        if hit is not None:
+            payload = {**hit, "query": query}
+            if debug:
+                payload["debug"] = _debug_field(deadline, "cached", None, cache, semantic)
+            return respond(200, payload)
+
+        # 2-4) Retrieve (within the request's filters), focus, extract
         try:
-            print("[IDE] top_k count:", len(top))
-            print("[IDE] top_k scores:", [round(float(t.get("score",0.0)), 4) for t in top])
-            print("[IDE] top_k docIds:", list({t.get("docId") for t in top}))
-        except Exception as e:
-            print("[IDE] debug(top) failed:", repr(e))
-
-        # 3) Focus on the *best* document (cleaner answers)
-        best_doc = top[0]["docId"] if top else None
-        if ANSWER_SCOPE == "best_doc" and best_doc:
-            filtered = [t for t in top if t["docId"] == best_doc and t["score"] >= MIN_SCORE]
-            if not filtered:
-                filtered = top[:1]
-        else:
-            filtered = [t for t in top if t["score"] >= MIN_SCORE] or top[:1]
-
-        # --- DEBUG: filtered view ---
-        try:
-            print("[IDE] best_doc:", best_doc)
-            print("[IDE] filtered_count:", len(filtered))
-            print("[IDE] filtered_scores:", [round(float(t.get("score",0.0)), 4) for t in filtered])
-        except Exception as e:
-            print("[IDE] debug(filtered) failed:", repr(e))
-
-        # 4) Build focused extractive answer + citations
-        answer = pick_sentences_focus(query, [t["text"] for t in filtered], limit_chars=MAX_ANSWER)
-        citations = [
-            {"source": t["source"], "page": t["page"], "chunkId": t["chunkId"], "score": t["score"]}
-            for t in filtered
-        ]
-
-        # --- guarantee a non-empty answer_raw (thematic fallback) ---
-        if not isinstance(answer, str) or not answer.strip():
-            answer = ""
-            thick_kw = re.compile(
-                r"\b(thicken|thickened|slurry|corn\s*flour|cornflour|cornstarch|arrowroot|roux|reduce|simmer\s+uncovered)\b",
-                re.I,
-            )
-            for t in filtered:
-                for s in split_sentences(t.get("text") or ""):
-                    if is_heading_or_noise(s):
-                        continue
-                    if thick_kw.search(s):
-                        answer = s
-                        break
-                if answer:
-                    break
-            if not answer and filtered:
-                answer = (filtered[0].get("text") or "")[:MAX_ANSWER]
-
-        # --- DEBUG: answer + LLM status ---
-        try:
-            print("[IDE] LLM:", QA_LLM_MODEL_ID, "enabled:", QA_LLM_ENABLE)
-            print("[IDE] answer_raw_len:", len(answer or ""))
-            print("[IDE] citations(min):", [{"p": c.get("page"), "chunk": c.get("chunkId")} for c in citations])
-        except Exception as e:
-            print("[IDE] debug(answer) failed:", repr(e))
+            answer, citations, top, ranking = prepare_answer(query, qv, corpus, top_k, deadline, filters)
+        except TimeoutError as e:
+            print("[IDE]", e)
+            return respond(503, {"error": str(e)})
 
-        # 5) Optional LLM polish → Markdown (falls back to raw if disabled or fails)
-        pretty_md = maybe_polish_answer(answer, citations)
+        # 5) Optional LLM polish → Markdown (falls back to raw if disabled, failed or out of budget)
+        with deadline.stage("polish"):
+            pretty_md, polish = polish_within(answer, citations, deadline)
+        info = _debug_field(deadline, polish, ranking, cache, semantic)
 
         # Final payload (both raw + polished)
         payload = {
             "query": query,
-            "answer_raw": answer or "",
+            "answer_raw": answer,
             "answer_md":  pretty_md,
             "citations":  citations,
             "top_k":      top
         }
+        if polish in CACHEABLE_POLISH:
+            remember_answer(key, settings, qv, payload)
+        if debug:
+            payload["debug"] = info
         return respond(200, payload)
 
     # Console test path
     query = (event.get("query") or "").strip() if isinstance(event, dict) else ""
     if not query:
         return {"error": "Provide {\"query\":\"...\"} in the event."}
-    api_evt = {"requestContext":{"http":{}}, "body": json.dumps({"query": query, "top_k": event.get("top_k", TOP_K)})}
+    api_evt = {"requestContext":{"http":{}}, "body": json.dumps({"query": query, "top_k": event.get("top_k", TOP_K),
+                                                                "filters": event.get("filters")})}
     return lambda_handler(api_evt, context)
-
@@ -14,25 +14,40 @@
 # Stage: $default
 # Statement ID: c198b0ba-3df2-535d-8689-dd37028750c3
 
+# Package with: ide_indexing.py, ide_sentences.py   (shared with ide-embed-index / ide-ingest)
+
 # Environment variables
 # BUCKET: ide-bd-eu-west-2
+# DELETE_WORKERS: 4   (parallel BatchWriteItem senders)
 # DRY_RUN: false
 # EXTRACTED_PREFIX: extracted/
+# OS_BULK_SIZE: 200
+# OS_DUAL_WRITE: false
+# OS_ENDPOINT: https://<YOUR_OPENSEARCH_ENDPOINT>.aoss.amazonaws.com
+# OS_INDEX: ide-rag
+# OS_SIGV4_SERVICE: aoss   (Serverless: generated doc ids + _delete_by_query; "es" for a managed domain, "none" unsigned, e.g. a local OpenSearch)
+# SEARCH_BACKEND: DDB
+# SENT_VEC_TABLE: ide-rag-sentvecs   (optional, set when the indexers write sentence vectors)
 # TABLE_NAME: ide-rag
+# WRITE_MAX_RETRIES: 8
 
 import os, json, re, base64, boto3
-from typing import List, Set
+from typing import List
 from boto3.dynamodb.conditions import Key
 
-TABLE_NAME      = os.environ["TABLE_NAME"]
+from ide_indexing import (_BatchWriter, _OsBulk, OS_DUAL_WRITE, DELETE_WORKERS, SENT_VEC_TABLE, MANIFEST_DOC,
+                          SHARD_DOC, EXTRACTED_DOC, bump_corpus_version, iter_doc_keys, is_reserved_doc_id,
+                          doc_id_from_source)
+
 BUCKET          = os.environ["BUCKET"]
 EXTRACTED_PREF  = os.environ.get("EXTRACTED_PREFIX", "extracted/")
 DRY_RUN         = os.environ.get("DRY_RUN", "false").lower() == "true"
 
 ddb = boto3.resource("dynamodb")
-table = ddb.Table(TABLE_NAME)
+table = ddb.Table(os.environ["TABLE_NAME"])
 s3 = boto3.client("s3")
 
+
 # ---- helpers --------------------------------------------------------------
 
 def _respond(status, body):
@@ -51,38 +66,57 @@ def _parse_event(event):
         return json.loads(body or "{}")
     return event if isinstance(event, dict) else {}
 
-def doc_id_from_source(src_key: str) -> str:
-    import os
-    base = os.path.basename(src_key)      # e.g. "My Doc.pdf"
-    name, _ = os.path.splitext(base)      # "My Doc"
-    return re.sub(r"[^A-Za-z0-9._-]", "-", name)[:200] or "doc"
-
-def list_items_for_doc(doc_id: str):
-    items = []
-    resp = table.query(KeyConditionExpression=Key("docId").eq(doc_id))
-    items.extend(resp.get("Items", []))
-    while "LastEvaluatedKey" in resp:
-        resp = table.query(
-            KeyConditionExpression=Key("docId").eq(doc_id),
-            ExclusiveStartKey=resp["LastEvaluatedKey"]
-        )
-        items.extend(resp.get("Items", []))
-    return items
-
-def batch_delete_items(items: List[dict]) -> int:
-    if not items:
-        return 0
+def source_for_doc(doc_id: str):
+    """→ (found, source URI or None): the manifest row first, else any one chunk of the doc."""
+    row = table.get_item(Key={"docId": MANIFEST_DOC, "chunkId": doc_id},
+                         ProjectionExpression="#src", ExpressionAttributeNames={"#src": "source"}).get("Item")
+    if row and row.get("source"):
+        return True, row["source"]
+    items = table.query(KeyConditionExpression=Key("docId").eq(doc_id), Limit=1,
+                        ProjectionExpression="#src", ExpressionAttributeNames={"#src": "source"}).get("Items", [])
+    return bool(items), (items[0].get("source") if items else None)
+
+def delete_doc_items(doc_id: str):
+    """
+    Deletes every chunk of doc_id from DDB (and OpenSearch) page by page as the keys arrive.
+    → (ddb_deleted, os_deleted)
+    """
     if DRY_RUN:
-        print(f"[DRY] Would delete {len(items)} DDB items")
-        return 0
-    deleted = 0
-    with table.batch_writer() as bw:
-        for it in items:
-            bw.delete_item(Key={"docId": it["docId"], "chunkId": it["chunkId"]})
-            deleted += 1
-    return deleted
+        n = sum(len(keys) for keys in iter_doc_keys(doc_id))
+        print(f"[DRY] Would delete {n} DDB items" + (f" and {n} OpenSearch docs" if OS_DUAL_WRITE else ""))
+        return 0, 0
+    ddb_deleted = 0
+    with _BatchWriter(f"{doc_id} (delete)", workers=DELETE_WORKERS) as bw, \
+            _BatchWriter(f"{doc_id} (delete sentences)", workers=DELETE_WORKERS, table_name=SENT_VEC_TABLE) as sw, \
+            _OsBulk(OS_DUAL_WRITE) as osb:
+        for keys in iter_doc_keys(doc_id):
+            for key in keys:
+                bw.delete(key)
+                sw.delete(key)   # no-op without SENT_VEC_TABLE
+                osb.delete(key)   # sent every OS_BULK_SIZE keys, overlapping the DDB deletes in flight
+            ddb_deleted += len(keys)
+    return ddb_deleted, osb.deleted
+
+def delete_manifest(doc_id: str):
+    # Dropping the version row tells warm ide-query / ide-answer caches to evict the doc;
+    # bumping the corpus counter invalidates ide-answer's answer cache
+    if DRY_RUN:
+        print(f"[DRY] Would delete manifest row for docId={doc_id}")
+        return
+    table.delete_item(Key={"docId": MANIFEST_DOC, "chunkId": doc_id})
+    table.delete_item(Key={"docId": SHARD_DOC, "chunkId": doc_id})   # sharded-indexing tracker, if any
+    bump_corpus_version()   # cached /answer responses may cite the deleted chunks
 
 def list_extracted_keys_for_source(source_key: str) -> List[str]:
+    # One point lookup in the source → extracted-keys manifest; listing is the fallback for
+    # uploads extracted before the manifest existed (ide-extracted-reconcile backfills them)
+    row = table.get_item(Key={"docId": EXTRACTED_DOC, "chunkId": source_key}).get("Item")
+    if row and row.get("keys"):
+        return sorted(row["keys"])
+    print(f"[IDE] No extracted-key manifest row for {source_key}; listing {EXTRACTED_PREF}")
+    return _list_extracted_keys(source_key)
+
+def _list_extracted_keys(source_key: str) -> List[str]:
     """
     Match both:
       extracted/.../uploads/<name>.pdf.json
@@ -143,6 +177,8 @@ def lambda_handler(event, context):
 
     if not doc_id and not source:
         return _respond(400, {"error": "Provide {\"docId\":\"...\"} or {\"source\":\"s3://.../uploads/file.pdf\"}"})
+    if doc_id and is_reserved_doc_id(doc_id):
+        return _respond(400, {"error": f"docId={doc_id} is reserved"})
 
     # If source is given, normalize and derive docId to match your current scheme
     if source:
@@ -155,24 +191,24 @@ def lambda_handler(event, context):
         if not doc_id:
             doc_id = doc_id_from_source(src_key)
     else:
-        # No source given; try to resolve it from any item for the docId
-        items = list_items_for_doc(doc_id)
-        if not items:
+        # No source given; resolve it from the manifest row or any item for the docId
+        found, src = source_for_doc(doc_id)
+        if not found:
             return _respond(404, {"error": f"No items found for docId={doc_id}"})
-        # grab the first non-empty source
-        src = next((it.get("source") for it in items if it.get("source")), None)
         if not src:
             return _respond(404, {"error": f"Items for docId={doc_id} do not contain 'source'"})
         _, rest = src.split("s3://", 1)
         src_bucket, src_key = rest.split("/", 1)
 
     # 1) Delete DDB items for docId
-    ddb_items = list_items_for_doc(doc_id)
-    ddb_deleted = batch_delete_items(ddb_items)
+    ddb_deleted, os_deleted = delete_doc_items(doc_id)
+    delete_manifest(doc_id)
 
     # 2) Delete extracted JSON objects for this source (all dates/variants)
     extracted_keys = list_extracted_keys_for_source(src_key)
     s3_deleted = delete_s3_keys(extracted_keys)
+    if not DRY_RUN:
+        table.delete_item(Key={"docId": EXTRACTED_DOC, "chunkId": src_key})
 
     # 3) (Optional) delete the original uploads file
     uploads_deleted = 0
@@ -189,6 +225,7 @@ def lambda_handler(event, context):
     result = {
         "docId": doc_id,
         "ddbDeleted": ddb_deleted,
+        "osDeleted": os_deleted,
         "s3ExtractedDeleted": s3_deleted,
         "uploadsDeleted": uploads_deleted,
         "dryRun": DRY_RUN
@@ -11,93 +11,150 @@
 # Source account: <YOUR_ACCOUNT_ID>
 # Statement ID: lambda-e45558ec-e2bb-4acc-8ab5-fba6f67284c8
 #                     Suffix: .json
+#
+# SQS (shard worker, only with INDEX_QUEUE_URL): ide-index-shards
+# Batch size: 1
+# Report batch item failures: Yes
+# Visibility timeout: >= function timeout
+
+# Layers
+# zstandard (optional, only to read zstd-compressed extracted files)
+
+# Package with: ide_indexing.py, ide_sentences.py   (shared with ide-ingest / ide-delete-doc)
 
 # Environment variables
 # BEDROCK_MODEL_ID: amazon.titan-embed-text-v2:0
 # BEDROCK_REGION: eu-west-2
+# EMBED_CACHE_SIZE: 4096
+# EMBED_CACHE_TABLE: ide-embed-cache   (optional, partition key "k" String)
+# EMBED_MAX_RETRIES: 6
+# EMBED_MAX_WORKERS: 8
+# INDEX_QUEUE_URL: https://sqs.<YOUR_REGION>.amazonaws.com/<YOUR_ACCOUNT_ID>/ide-index-shards
+#                  (optional; unset = index inline, "local:" = in-process queue for local runs)
 # MAX_CHARS_PER_CHUNK: 800
+# OS_BULK_SIZE: 200
+# OS_DUAL_WRITE: false
 # OS_ENDPOINT: https://<YOUR_OPENSEARCH_ENDPOINT>.aoss.amazonaws.com
 # OS_INDEX: ide-rag
 # OS_NUM_CANDIDATES: 100
-# OS_SIGV4_SERVICE: aoss
-# SEARCH_BACKEND: DDB
+# OS_SIGV4_SERVICE: aoss   (Serverless: generated doc ids + _delete_by_query; "es" for a managed domain, "none" unsigned, e.g. a local OpenSearch)
+# SEARCH_BACKEND: DDB   (OPENSEARCH also writes every chunk to the k-NN index)
+# SENT_EMBED: false   (true also embeds every usable sentence for ide-answer's rerank; needs SENT_VEC_TABLE)
+# SENT_EMBED_MAX: 48   (chunks with more usable sentences get no sentence vectors)
+# SENT_VEC_TABLE: ide-rag-sentvecs   (optional sentence-vector store, partition key "docId", sort key "chunkId")
+# SHARD_PAGES: 50   (documents with more pages are split into page-range shards)
 # TABLE_NAME: ide-rag
-
-import os, json, re, math, boto3, urllib.parse
-from decimal import Decimal
-
-import json, os, urllib3
-from botocore.awsrequest import AWSRequest
-from botocore.auth import SigV4Auth
-from botocore.session import Session
-
-_http = urllib3.PoolManager()
-_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "eu-west-2"))
-_os_endpoint = os.environ["OS_ENDPOINT"].rstrip("/")
-_os_index = os.environ.get("OS_INDEX","ide-rag")
-_sigv4_service = os.environ.get("OS_SIGV4_SERVICE","aoss")
-_creds = Session().get_credentials().get_frozen_credentials()
-
-def _es(method: str, path: str, body=None, params: str=""):
-    url = f"{_os_endpoint}{path}{('?' + params) if params else ''}"
-    data = json.dumps(body).encode("utf-8") if isinstance(body, dict) else (body or None)
-    headers = {"host": _os_endpoint.replace("https://","").replace("http://",""),
-               "content-type": "application/json"}
-    req = AWSRequest(method=method, url=url, data=data, headers=headers)
-    SigV4Auth(_creds, _sigv4_service, _region).add_auth(req)
-    r = _http.request(method, url, body=data, headers=dict(req.headers))
-    if r.status >= 300:
-        raise RuntimeError(f"OS {method} {path} -> {r.status} {r.data[:400]!r}")
-    if r.data and r.headers.get("content-type","").startswith("application/json"):
-        return json.loads(r.data.decode("utf-8"))
-    return None
-
-
-s3 = boto3.client("s3")
-ddb = boto3.resource("dynamodb")
-bedrock = boto3.client("bedrock-runtime", region_name=os.environ["BEDROCK_REGION"])
-
-TABLE_NAME = os.environ["TABLE_NAME"]
-MODEL_ID   = os.environ.get("BEDROCK_MODEL_ID", "amazon.titan-embed-text-v2:0")
-MAX_CHARS  = int(os.environ.get("MAX_CHARS_PER_CHUNK","800"))
-
-table = ddb.Table(TABLE_NAME)
-
-def embed_text(text: str):
-    body = json.dumps({"inputText": text})
-    resp = bedrock.invoke_model(
-        modelId=MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=body
-    )
-    payload = json.loads(resp["body"].read())
-    vec = payload.get("embedding") or payload.get("embeddings") or []
-    # Convert floats → Decimals for DynamoDB
-    return [Decimal(str(x)) for x in vec]
-
-def chunk_lines(lines, max_chars=800):
-    buf, size = [], 0
-    for ln in lines:
-        ln = (ln or "").strip()
-        if not ln:
-            continue
-        if size + len(ln) + 1 > max_chars and buf:
-            yield " ".join(buf)
-            buf, size = [ln], len(ln)
-        else:
-            buf.append(ln)
-            size += len(ln) + 1
-    if buf:
-        yield " ".join(buf)
-
-def doc_id_from_source(src_key: str):
-    base = os.path.basename(src_key)          # e.g. "Coffee Machine Program Requirements.pdf"
-    name, _ = os.path.splitext(base)          # "Coffee Machine Program Requirements"
-    return re.sub(r'[^A-Za-z0-9._-]', '-', name)[:200] or "doc"
+# VEC_FORMAT: decimal
+# WRITE_MAX_RETRIES: 8
+
+import os, json, time, boto3, botocore, urllib.parse
+from collections import deque
+
+from ide_indexing import table, SHARD_DOC, read_extracted, index_pages, put_manifest, doc_id_from_source
+
+INDEX_QUEUE_URL = os.environ.get("INDEX_QUEUE_URL", "")
+SHARD_PAGES     = max(1, int(os.environ.get("SHARD_PAGES", "50")))
+
+sqs = boto3.client("sqs") if INDEX_QUEUE_URL and not INDEX_QUEUE_URL.startswith("local:") else None
+
+# ---------- Sharded fan-out (INDEX_QUEUE_URL) ----------
+# Documents with more than SHARD_PAGES pages are split into page-range shards, one SQS message
+# each; this same function consumes the queue. A tracker row (docId=SHARD_DOC, chunkId=<docId>)
+# holds the run id, the string set of pending shard ids and per-shard stats. A worker records
+# its stats and removes its shard id in one conditional UpdateItem; whoever empties the set
+# writes the manifest. Re-running a shard is a no-op diff, and shards of a superseded run
+# (the document was re-extracted meanwhile) fail the run condition and are dropped.
+_LOCAL_QUEUE = deque()   # INDEX_QUEUE_URL="local:" stand-in, drained in-process
+
+def plan_shards(page_count: int):
+    """[(shardId, first_page, last_page), ...]; the first and last shards are open-ended."""
+    shards = [[f"{i:04d}", start, start + SHARD_PAGES - 1]
+              for i, start in enumerate(range(1, max(page_count, 1) + 1, SHARD_PAGES))]
+    shards[0][1], shards[-1][2] = None, None
+    return [tuple(s) for s in shards]
+
+def _send_shards(messages):
+    if INDEX_QUEUE_URL.startswith("local:"):
+        _LOCAL_QUEUE.extend(json.dumps(m) for m in messages)
+        return
+    for i in range(0, len(messages), 10):
+        entries = [{"Id": str(j), "MessageBody": json.dumps(m)} for j, m in enumerate(messages[i:i + 10])]
+        resp = sqs.send_message_batch(QueueUrl=INDEX_QUEUE_URL, Entries=entries)
+        if resp.get("Failed"):
+            raise RuntimeError(f"SQS send_message_batch failed: {resp['Failed']}")
+
+def enqueue_shards(bucket, key, doc_id, source_uri, page_count):
+    shards = plan_shards(page_count)
+    run = str(time.time_ns() // 1_000_000)
+    table.put_item(Item={
+        "docId":   SHARD_DOC,
+        "chunkId": doc_id,
+        "run":     run,
+        "pending": {s for s, _, _ in shards},
+        "total":   len(shards),
+        "stats":   {},
+        "source":  source_uri,
+        "key":     key,
+    })
+    _send_shards([{"bucket": bucket, "key": key, "docId": doc_id, "source": source_uri,
+                   "run": run, "shard": s, "first": first, "last": last} for s, first, last in shards])
+    print(f"[IDE] docId={doc_id} pages={page_count} → {len(shards)} shards of {SHARD_PAGES} pages (run={run})")
+    return len(shards)
+
+def index_shard(msg):
+    doc_id = msg["docId"]
+    _, pages = read_extracted(msg["bucket"], msg["key"])
+    stats = index_pages(pages, doc_id, msg["source"], (msg.get("first"), msg.get("last")))
+    try:
+        done = table.update_item(
+            Key={"docId": SHARD_DOC, "chunkId": doc_id},
+            UpdateExpression="SET #stats.#shard = :stats DELETE #pending :shard",
+            ConditionExpression="#run = :run",
+            ExpressionAttributeNames={"#stats": "stats", "#shard": msg["shard"], "#pending": "pending", "#run": "run"},
+            ExpressionAttributeValues={":stats": stats, ":shard": {msg["shard"]}, ":run": msg["run"]},
+            ReturnValues="ALL_NEW",
+        )["Attributes"]
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        print(f"[IDE] docId={doc_id} shard={msg['shard']} belongs to a superseded run; dropped")
+        return stats
+    if not done.get("pending"):   # DynamoDB removes a string set once it is empty
+        totals = {k: sum(int(st.get(k, 0)) for st in done["stats"].values()) for k in ("indexed", "kept", "deleted")}
+        if totals["indexed"] or totals["deleted"]:
+            put_manifest(doc_id, totals["indexed"] + totals["kept"], msg["source"])
+        print(f"[IDE] docId={doc_id} all {done.get('total')} shards done: {totals}")
+    return stats
+
+def handle_shard_batch(records):
+    failures = []
+    for rec in records:
+        t0 = time.time()
+        try:
+            msg = json.loads(rec["body"])
+            index_shard(msg)
+            print(f"[IDE] shard {msg['docId']}/{msg['shard']} done in {time.time() - t0:.1f}s")
+        except Exception as e:
+            print(f"[IDE] shard message {rec.get('messageId')} failed: {e!r}")
+            failures.append({"itemIdentifier": rec["messageId"]})
+    return {"batchItemFailures": failures}
+
+def drain_local_queue(max_attempts=3):
+    """Runs queued shards in-process (INDEX_QUEUE_URL="local:"); failed shards are retried like redeliveries."""
+    attempts = {}
+    while _LOCAL_QUEUE:
+        body = _LOCAL_QUEUE.popleft()
+        attempts[body] = attempts.get(body, 0) + 1
+        failed = handle_shard_batch([{"messageId": f"local-{len(attempts)}", "body": body}])["batchItemFailures"]
+        if failed and attempts[body] < max_attempts:
+            _LOCAL_QUEUE.append(body)
 
 def lambda_handler(event, context):
-    for rec in event.get("Records", []):
+    records = event.get("Records", [])
+    if records and records[0].get("eventSource") == "aws:sqs":
+        return handle_shard_batch(records)
+
+    for rec in records:
         s3info = rec.get("s3", {})
         bucket = s3info.get("bucket", {}).get("name")
         key    = urllib.parse.unquote_plus(s3info.get("object", {}).get("key", ""))
@@ -107,35 +164,24 @@ def lambda_handler(event, context):
             continue
 
         print(f"[IDE] Processing extracted JSON s3://{bucket}/{key}")
-        j = s3.get_object(Bucket=bucket, Key=key)
-        doc = json.loads(j["Body"].read())
+        header, pages = read_extracted(bucket, key)   # pages stream in while chunks are embedded
 
         # Prefer source_* fields written by the callback; fallback to the key if missing
-        source_bucket = doc.get("source_bucket", bucket)
-        source_key    = doc.get("source_key", key)
+        source_bucket = header.get("source_bucket", bucket)
+        source_key    = header.get("source_key", key)
         # NEW: stable, suffixless docId from the original upload filename
         doc_id        = doc_id_from_source(source_key)
 
-        pages = doc.get("pages", [])
-        chunk_index = 0
-        puts = 0
-
-        for page_obj in pages:
-            page_no = int(page_obj.get("page", 0))
-            lines   = page_obj.get("lines", [])
-            for chunk in chunk_lines(lines, MAX_CHARS):
-                emb = embed_text(chunk)
-                item = {
-                    "docId":  doc_id,
-                    "chunkId": f"{page_no:04d}#{chunk_index:06d}",
-                    "text":   chunk,
-                    "page":   page_no,
-                    "source": f"s3://{source_bucket}/{source_key}",
-                    "vec":    emb
-                }
-                table.put_item(Item=item)
-                chunk_index += 1
-                puts += 1
-
-        print(f"[IDE] Indexed {puts} chunks for docId={doc_id}")
+        source_uri = f"s3://{source_bucket}/{source_key}"
+        page_count = int(header.get("page_count") or 0)   # known for ide-pages/1 files only
+        if INDEX_QUEUE_URL and page_count > SHARD_PAGES:
+            enqueue_shards(bucket, key, doc_id, source_uri, page_count)
+            continue
+        stats = index_pages(pages, doc_id, source_uri)
+
+        if stats["indexed"] or stats["deleted"]:
+            put_manifest(doc_id, stats["indexed"] + stats["kept"], source_uri)
+        print(f"[IDE] Indexed {stats['indexed'] + stats['kept']} chunks for docId={doc_id}")
+    if INDEX_QUEUE_URL.startswith("local:"):
+        drain_local_queue()
     return {"ok": True}
@@ -0,0 +1,142 @@
+# Lambda Trigger
+# EventBridge Scheduler: ide-extracted-reconcile-weekly
+# Schedule: rate(7 days)   (or invoke manually once to backfill existing extracted/ objects)
+# Details
+# Memory: 512 MB
+# Timeout: 15 min
+# Also runnable offline: python ide-extracted-reconcile.py
+
+# Environment variables
+# BUCKET: ide-bd-eu-west-2
+# DRY_RUN: false
+# EXTRACTED_PREFIX: extracted/
+# TABLE_NAME: ide-rag
+
+# Rebuilds the source → extracted-keys manifest from a full listing of EXTRACTED_PREFIX.
+# ide-textract-callback maintains these rows as it writes output; this job backfills uploads
+# extracted before the manifest existed and repairs drift (objects deleted or copied by hand):
+#   docId="__extracted__", chunkId=<source key, e.g. uploads/My Doc.pdf>
+#   keys:     string set of every extracted object for that upload
+#   latest:   newest of them (LastModified), read by ide-ingest
+#   latestAt: its LastModified in ms
+# Rows whose source no longer has any extracted object are deleted.
+# Every write is a conditional UpdateItem merged into the live row, never a blind put: keys the
+# callback adds while the listing runs survive, and "latest" only moves to a newer object
+# (or off an object that was deleted by hand).
+
+import os, re, json, time, boto3, botocore
+from boto3.dynamodb.conditions import Key
+
+TABLE_NAME     = os.environ["TABLE_NAME"]
+BUCKET         = os.environ["BUCKET"]
+EXTRACTED_PREF = os.environ.get("EXTRACTED_PREFIX", "extracted/")
+DRY_RUN        = os.environ.get("DRY_RUN", "false").lower() == "true"
+EXTRACTED_DOC  = "__extracted__"
+
+s3 = boto3.client("s3")
+ddb = boto3.resource("dynamodb")
+table = ddb.Table(TABLE_NAME)
+
+# extracted/YYYY/MM/DD/<source key>.json, with "-<first 8 chars of the Textract JobId>" before ".pdf"
+_DATED = re.compile(r"^\d{4}/\d{2}/\d{2}/(.+)\.json$")
+_SHORT = re.compile(r"-[0-9a-fA-F]{8}(\.pdf)$", re.IGNORECASE)
+
+def source_key_for(extracted_key: str):
+    m = _DATED.match(extracted_key[len(EXTRACTED_PREF):])
+    return _SHORT.sub(r"\1", m.group(1)) if m else None
+
+def list_extracted():
+    """{source key: [(LastModified, extracted key), ...]} for every object under EXTRACTED_PREF."""
+    by_source, skipped = {}, 0
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=EXTRACTED_PREF):
+        for obj in page.get("Contents", []):
+            src = source_key_for(obj["Key"])
+            if src is None:
+                skipped += 1
+                continue
+            by_source.setdefault(src, []).append((obj["LastModified"], obj["Key"]))
+    if skipped:
+        print(f"[IDE] reconcile: {skipped} objects under {EXTRACTED_PREF} do not look like extracted output")
+    return by_source
+
+def existing_rows():
+    """{source key: row} of the current manifest; read before the listing, so a key that is in a
+    row but not in the listing was deleted (the callback writes the object before the row)."""
+    kwargs = {"KeyConditionExpression": Key("docId").eq(EXTRACTED_DOC),
+              "ProjectionExpression": "chunkId, #keys, #latest, #at",
+              "ExpressionAttributeNames": {"#keys": "keys", "#latest": "latest", "#at": "latestAt"}}
+    resp = table.query(**kwargs)
+    rows = {it["chunkId"]: it for it in resp.get("Items", [])}
+    while "LastEvaluatedKey" in resp:
+        resp = table.query(ExclusiveStartKey=resp["LastEvaluatedKey"], **kwargs)
+        rows.update((it["chunkId"], it) for it in resp.get("Items", []))
+    return rows
+
+def _update(src, expr, names, values, cond=None):
+    """UpdateItem on the manifest row; False when the condition no longer holds."""
+    kwargs = {"ConditionExpression": cond} if cond else {}
+    try:
+        table.update_item(Key={"docId": EXTRACTED_DOC, "chunkId": src}, UpdateExpression=expr,
+                          ExpressionAttributeNames=names, ExpressionAttributeValues=values, **kwargs)
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        return False
+
+def merge_row(src, objs, row):
+    """Merges the listed objects of one source into its row; → number of UpdateItem calls."""
+    last_modified, latest = max(objs)
+    at = int(last_modified.timestamp() * 1000)
+    listed = {k for _, k in objs}
+    names, values = {"#keys": "keys", "#bucket": "bucket"}, {":k": listed, ":b": BUCKET}
+    calls = 1
+    if not _update(src, "ADD #keys :k SET #bucket = :b, #latest = :key, #at = :at",
+                   {**names, "#latest": "latest", "#at": "latestAt"}, {**values, ":key": latest, ":at": at},
+                   "attribute_not_exists(#at) OR #at < :at"):
+        _update(src, "ADD #keys :k SET #bucket = :b", names, values)   # a newer object is already latest
+        calls += 1
+    gone = set((row or {}).get("keys") or ()) - listed
+    if gone:
+        _update(src, "DELETE #keys :gone", {"#keys": "keys"}, {":gone": gone})
+        calls += 1
+        if row.get("latest") in gone:   # latest was deleted by hand: fall back to the newest listed object
+            _update(src, "SET #latest = :key, #at = :at", {"#latest": "latest", "#at": "latestAt"},
+                    {":key": latest, ":at": at, ":old": row["latest"]}, "#latest = :old")
+            calls += 1
+    return calls
+
+def delete_stale(src, row):
+    # skipped when the callback recorded a new extraction for the source since the rows were read
+    kwargs = ({"ConditionExpression": "#at = :at", "ExpressionAttributeNames": {"#at": "latestAt"},
+               "ExpressionAttributeValues": {":at": row["latestAt"]}} if "latestAt" in row else
+              {"ConditionExpression": "attribute_not_exists(#at)", "ExpressionAttributeNames": {"#at": "latestAt"}})
+    try:
+        table.delete_item(Key={"docId": EXTRACTED_DOC, "chunkId": src}, **kwargs)
+        return 1
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        return 0
+
+def lambda_handler(event, context):
+    t0 = time.time()
+    rows = existing_rows()
+    by_source = list_extracted()
+    stale = rows.keys() - by_source.keys()
+    updates = deleted = 0
+    if DRY_RUN:
+        print(f"[DRY] Would merge {len(by_source)} manifest rows and delete {len(stale)}")
+    else:
+        for src, objs in by_source.items():
+            updates += merge_row(src, objs, rows.get(src))
+        for src in stale:
+            deleted += delete_stale(src, rows[src])
+    result = {"sources": len(by_source), "objects": sum(len(v) for v in by_source.values()),
+              "updates": updates, "staleDeleted": deleted, "dryRun": DRY_RUN,
+              "seconds": round(time.time() - t0, 1)}
+    print("[IDE] extracted-key reconcile:", result)
+    return result
+
+if __name__ == "__main__":
+    print(json.dumps(lambda_handler({}, None), indent=2))
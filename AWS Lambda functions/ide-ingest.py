@@ -14,62 +14,57 @@
 # Stage: $default
 # Statement ID: 0df1e0d7-3287-53f7-9a97-66a9cfce3a2a
 
+# Layers
+# zstandard (optional, only to read zstd-compressed extracted files)
+
+# Package with: ide_indexing.py, ide_sentences.py   (shared with ide-embed-index / ide-delete-doc)
+
 # Environment variables
 # BEDROCK_MODEL_ID: amazon.titan-embed-text-v2:0
 # BEDROCK_REGION: eu-west-2
+# DELETE_WORKERS: 4   (parallel BatchWriteItem senders for full re-index purges)
+# EMBED_CACHE_SIZE: 4096
+# EMBED_CACHE_TABLE: ide-embed-cache   (optional, partition key "k" String)
+# EMBED_MAX_RETRIES: 6
+# EMBED_MAX_WORKERS: 8
 # MAX_CHARS_PER_CHUNK: 800
+# OS_BULK_SIZE: 200
+# OS_DUAL_WRITE: false
+# OS_ENDPOINT: https://<YOUR_OPENSEARCH_ENDPOINT>.aoss.amazonaws.com
+# OS_INDEX: ide-rag
+# OS_SIGV4_SERVICE: aoss   (Serverless: generated doc ids + _delete_by_query; "es" for a managed domain, "none" unsigned, e.g. a local OpenSearch)
+# SEARCH_BACKEND: DDB
+# SENT_EMBED: false   (true also embeds every usable sentence for ide-answer's rerank; needs SENT_VEC_TABLE)
+# SENT_EMBED_MAX: 48   (chunks with more usable sentences get no sentence vectors)
+# SENT_VEC_TABLE: ide-rag-sentvecs   (optional sentence-vector store, partition key "docId", sort key "chunkId")
 # TABLE_NAME: ide-rag
+# VEC_FORMAT: decimal
+# WRITE_MAX_RETRIES: 8
 
 
-import os, json, re, base64, boto3, urllib.parse
-from decimal import Decimal
+import os, json, re, base64, boto3
 from boto3.dynamodb.conditions import Key
 
-s3   = boto3.client("s3")
-ddb  = boto3.resource("dynamodb")
-bedr = boto3.client("bedrock-runtime", region_name=os.environ["BEDROCK_REGION"])
-
-TABLE_NAME = os.environ["TABLE_NAME"]
-MODEL_ID   = os.environ.get("BEDROCK_MODEL_ID","amazon.titan-embed-text-v2:0")
-MAX_CHARS  = int(os.environ.get("MAX_CHARS_PER_CHUNK","800"))
+from ide_indexing import (_BatchWriter, _OsBulk, OS_DUAL_WRITE, DELETE_WORKERS, SENT_VEC_TABLE, EXTRACTED_DOC,
+                          read_extracted, index_pages, put_manifest, iter_doc_keys, is_reserved_doc_id,
+                          doc_id_from_source)
 
-table  = ddb.Table(TABLE_NAME)
+ddb = boto3.resource("dynamodb")
+table = ddb.Table(os.environ["TABLE_NAME"])
+s3 = boto3.client("s3")
 BUCKET = "<YOUR_BUCKET_NAME>"  # change to your bucket name
 
-def embed_text(text: str):
-    body = json.dumps({"inputText": text})
-    resp = bedr.invoke_model(
-        modelId=MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=body
-    )
-    payload = json.loads(resp["body"].read())
-    vec = payload.get("embedding") or payload.get("embeddings") or []
-    return [Decimal(str(x)) for x in vec]
-
-def chunk_lines(lines, max_chars=800):
-    buf, size = [], 0
-    for ln in lines:
-        ln = (ln or "").strip()
-        if not ln:
-            continue
-        if size + len(ln) + 1 > max_chars and buf:
-            yield " ".join(buf)
-            buf, size = [ln], len(ln)
-        else:
-            buf.append(ln)
-            size += len(ln) + 1
-    if buf:
-        yield " ".join(buf)
-
-def make_doc_id_from_source(source_key: str):
-    base = os.path.basename(source_key)
-    name, _ = os.path.splitext(base)
-    name = re.sub(r"[^A-Za-z0-9._-]", "-", name)[:200]
-    return name or "doc"
-
 def find_latest_extracted_key_for_source(source_key: str):
+    # One point lookup in the source → extracted-keys manifest; listing is the fallback for
+    # uploads extracted before the manifest existed (ide-extracted-reconcile backfills them)
+    row = table.get_item(Key={"docId": EXTRACTED_DOC, "chunkId": source_key}).get("Item")
+    if row and row.get("latest"):
+        print(f"[IDE] Manifest extracted key: s3://{BUCKET}/{row['latest']}")
+        return row["latest"]
+    print(f"[IDE] No extracted-key manifest row for {source_key}; listing extracted/")
+    return _list_latest_extracted_key(source_key)
+
+def _list_latest_extracted_key(source_key: str):
     """
     Match both:
       extracted/.../uploads/<name>.pdf.json
@@ -101,47 +96,22 @@ def find_latest_extracted_key_for_source(source_key: str):
     return latest["Key"]
 
 def delete_doc_items(doc_id: str):
-    # query all items for docId and delete in batch
-    resp = table.query(KeyConditionExpression=Key("docId").eq(doc_id))
-    items = resp.get("Items", [])
-    while "LastEvaluatedKey" in resp:
-        resp = table.query(
-            KeyConditionExpression=Key("docId").eq(doc_id),
-            ExclusiveStartKey=resp["LastEvaluatedKey"]
-        )
-        items += resp.get("Items", [])
-    if not items:
-        return 0
+    # stream key pages into the concurrent deleter as they arrive
     count = 0
-    with table.batch_writer() as bw:
-        for it in items:
-            bw.delete_item(Key={"docId": it["docId"], "chunkId": it["chunkId"]})
-            count += 1
+    with _BatchWriter(f"{doc_id} (delete)", workers=DELETE_WORKERS) as bw, \
+            _BatchWriter(f"{doc_id} (delete sentences)", workers=DELETE_WORKERS, table_name=SENT_VEC_TABLE) as sw, \
+            _OsBulk(OS_DUAL_WRITE) as osb:
+        for keys in iter_doc_keys(doc_id):
+            for key in keys:
+                bw.delete(key)
+                sw.delete(key)   # no-op without SENT_VEC_TABLE
+                osb.delete(key)
+            count += len(keys)
     return count
 
 def index_from_extracted(bucket, extracted_key, source_bucket, source_key, doc_id):
-    obj = s3.get_object(Bucket=bucket, Key=extracted_key)
-    data = json.loads(obj["Body"].read())
-    pages = data.get("pages", [])
-    puts = 0
-    chunk_index = 0
-    for p in pages:
-        page_no = int(p.get("page", 0))
-        lines   = p.get("lines", [])
-        for chunk in chunk_lines(lines, MAX_CHARS):
-            emb = embed_text(chunk)
-            item = {
-                "docId":   doc_id,
-                "chunkId": f"{page_no:04d}#{chunk_index:06d}",
-                "text":    chunk,
-                "page":    page_no,
-                "source":  f"s3://{source_bucket}/{source_key}",
-                "vec":     emb
-            }
-            table.put_item(Item=item)
-            puts += 1
-            chunk_index += 1
-    return puts
+    _, pages = read_extracted(bucket, extracted_key)
+    return index_pages(pages, doc_id, f"s3://{source_bucket}/{source_key}")
 
 def _parse_body(event):
     if "requestContext" in event and "http" in event["requestContext"]:
@@ -165,6 +135,8 @@ def lambda_handler(event, context):
 
     if not source and not doc_id:
         return _response(400, {"error":"Provide {\"source\":\"s3://...\"} or {\"docId\":\"...\"}"})
+    if doc_id and is_reserved_doc_id(doc_id):
+        return _response(400, {"error": f"docId={doc_id} is reserved"})
 
     # If only docId given, resolve source from any existing item
     if doc_id and not source:
@@ -181,15 +153,19 @@ def lambda_handler(event, context):
     src_bucket, src_key = rest.split("/", 1)
 
     if not doc_id:
-        doc_id = make_doc_id_from_source(src_key)
+        doc_id = doc_id_from_source(src_key)
 
     extracted_key = find_latest_extracted_key_for_source(src_key)  # date-partition aware
-    deleted = delete_doc_items(doc_id)
-    indexed = index_from_extracted(BUCKET, extracted_key, src_bucket, src_key, doc_id)
+    # Reindex is a diff (unchanged chunks are kept); {"full": true} forces delete + re-embed
+    purged = delete_doc_items(doc_id) if data.get("full") else 0
+    stats = index_from_extracted(BUCKET, extracted_key, src_bucket, src_key, doc_id)
+    if purged or stats["indexed"] or stats["deleted"]:
+        put_manifest(doc_id, stats["indexed"] + stats["kept"], f"s3://{src_bucket}/{src_key}")
 
     return _response(200, {
         "docId": doc_id,
-        "deleted": deleted,
-        "indexed": indexed,
+        "deleted": purged + stats["deleted"],
+        "indexed": stats["indexed"],
+        "kept": stats["kept"],
         "extracted_json": f"s3://{BUCKET}/{extracted_key}"
     })
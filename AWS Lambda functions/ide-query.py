@@ -14,71 +14,38 @@
 # Stage: $default
 # Statement ID: c0ad3a5a-709f-5630-9d36-6ce453d56985
 
+# Layers
+# numpy (e.g. AWSSDKPandas-Python311, or a custom numpy layer)
+# faiss-cpu (only for SEARCH_BACKEND=ANN)
+
+# Package with: ide_retrieval.py   (retrieval stack shared with ide-answer)
+
 # Environment variables
+# ANN_BUCKET: ide-bd-eu-west-2   (SEARCH_BACKEND=ANN)
+# ANN_CHECK_SECONDS: 300
+# ANN_EF_SEARCH: 64
+# ANN_NPROBE: 16
+# ANN_PREFIX: ann/
 # BEDROCK_MODEL_ID: amazon.titan-embed-text-v2:0
 # BEDROCK_REGION: eu-west-2
+# CORPUS_REFRESH_SECONDS: 30
+# EMBED_DIM: 1024   (must match the indexers' model; rows of another size are not searched)
+# EMBED_CACHE_TABLE: ide-embed-cache   (optional, shared query-embedding tier)
+# INDEX_TTL_SECONDS: 3600
 # OS_ENDPOINT: https://<YOUR_OPENSEARCH_ENDPOINT>.aoss.amazonaws.com
 # OS_INDEX: ide-rag
 # OS_NUM_CANDIDATES: 100
-# OS_SIGV4_SERVICE: aoss
-# SEARCH_BACKEND: DDB
+# OS_SIGV4_SERVICE: aoss   ("none" disables SigV4, e.g. for a local OpenSearch)
+# QUERY_CACHE_SIZE: 512
+# QUERY_CACHE_TTL_SECONDS: 3600
+# SCAN_SEGMENTS: 8   (max parallel scan segments for a full corpus load)
+# SEARCH_BACKEND: DDB   (DDB|MEMORY = in-memory index, DDB_SCAN = per-request scan, OPENSEARCH = k-NN, ANN = faiss snapshot)
 # TABLE_NAME: ide-rag
 
 
-import os, json, math, boto3, base64
+import json, base64
 from decimal import Decimal
-import urllib3
-from botocore.awsrequest import AWSRequest
-from botocore.auth import SigV4Auth
-from botocore.session import Session
-
-_http = urllib3.PoolManager()
-_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "eu-west-2"))
-_os_endpoint = os.environ["OS_ENDPOINT"].rstrip("/")
-_os_index = os.environ.get("OS_INDEX","ide-rag")
-_sigv4_service = os.environ.get("OS_SIGV4_SERVICE","aoss")
-_creds = Session().get_credentials().get_frozen_credentials()
-
-def _es(method: str, path: str, body=None, params: str=""):
-    url = f"{_os_endpoint}{path}{('?' + params) if params else ''}"
-    data = json.dumps(body).encode("utf-8") if isinstance(body, dict) else (body or None)
-    headers = {"host": _os_endpoint.replace("https://","").replace("http://",""),
-               "content-type": "application/json"}
-    req = AWSRequest(method=method, url=url, data=data, headers=headers)
-    SigV4Auth(_creds, _sigv4_service, _region).add_auth(req)
-    r = _http.request(method, url, body=data, headers=dict(req.headers))
-    if r.status >= 300:
-        raise RuntimeError(f"OS {method} {path} -> {r.status} {r.data[:400]!r}")
-    if r.data and r.headers.get("content-type","").startswith("application/json"):
-        return json.loads(r.data.decode("utf-8"))
-    return None
-
-ddb = boto3.resource("dynamodb")
-table = ddb.Table(os.environ["TABLE_NAME"])
-bedrock = boto3.client("bedrock-runtime", region_name=os.environ["BEDROCK_REGION"])
-MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "amazon.titan-embed-text-v2:0")
-
-def embed(q):
-    body = json.dumps({"inputText": q})
-    resp = bedrock.invoke_model(
-        modelId=MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=body
-    )
-    payload = json.loads(resp["body"].read())
-    return payload.get("embedding") or payload.get("embeddings") or []
-
-def cosine(a, b):
-    if not a or not b or len(a) != len(b):
-        return -1.0
-    num = sum(x*y for x,y in zip(a,b))
-    da  = math.sqrt(sum(x*x for x in a))
-    db  = math.sqrt(sum(y*y for y in b))
-    return (num/(da*db)) if da and db else -1.0
-
-def to_float_list(vec):
-    return [float(v) for v in vec]
+from ide_retrieval import embed_query, parse_filters, retrieve
 
 # NEW: serializer for Decimal
 def _json_default(o):
@@ -86,34 +53,23 @@ def _json_default(o):
         return float(o)
     raise TypeError
 
-def _search(query, top_k=5):
-    qv = embed(query)
-    items = []
-    resp = table.scan()
-    items.extend(resp.get("Items", []))
-    while "LastEvaluatedKey" in resp:
-        resp = table.scan(ExclusiveStartKey=resp["LastEvaluatedKey"])
-        items.extend(resp.get("Items", []))
+def _search(query, top_k=5, filters=None):
+    qv = embed_query(query)
+    hits = retrieve(qv, top_k, filters)
+    for h in hits:
+        h["text"] = h["text"][:500]   # /search returns snippets
+    return hits
 
-    scored = []
-    for it in items:
-        vec = it.get("vec")
-        if not vec:
-            continue
-        score = float(cosine(qv, to_float_list(vec)))  # ensure plain float
-        # page may be Decimal from DynamoDB → cast to int when present
-        page_val = it.get("page")
-        page_int = int(page_val) if isinstance(page_val, (int, float, Decimal)) else None
-
-        scored.append({
-            "score": score,
-            "docId": it["docId"],
-            "chunkId": it["chunkId"],
-            "page": page_int,
-            "text": it.get("text","")[:500],
-            "source": it.get("source")
-        })
-    return sorted(scored, key=lambda x: x["score"], reverse=True)[:top_k]
+def _parse_args(data):
+    """top_k + filters of an HTTP body or console event → ((top_k, filters), None) or (None, error)."""
+    try:
+        top_k = int(data.get("top_k", 5))
+    except (TypeError, ValueError):
+        return None, "top_k must be an integer"
+    try:
+        return (top_k, parse_filters(data)), None
+    except (TypeError, ValueError) as e:
+        return None, f"Invalid filters: {e}"
 
 def lambda_handler(event, context):
     # HTTP API (payload v2.0)
@@ -134,8 +90,18 @@ def lambda_handler(event, context):
                     },
                     "body": json.dumps(resp)
                 }
-            top_k = int(data.get("top_k", 5))
-            result = _search(query, top_k=top_k)
+            args, error = _parse_args(data)
+            if error:
+                return {
+                    "statusCode": 400,
+                    "headers": {
+                        "content-type":"application/json",
+                        "access-control-allow-origin":"*"
+                    },
+                    "body": json.dumps({"error": error})
+                }
+            top_k, filters = args
+            result = _search(query, top_k=top_k, filters=filters)
             return {
                 "statusCode": 200,
                 "headers": {
@@ -159,5 +125,8 @@ def lambda_handler(event, context):
     query = (event.get("query") or "").strip() if isinstance(event, dict) else ""
     if not query:
         return {"error": "Provide {\"query\":\"...\"} in the event."}
-    top_k = int(event.get("top_k", 5))
-    return {"top_k": _search(query, top_k=top_k)}
+    args, error = _parse_args(event)
+    if error:
+        return {"error": error}
+    top_k, filters = args
+    return {"top_k": _search(query, top_k=top_k, filters=filters)}
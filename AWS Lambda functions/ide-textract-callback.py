@@ -4,26 +4,42 @@
 # state: Enabled
 # Details
 # Activate trigger: Yes
-# Batch size: 1
-# Batch window: None
+# Batch size: 10
+# Batch window: 5 seconds
 # Event source mapping ARN: arn:aws:lambda:<YOUR_REGION>:<YOUR_ACCOUNT_ID>:event-source-mapping:<YOUR_MAPPING_ID>
 # Metrics: None
 # On-failure destination: None
-# Report batch item failures: No
+# Report batch item failures: Yes
 # Tags: View
 
+# Layers
+# zstandard (only for OUTPUT_COMPRESSION=zstd)
+
 # Environment variables
+# CALLBACK_WORKERS: 4   (records of a batch processed concurrently)
 # OUTPUT_BUCKET: ide-bd-eu-west-2
+# OUTPUT_COMPRESSION: none   (none | gzip | zstd; also set as the object's Content-Encoding, readers detect it from the magic bytes)
+# OUTPUT_PART_MB: 8   (S3 multipart part size for the extracted JSON; min 5)
 # OUTPUT_PREFIX: extracted/
+# TABLE_NAME: ide-rag   (source → extracted-keys manifest rows; optional)
 
-import os, json, boto3, urllib.parse, botocore, re
+import os, json, zlib, itertools, time, boto3, urllib.parse, botocore, re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 s3 = boto3.client("s3")
 textract = boto3.client("textract")
+ddb = boto3.resource("dynamodb")
 
 OUT_BUCKET = os.environ["OUTPUT_BUCKET"]
 OUT_PREFIX = os.environ.get("OUTPUT_PREFIX","extracted/")
+PART_BYTES = max(5, int(os.environ.get("OUTPUT_PART_MB", "8"))) * 1024 * 1024
+COMPRESSION = os.environ.get("OUTPUT_COMPRESSION", "none").lower()
+CONTENT_ENCODING = {"gzip": "gzip", "zstd": "zstd"}.get(COMPRESSION)   # S3 Content-Encoding; none → unset
+CALLBACK_WORKERS = max(1, int(os.environ.get("CALLBACK_WORKERS", "4")))
+EXTRACTED_FORMAT = "ide-pages/1"   # JSON Lines: header object, then one {"page", "lines"} record per page
+EXTRACTED_DOC = "__extracted__"
+table = ddb.Table(os.environ["TABLE_NAME"]) if os.environ.get("TABLE_NAME") else None
 
 def _safe_out_key(src_bucket, src_key, job_id):
     base = os.path.basename(src_key)
@@ -34,6 +50,123 @@ def _safe_out_key(src_bucket, src_key, job_id):
     # Keeps the original 'uploads/' subpath (nice for traceability). Remove it if you want a flat layout.
     return f"{OUT_PREFIX}{date}/{src_key}.json".replace(".pdf.json", f"-{short}.pdf.json")
 
+class _S3StreamWriter:
+    """
+    Buffered writer that streams an S3 object as multipart upload parts of PART_BYTES.
+    Objects smaller than one part go out as a single put_object. The object only becomes
+    visible on close() (CompleteMultipartUpload); an exception inside the with-block aborts it.
+    """
+
+    def __init__(self, bucket, key, content_type, content_encoding=None):
+        self.bucket, self.key = bucket, key
+        self.headers = {"ContentType": content_type,
+                        **({"ContentEncoding": content_encoding} if content_encoding else {})}
+        self.buf = bytearray()
+        self.upload_id, self.parts, self.size = None, [], 0
+
+    def write(self, data: bytes):
+        self.buf += data
+        self.size += len(data)
+        if len(self.buf) >= PART_BYTES:
+            self._flush_part()
+
+    def _flush_part(self):
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.headers)["UploadId"]
+        n = len(self.parts) + 1
+        resp = s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                              PartNumber=n, Body=bytes(self.buf))
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": n})
+        self.buf.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            if self.upload_id:
+                s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            return False
+        if self.upload_id is None:
+            s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buf), **self.headers)
+        else:
+            if self.buf:
+                self._flush_part()
+            s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                         MultipartUpload={"Parts": self.parts})
+        return False
+
+def record_extracted(src_key, out_key, at_ms):
+    """
+    Source → extracted-keys manifest row (docId=EXTRACTED_DOC, chunkId=<source key>):
+    "keys" is the string set of every extracted object for the upload, "latest" the newest.
+    ide-ingest / ide-delete-doc resolve keys with one GetItem instead of listing extracted/.
+    "latest" only moves forward: out_key replaces it when its at_ms (the object's write time)
+    is newer than "latestAt", so a late redelivery of an older job never repoints it.
+    """
+    if table is None or not src_key:
+        return
+    key = {"docId": EXTRACTED_DOC, "chunkId": src_key}
+    names, values = {"#keys": "keys", "#bucket": "bucket"}, {":k": {out_key}, ":b": OUT_BUCKET}
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression="ADD #keys :k SET #bucket = :b, #latest = :key, #at = :at",
+            ConditionExpression="attribute_not_exists(#at) OR #at < :at",
+            ExpressionAttributeNames={**names, "#latest": "latest", "#at": "latestAt"},
+            ExpressionAttributeValues={**values, ":key": out_key, ":at": at_ms},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
+        # a newer extraction is already latest; still record this key
+        table.update_item(Key=key, UpdateExpression="ADD #keys :k SET #bucket = :b",
+                          ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+
+def _compressor():
+    """→ (compress(bytes) -> bytes, flush() -> bytes) for OUTPUT_COMPRESSION."""
+    if COMPRESSION == "gzip":
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return c.compress, c.flush
+    if COMPRESSION == "zstd":
+        import zstandard
+        c = zstandard.ZstdCompressor(level=3).compressobj()
+        return c.compress, c.flush
+    return (lambda b: b), (lambda: b"")
+
+def iter_textract_pages(job_id, meta):
+    """
+    Pages through get_document_text_detection and yields (page_no, [line, ...]) one page at a time.
+    Textract returns blocks in page order, so only the current page is held in memory.
+    meta["page_count"] is set from DocumentMetadata once the first response has arrived.
+    """
+    page_no, lines, seen = None, [], set()
+    next_token = None
+    while True:
+        kwargs = {"JobId": job_id, "MaxResults": 1000}
+        if next_token:
+            kwargs["NextToken"] = next_token
+        resp = textract.get_document_text_detection(**kwargs)
+        meta.setdefault("page_count", resp.get("DocumentMetadata", {}).get("Pages"))
+        for b in resp.get("Blocks", []):
+            if b.get("BlockType") != "LINE":
+                continue
+            p = b.get("Page", 1)
+            if p != page_no:
+                if page_no is not None:
+                    yield page_no, lines
+                if p in seen:
+                    print(f"[IDE] JobId={job_id}: page {p} returned out of order; emitting it again")
+                seen.add(p)
+                page_no, lines = p, []
+            lines.append(b.get("Text", ""))
+        next_token = resp.get("NextToken")
+        if not next_token:
+            break
+    if page_no is not None:
+        yield page_no, lines
+
 def _parse_textract_sns_record(sqs_record):
     """
     Returns: status, job_id, bucket, key, job_tag, api
@@ -79,62 +212,75 @@ def _parse_textract_sns_record(sqs_record):
 
     return status, job_id, bucket, key, job_tag, api
 
-def lambda_handler(event, context):
-    for rec in event.get("Records", []):
-        status, job_id, bucket, key, job_tag, api = _parse_textract_sns_record(rec)
-        print(f"[IDE] Parsed -> status={status} job_id={job_id} api={api} bucket={bucket} key={key} job_tag={job_tag}")
-
-        if not job_id:
-            print("[IDE] Missing JobId in SNS message; skipping.")
-            continue
-
-        if status != "SUCCEEDED":
-            print(f"[IDE] JobId={job_id} not successful (status={status}). Skipping.")
-            continue
-
-        out_key = _safe_out_key(bucket, key, job_id)
-
-        # Idempotency: if output already exists, skip
-        try:
-            s3.head_object(Bucket=OUT_BUCKET, Key=out_key)
-            print(f"[IDE] Output exists s3://{OUT_BUCKET}/{out_key} ; skipping.")
-            continue
-        except botocore.exceptions.ClientError as e:
-            if e.response.get("Error", {}).get("Code") != "404":
-                raise  # only ignore Not Found
-
-        # Page through results
-        pages = {}
-        next_token = None
-        while True:
-            kwargs = {"JobId": job_id, "MaxResults": 1000}
-            if next_token:
-                kwargs["NextToken"] = next_token
-            resp = textract.get_document_text_detection(**kwargs)
-            for b in resp.get("Blocks", []):
-                if b.get("BlockType") == "LINE":
-                    p = b.get("Page", 1)
-                    pages.setdefault(p, []).append(b.get("Text", ""))
-            next_token = resp.get("NextToken")
-            if not next_token:
-                break
-
-        ordered = [{"page": p, "lines": pages[p]} for p in sorted(pages)]
-        payload = {
-            "source_bucket": bucket,
-            "source_key": key,
-            "job_id": job_id,
-            "job_tag": job_tag,
-            "api": api,
-            "pages": ordered
-        }
-
-        s3.put_object(
-            Bucket=OUT_BUCKET,
-            Key=out_key,
-            Body=json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"),
-            ContentType="application/json"
-        )
-        print(f"[IDE] Wrote s3://{OUT_BUCKET}/{out_key}")
+def process_record(rec):
+    """Handles one SQS record; returns a short outcome string. Raises → the record is retried."""
+    status, job_id, bucket, key, job_tag, api = _parse_textract_sns_record(rec)
+    print(f"[IDE] Parsed -> status={status} job_id={job_id} api={api} bucket={bucket} key={key} job_tag={job_tag}")
+
+    if not job_id:
+        print("[IDE] Missing JobId in SNS message; skipping.")
+        return "skipped"
+
+    if status != "SUCCEEDED":
+        print(f"[IDE] JobId={job_id} not successful (status={status}). Skipping.")
+        return "skipped"
 
-    return {"ok": True}
+    out_key = _safe_out_key(bucket, key, job_id)
+
+    # Idempotency: if output already exists, skip
+    try:
+        head = s3.head_object(Bucket=OUT_BUCKET, Key=out_key)
+        print(f"[IDE] Output exists s3://{OUT_BUCKET}/{out_key} ; skipping.")
+        # heals a manifest write lost on an earlier attempt, latest included
+        record_extracted(key, out_key, int(head["LastModified"].timestamp() * 1000))
+        return "exists"
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "404":
+            raise  # only ignore Not Found
+
+    # Stream the ide-pages/1 JSON Lines document page by page as results arrive
+    meta = {}
+    pages = iter_textract_pages(job_id, meta)
+    first = next(pages, None)   # first Textract response carries DocumentMetadata.Pages
+    header = {
+        "format": EXTRACTED_FORMAT,
+        "source_bucket": bucket,
+        "source_key": key,
+        "job_id": job_id,
+        "job_tag": job_tag,
+        "api": api,
+        "page_count": meta.get("page_count"),
+    }
+    compress, flush = _compressor()
+    n_pages = 0
+    with _S3StreamWriter(OUT_BUCKET, out_key, "application/x-ndjson", CONTENT_ENCODING) as out:
+        out.write(compress(json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n"))
+        for p, lines in itertools.chain([first] if first else [], pages):
+            line = json.dumps({"page": p, "lines": lines}, ensure_ascii=False, separators=(",", ":"))
+            out.write(compress(line.encode("utf-8") + b"\n"))
+            n_pages += 1
+        out.write(flush())
+    print(f"[IDE] Wrote s3://{OUT_BUCKET}/{out_key} ({n_pages} pages, {out.size} bytes {COMPRESSION}, "
+          f"{len(out.parts) or 1} part(s))")
+    record_extracted(key, out_key, int(time.time() * 1000))
+    return "written"
+
+def _timed(rec):
+    t0 = time.time()
+    try:
+        outcome = process_record(rec)
+        print(f"[IDE] record {rec.get('messageId')} {outcome} in {(time.time() - t0) * 1000:.0f} ms")
+        return None
+    except Exception as e:
+        print(f"[IDE] record {rec.get('messageId')} failed after {(time.time() - t0) * 1000:.0f} ms: {e!r}")
+        return {"itemIdentifier": rec["messageId"]}
+
+def lambda_handler(event, context):
+    # Records of a batch are independent Textract jobs: fetch/stream them concurrently and
+    # report only the failed ones back to SQS (ReportBatchItemFailures) for redelivery
+    records = event.get("Records", [])
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=min(CALLBACK_WORKERS, max(1, len(records)))) as pool:
+        failures = [f for f in pool.map(_timed, records) if f]
+    print(f"[IDE] batch of {len(records)} records: {len(failures)} failed, {(time.time() - t0) * 1000:.0f} ms")
+    return {"batchItemFailures": failures}
@@ -0,0 +1,697 @@
+# Shared indexing code for ide-embed-index, ide-ingest and ide-delete-doc: Bedrock embedding
+# with adaptive concurrency + embedding cache, the extracted-pages reader, the pipelined DynamoDB
+# batch writer, the OpenSearch dual-write, diff-based indexing and the manifest rows.
+# Package it with each of those handlers (same zip, or a layer under python/) together with
+# ide_sentences.py. It reads the environment variables listed in the handlers' headers; the
+# clients below are module globals so local runs can swap them (see bench/run_bench.py).
+
+# Layers
+# zstandard (optional, only to read zstd-compressed extracted files)
+
+import os, json, re, hashlib, time, struct, random, queue, threading, zlib, itertools, boto3, botocore
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+
+import urllib3
+from botocore.awsrequest import AWSRequest
+from botocore.auth import SigV4Auth
+from botocore.session import Session
+
+from ide_sentences import SENT_VERSION, SENT_NOISE, sentence_spans, is_heading_or_noise
+
+_http = urllib3.PoolManager()   # swap for a stub with .request() to test against a local fake
+_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "eu-west-2"))
+_os_endpoint = os.environ["OS_ENDPOINT"].rstrip("/") if os.environ.get("OS_ENDPOINT") else ""
+_os_index = os.environ.get("OS_INDEX","ide-rag")
+_sigv4_service = os.environ.get("OS_SIGV4_SERVICE","aoss")   # "none" → unsigned (local OpenSearch)
+_creds = None
+
+def _credentials():
+    global _creds
+    if _creds is None:
+        _creds = Session().get_credentials().get_frozen_credentials()
+    return _creds
+
+def _es(method: str, path: str, body=None, params: str=""):
+    if not _os_endpoint:
+        raise RuntimeError("OS_ENDPOINT not configured")
+    url = f"{_os_endpoint}{path}{('?' + params) if params else ''}"
+    data = json.dumps(body).encode("utf-8") if isinstance(body, dict) else (body or None)
+    headers = {"host": _os_endpoint.replace("https://","").replace("http://",""),
+               "content-type": "application/json"}
+    if _sigv4_service != "none":
+        req = AWSRequest(method=method, url=url, data=data, headers=headers)
+        SigV4Auth(_credentials(), _sigv4_service, _region).add_auth(req)
+        headers = dict(req.headers)
+    r = _http.request(method, url, body=data, headers=headers)
+    if r.status >= 300:
+        raise RuntimeError(f"OS {method} {path} -> {r.status} {r.data[:400]!r}")
+    if r.data and r.headers.get("content-type","").startswith("application/json"):
+        return json.loads(r.data.decode("utf-8"))
+    return None
+
+s3 = boto3.client("s3")
+ddb = boto3.resource("dynamodb")
+bedrock = boto3.client("bedrock-runtime", region_name=os.environ.get("BEDROCK_REGION"),
+                       config=Config(max_pool_connections=max(10, int(os.environ.get("EMBED_MAX_WORKERS", "8")))))
+
+TABLE_NAME = os.environ["TABLE_NAME"]
+MODEL_ID   = os.environ.get("BEDROCK_MODEL_ID", "amazon.titan-embed-text-v2:0")
+MAX_CHARS  = int(os.environ.get("MAX_CHARS_PER_CHUNK","800"))
+MANIFEST_DOC  = "__manifest__"    # chunkId=<docId>: {version, chunks, source}, read by ide-query / ide-answer
+CORPUS_DOC    = "__corpus__"      # chunkId="version": corpus-wide change counter
+SHARD_DOC     = "__shards__"      # chunkId=<docId>: sharded-indexing tracker (ide-embed-index)
+EXTRACTED_DOC = "__extracted__"   # chunkId=<source key> → {"keys", "latest"}, written by ide-textract-callback
+VEC_FORMAT = os.environ.get("VEC_FORMAT", "decimal").lower()   # decimal | f32 | f16
+EMBED_MAX_WORKERS = int(os.environ.get("EMBED_MAX_WORKERS", "8"))
+EMBED_MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", "6"))
+WRITE_MAX_RETRIES = int(os.environ.get("WRITE_MAX_RETRIES", "8"))
+DELETE_WORKERS = max(1, int(os.environ.get("DELETE_WORKERS", "4")))
+EMBED_CACHE_TABLE = os.environ.get("EMBED_CACHE_TABLE", "")
+EMBED_CACHE_SIZE  = int(os.environ.get("EMBED_CACHE_SIZE", "4096"))
+SENT_VEC_TABLE = os.environ.get("SENT_VEC_TABLE", "")
+SENT_EMBED     = os.environ.get("SENT_EMBED", "false").lower() == "true"
+SENT_EMBED_MAX = int(os.environ.get("SENT_EMBED_MAX", "48"))
+if SENT_EMBED and not SENT_VEC_TABLE:
+    print("[IDE] SENT_EMBED=true needs SENT_VEC_TABLE; sentence vectors are not written")
+    SENT_EMBED = False
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "DDB").upper()
+OS_DUAL_WRITE  = SEARCH_BACKEND == "OPENSEARCH" or os.environ.get("OS_DUAL_WRITE", "false").lower() == "true"
+OS_BULK_SIZE   = int(os.environ.get("OS_BULK_SIZE", "200"))
+
+table = ddb.Table(TABLE_NAME)
+cache_table = ddb.Table(EMBED_CACHE_TABLE) if EMBED_CACHE_TABLE else None
+
+
+def embed_text(text: str):
+    body = json.dumps({"inputText": text})
+    resp = bedrock.invoke_model(
+        modelId=MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=body
+    )
+    payload = json.loads(resp["body"].read())
+    return payload.get("embedding") or payload.get("embeddings") or []
+
+# Storage format for embeddings: "decimal" (legacy List of Numbers) or packed little-endian
+# "f32" / "f16" Binary. Readers accept both, so the format can be switched per indexer.
+def encode_vec(vec):
+    if VEC_FORMAT in ("f32", "f16"):
+        code = "f" if VEC_FORMAT == "f32" else "e"
+        return {"vec": struct.pack(f"<{len(vec)}{code}", *vec), "vecFmt": VEC_FORMAT}
+    return {"vec": [Decimal(str(x)) for x in vec]}
+
+def put_manifest(doc_id: str, chunks: int, source: str):
+    # Per-doc version row read by ide-query / ide-answer to refresh their warm corpus cache
+    table.put_item(Item={
+        "docId":   MANIFEST_DOC,
+        "chunkId": doc_id,
+        "version": time.time_ns() // 1_000_000,
+        "chunks":  chunks,
+        "source":  source
+    })
+    bump_corpus_version()
+
+def bump_corpus_version():
+    # Single counter row: ide-answer keys its answer cache on it, so any change here invalidates it
+    table.update_item(Key={"docId": CORPUS_DOC, "chunkId": "version"},
+                      UpdateExpression="ADD #v :one",
+                      ExpressionAttributeNames={"#v": "version"},
+                      ExpressionAttributeValues={":one": 1})
+
+def chunk_lines(lines, max_chars=800):
+    buf, size = [], 0
+    for ln in lines:
+        ln = (ln or "").strip()
+        if not ln:
+            continue
+        if size + len(ln) + 1 > max_chars and buf:
+            yield " ".join(buf)
+            buf, size = [ln], len(ln)
+        else:
+            buf.append(ln)
+            size += len(ln) + 1
+    if buf:
+        yield " ".join(buf)
+
+# ---------- Sentence index (read by ide-answer's extractive synthesis) ----------
+# Every chunk item carries "sents": packed little-endian uint16 (start, end, flags) triples, one per
+# sentence of its text, plus "sentVer". Flag SENT_NOISE marks headings / ingredient lists / stubs,
+# so ide-answer can slice out the usable sentences without re-splitting or running the noise regexes.
+# The rules themselves live in ide_sentences.py, which ide-answer imports as well.
+def sentence_index(text: str):
+    text = text or ""
+    if len(text) > 0xFFFF:
+        return {}   # offsets would not fit uint16; ide-answer splits such chunks itself
+    flat = []
+    for s, e in sentence_spans(text):
+        flat += (s, e, SENT_NOISE if is_heading_or_noise(text[s:e]) else 0)
+    return {"sents": struct.pack(f"<{len(flat)}H", *flat), "sentVer": SENT_VERSION}
+
+def usable_sentences(text: str):
+    """The non-noise sentences of a chunk, in the order ide-answer slices them out of "sents"."""
+    text = text or ""
+    return [text[s:e] for s, e in sentence_spans(text) if not is_heading_or_noise(text[s:e])]
+
+# SENT_EMBED: sentence vectors live in their own table (SENT_VEC_TABLE, partition key docId, sort
+# key chunkId), so the chunk rows that every scan and cold load reads stay small. A store row holds
+# "sentVecs", one packed little-endian float16 embedding per usable sentence (same model as the
+# chunk vectors, so ide-answer compares them with the query vector it already has), "sentEmb" (the
+# model id) and the chunk's "embHash"; the chunk row itself only carries "sentEmb" as a marker.
+# ide-answer reads the rows of the chunks it answers from. Too many sentences → no row, ide-answer
+# then keeps the keyword ranking for that answer.
+def encode_sent_vecs(vecs):
+    flat = [x for v in vecs for x in v]
+    return {"sentVecs": struct.pack(f"<{len(flat)}e", *flat), "sentEmb": MODEL_ID}
+
+# ---------- Embedding stage (bounded thread pool, adaptive concurrency) ----------
+# Bedrock throttling codes that are worth retrying with backoff
+_THROTTLE_CODES = {"ThrottlingException", "TooManyRequestsException",
+                   "ServiceUnavailableException", "ModelNotReadyException"}
+
+class _AdaptiveLimit:
+    """AIMD limit on in-flight Bedrock calls: +1 after a clean round, halved on throttling."""
+    def __init__(self, max_limit):
+        self.max_limit = max(1, max_limit)
+        self.limit = max(1, self.max_limit // 2)
+        self.active = self.clean = self.throttles = 0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def success(self):
+        with self.cond:
+            self.clean += 1
+            if self.clean >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.clean = 0
+                self.cond.notify_all()
+
+    def throttled(self):
+        with self.cond:
+            self.limit = max(1, self.limit // 2)
+            self.clean = 0
+            self.throttles += 1
+
+def _embed_with_backoff(text, limiter):
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            with limiter:
+                vec = embed_text(text)
+            limiter.success()
+            return vec
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in _THROTTLE_CODES or attempt == EMBED_MAX_RETRIES:
+                raise
+            limiter.throttled()
+            time.sleep(random.uniform(0, min(20.0, 0.5 * 2 ** attempt)))  # full jitter
+
+# ---------- Embedding cache: in-container LRU in front of an optional DynamoDB table ----------
+# Keyed by (model id, whitespace-normalized chunk text); stored vectors are packed float32.
+_LRU, _LRU_LOCK = OrderedDict(), threading.Lock()
+
+def emb_hash(text: str) -> str:
+    norm = re.sub(r"\s+", " ", text or "").strip()
+    return hashlib.sha256(f"{MODEL_ID}\n{norm}".encode("utf-8")).hexdigest()
+
+def _lru_get(h):
+    with _LRU_LOCK:
+        vec = _LRU.get(h)
+        if vec is not None:
+            _LRU.move_to_end(h)
+        return vec
+
+def _lru_put(h, vec):
+    with _LRU_LOCK:
+        _LRU[h] = vec
+        _LRU.move_to_end(h)
+        while len(_LRU) > EMBED_CACHE_SIZE:
+            _LRU.popitem(last=False)
+
+def _embed_cached(text, limiter):
+    """Returns (vec, tier) where tier is "lru", "ddb" or "bedrock"."""
+    h = emb_hash(text)
+    vec = _lru_get(h)
+    if vec is not None:
+        return vec, "lru"
+    if cache_table is not None:
+        try:
+            it = cache_table.get_item(Key={"k": h}).get("Item")
+            if it:
+                raw = it["vec"].value
+                vec = list(struct.unpack(f"<{len(raw) // 4}f", raw))
+                _lru_put(h, vec)
+                return vec, "ddb"
+        except Exception as e:
+            print("[IDE] embed cache read failed:", repr(e))
+    vec = _embed_with_backoff(text, limiter)
+    _lru_put(h, vec)
+    if cache_table is not None:
+        try:
+            cache_table.put_item(Item={"k": h, "model": MODEL_ID,
+                                       "vec": struct.pack(f"<{len(vec)}f", *vec)})
+        except Exception as e:
+            print("[IDE] embed cache write failed:", repr(e))
+    return vec, "bedrock"
+
+# ---------- Extracted document reader ----------
+# ide-textract-callback writes "ide-pages/1": JSON Lines, a header object
+#   {"format": "ide-pages/1", "source_bucket": ..., "source_key": ..., "job_id": ..., "page_count": N}
+# followed by one {"page": n, "lines": [...]} record per page, optionally gzip/zstd compressed
+# (detected from the magic bytes). Older files are a single {"source_*": ..., "pages": [...]} object.
+EXTRACTED_FORMAT = "ide-pages/1"
+_GZIP_MAGIC, _ZSTD_MAGIC = b"\x1f\x8b", b"\x28\xb5\x2f\xfd"
+
+def _decompressed_chunks(body, chunk_size=1 << 20):
+    chunks = body.iter_chunks(chunk_size)
+    first = next(chunks, b"")
+    if first.startswith(_GZIP_MAGIC):
+        decompress = zlib.decompressobj(wbits=31).decompress
+    elif first.startswith(_ZSTD_MAGIC):
+        import zstandard   # optional layer, only needed for zstd-compressed files
+        decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+    else:
+        decompress = None
+    for c in itertools.chain([first], chunks):
+        yield decompress(c) if decompress else c
+
+def _iter_lines(chunks):
+    parts = []
+    for c in chunks:
+        *lines, rest = c.split(b"\n")
+        if lines:
+            lines[0] = b"".join(parts) + lines[0]
+            parts = []
+            yield from lines
+        parts.append(rest)
+    tail = b"".join(parts)
+    if tail:
+        yield tail
+
+def read_extracted(bucket, key):
+    """
+    Opens an extracted document → (header, pages), where pages lazily yields
+    {"page": n, "lines": [...]}. ide-pages/1 files are parsed while they download;
+    legacy single-object files are read whole.
+    """
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    lines = _iter_lines(_decompressed_chunks(body))
+    first = next(lines, b"")
+    try:
+        header = json.loads(first)
+    except ValueError:
+        header = None
+    if isinstance(header, dict) and header.get("format") == EXTRACTED_FORMAT:
+        return header, (json.loads(ln) for ln in lines if ln.strip())
+    doc = json.loads(b"\n".join([first, *lines]))
+    return doc, iter(doc.pop("pages", []))
+
+def iter_chunks(pages):
+    """
+    Yields (page_no, chunk_index, text) in document order. chunk_index restarts on every page, so
+    an edit to one page leaves every other page's chunkIds (and their embeddings) in place.
+    """
+    for page_obj in pages:
+        page_no = int(page_obj.get("page", 0))
+        for chunk_index, chunk in enumerate(chunk_lines(page_obj.get("lines", []), MAX_CHARS)):
+            yield page_no, chunk_index, chunk
+
+def _embed_sentences(text, limiter):
+    """
+    Usable-sentence vectors of one chunk → ([vec, ...], [tier, ...]), or ([], []) past
+    SENT_EMBED_MAX. Titan embeddings take one text per call, so a chunk's sentences are
+    embedded one after another in a single pool task: each chunk has at most one sentence
+    call in flight and sentence work cannot crowd the chunk embeddings out of the pool.
+    Repeated sentences are embedded once.
+    """
+    sents = usable_sentences(text)
+    if len(sents) > SENT_EMBED_MAX:
+        return [], []
+    done = {}
+    for s in sents:
+        if s not in done:
+            done[s] = _embed_cached(s, limiter)
+    return [done[s][0] for s in sents], [tier for _, tier in done.values()]
+
+def embed_chunks(chunks):
+    """
+    Embeds (page_no, chunk_index, text) tuples concurrently and yields
+    (page_no, chunk_index, text, vec, sent_vecs) in input order; sent_vecs is the list of
+    usable-sentence vectors with SENT_EMBED, else None. At most 2 * EMBED_MAX_WORKERS
+    chunks are in flight, so `chunks` can be a lazy generator.
+    """
+    limiter = _AdaptiveLimit(EMBED_MAX_WORKERS)
+    window, tiers, t0 = deque(), {"lru": 0, "ddb": 0, "bedrock": 0}, time.time()
+    counts = {"chunks": 0, "sentences": 0}
+
+    def emit():
+        ch, fut, sent_fut = window.popleft()
+        vec, tier = fut.result()
+        tiers[tier] += 1
+        counts["chunks"] += 1
+        sent_vecs = None
+        if sent_fut is not None:
+            sent_vecs, sent_tiers = sent_fut.result()
+            for tier in sent_tiers:
+                tiers[tier] += 1
+            counts["sentences"] += len(sent_vecs)
+        return (*ch, vec, sent_vecs)
+
+    with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as pool:
+        for ch in chunks:
+            sent_fut = pool.submit(_embed_sentences, ch[2], limiter) if SENT_EMBED else None
+            window.append((ch, pool.submit(_embed_cached, ch[2], limiter), sent_fut))
+            if len(window) >= 2 * EMBED_MAX_WORKERS:
+                yield emit()
+        while window:
+            yield emit()
+    print(f"[IDE] Embedded {counts['chunks']} chunks + {counts['sentences']} sentences in {time.time() - t0:.1f}s "
+          f"(bedrock={tiers['bedrock']} cache_lru={tiers['lru']} cache_ddb={tiers['ddb']} "
+          f"limit={limiter.limit}/{limiter.max_limit} throttled={limiter.throttles})")
+
+# ---------- Pipelined DynamoDB batch writer ----------
+class _BatchWriter:
+    """
+    Groups puts into 25-item BatchWriteItem requests and sends them from `workers` background
+    threads, so writes overlap with the embedding of later chunks (or, for deletes, with
+    paging through the keys). UnprocessedItems are retried with jittered exponential
+    backoff; per-document stats are printed on exit. An empty `table_name` (an optional table
+    that is not configured, e.g. SENT_VEC_TABLE) turns puts and deletes into no-ops.
+    """
+    def __init__(self, label, workers=1, table_name=TABLE_NAME):
+        self.label, self.table_name = label, table_name
+        self.buf, self.error = [], None
+        self.items = self.requests = self.retried = 0
+        self.lock = threading.Lock()
+        self.q = queue.Queue(maxsize=8 * workers)   # backpressure: at most 8 batches queued per worker
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers if table_name else 0)]
+
+    def __enter__(self):
+        self.t0 = time.time()
+        for t in self.threads:
+            t.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._flush()
+        for _ in self.threads:
+            self.q.put(None)
+        for t in self.threads:
+            t.join()
+        if exc_type is None and self.error:
+            raise self.error
+        if not self.table_name:
+            return False
+        secs = max(time.time() - self.t0, 1e-6)
+        print(f"[IDE] Wrote {self.items} items for {self.label} in {secs:.1f}s "
+              f"({self.items / secs:.1f} items/s, requests={self.requests} retried={self.retried})")
+        return False
+
+    def put(self, item):
+        if not self.table_name:
+            return
+        self.buf.append({"PutRequest": {"Item": item}})
+        if len(self.buf) == 25:
+            self._flush()
+
+    def delete(self, key):
+        if not self.table_name:
+            return
+        self.buf.append({"DeleteRequest": {"Key": key}})
+        if len(self.buf) == 25:
+            self._flush()
+
+    def _flush(self):
+        if self.error:
+            raise self.error
+        if self.buf:
+            self.q.put(self.buf)
+            self.buf = []
+
+    def _run(self):
+        while True:
+            batch = self.q.get()
+            if batch is None:
+                return
+            if self.error:
+                continue  # drain after a failure; the caller re-raises it
+            try:
+                self._send(batch)
+            except Exception as e:
+                self.error = e
+
+    def _send(self, batch):
+        pending = {self.table_name: batch}
+        for attempt in range(WRITE_MAX_RETRIES + 1):
+            resp = ddb.batch_write_item(RequestItems=pending)
+            pending = resp.get("UnprocessedItems") or {}
+            left = len(pending.get(self.table_name, []))
+            with self.lock:
+                self.requests += 1
+                self.retried += left
+                if not left:
+                    self.items += len(batch)
+            if not left:
+                return
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+        raise RuntimeError(f"BatchWriteItem left {left} unprocessed items after {WRITE_MAX_RETRIES} retries")
+
+# ---------- OpenSearch k-NN dual-write (SEARCH_BACKEND=OPENSEARCH or OS_DUAL_WRITE=true) ----------
+_os_index_ready = False
+
+def _check_os_mapping(dim: int):
+    """Refuses an index whose "vec" field ide-query / ide-answer could not turn back into cosine."""
+    mapping = _es("GET", f"/{_os_index}/_mapping") or {}
+    field = next(iter(mapping.values()), {}).get("mappings", {}).get("properties", {}).get("vec", {})
+    space = field.get("method", {}).get("space_type") or field.get("space_type") or "l2"   # l2 is OpenSearch's default
+    if field.get("type") != "knn_vector" or space != "cosinesimil" or int(field.get("dimension", 0)) != dim:
+        raise RuntimeError(f"OpenSearch index {_os_index}: vec is {field.get('type')} space_type={space} "
+                           f"dimension={field.get('dimension')}; expected knn_vector cosinesimil dimension={dim}")
+
+def _ensure_os_index(dim: int):
+    global _os_index_ready
+    if _os_index_ready:
+        return
+    try:
+        _es("HEAD", f"/{_os_index}")
+        created = False
+    except RuntimeError:
+        try:
+            _es("PUT", f"/{_os_index}", {
+                "settings": {"index": {"knn": True}},
+                "mappings": {"properties": {
+                    "vec":     {"type": "knn_vector", "dimension": dim,
+                                "method": {"name": "hnsw", "space_type": "cosinesimil", "engine": "lucene"}},
+                    "docId":   {"type": "keyword"},
+                    "chunkId": {"type": "keyword"},
+                    "page":    {"type": "integer"},
+                    "source":  {"type": "keyword"},
+                    "text":    {"type": "text"}
+                }}
+            })
+            created = True
+        except RuntimeError as e:
+            if "resource_already_exists" not in str(e):
+                raise
+            created = False
+    if not created:
+        _check_os_mapping(dim)   # created elsewhere (or by an older deploy): must score like ours
+    _os_index_ready = True
+
+# OpenSearch Serverless (OS_SIGV4_SERVICE=aoss) vector collections reject custom document ids, so
+# there documents get generated ids and are addressed by their docId / chunkId fields instead:
+# deleted chunks and the old copy of a re-embedded chunk go through _delete_by_query, which
+# runs before the _bulk that re-adds them. Elsewhere "<docId>|<chunkId>" ids make both idempotent.
+OS_CUSTOM_IDS = _sigv4_service != "aoss"
+
+class _OsBulk:
+    """Buffers index/delete actions and sends them through _bulk every OS_BULK_SIZE actions."""
+    def __init__(self, enabled):
+        self.enabled, self.lines, self.pending, self.sent, self.deleted = enabled, [], 0, 0, 0
+        self.by_query = {}   # aoss: docId -> [chunkId, ...] for the next _delete_by_query
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def index(self, item, vec, replace=False):
+        """replace: the chunk may already be in the index (re-embedded after a change)."""
+        if not self.enabled:
+            return
+        _ensure_os_index(len(vec))
+        doc = {k: item[k] for k in ("docId", "chunkId", "page", "text", "source")}
+        doc["vec"] = [float(x) for x in vec]
+        if OS_CUSTOM_IDS:
+            self._add({"index": {"_index": _os_index, "_id": f"{item['docId']}|{item['chunkId']}"}}, doc)
+            return
+        if replace:
+            self._delete_by_query(item)
+        self._add({"index": {"_index": _os_index}}, doc)
+
+    def delete(self, key):
+        if not self.enabled:
+            return
+        if OS_CUSTOM_IDS:
+            self._add({"delete": {"_index": _os_index, "_id": f"{key['docId']}|{key['chunkId']}"}})
+        else:
+            self._delete_by_query(key)
+
+    def _delete_by_query(self, key):
+        self.by_query.setdefault(key["docId"], []).append(key["chunkId"])
+        self._count()
+
+    def _add(self, action, doc=None):
+        self.lines.append(json.dumps(action))
+        if doc is not None:
+            self.lines.append(json.dumps(doc, ensure_ascii=False))
+        self._count()
+
+    def _count(self):
+        self.pending += 1
+        if self.pending >= OS_BULK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.by_query:
+            should = [{"bool": {"filter": [{"term": {"docId": d}}, {"terms": {"chunkId": c}}]}}
+                      for d, c in self.by_query.items()]
+            try:
+                resp = _es("POST", f"/{_os_index}/_delete_by_query",
+                           {"query": {"bool": {"should": should, "minimum_should_match": 1}}}) or {}
+                self.deleted += int(resp.get("deleted", 0))
+            except RuntimeError as e:
+                if "-> 404" not in str(e):   # no index yet: nothing to delete
+                    raise
+            self.by_query = {}
+        if self.lines:
+            resp = _es("POST", "/_bulk", ("\n".join(self.lines) + "\n").encode("utf-8")) or {}
+            if resp.get("errors"):
+                failed = [i for i in resp.get("items", []) for v in i.values()
+                          if v.get("error") and v.get("status") != 404]
+                if failed:
+                    raise RuntimeError(f"OS _bulk: {len(failed)} failed actions, first: {failed[0]}")
+            self.deleted += sum(1 for i in resp.get("items", []) if i.get("delete", {}).get("result") == "deleted")
+        self.sent += self.pending
+        self.lines, self.pending = [], 0
+
+# ---------- Diff-based indexing ----------
+def existing_chunk_state(doc_id: str):
+    """chunkId -> (embHash, source, sentEmb) of the doc's current items; vectors and text are not read."""
+    kwargs = {
+        "KeyConditionExpression": Key("docId").eq(doc_id),
+        "ProjectionExpression": "chunkId, embHash, #src, sentEmb",
+        "ExpressionAttributeNames": {"#src": "source"},
+    }
+    state, resp = {}, table.query(**kwargs)
+    while True:
+        for it in resp.get("Items", []):
+            state[it["chunkId"]] = (it.get("embHash"), it.get("source"), it.get("sentEmb"))
+        if "LastEvaluatedKey" not in resp:
+            return state
+        resp = table.query(ExclusiveStartKey=resp["LastEvaluatedKey"], **kwargs)
+
+def _chunk_page(chunk_id: str):
+    head = chunk_id.split("#", 1)[0]
+    return int(head) if head.isdigit() else 0
+
+def index_pages(pages, doc_id: str, source_uri: str, page_range=(None, None)):
+    """
+    Indexes a document as a diff against what is already stored: unchanged chunks
+    (same chunkId, model + text hash and source, and sentence vectors when SENT_EMBED
+    is on) are kept, new or changed ones are
+    embedded and written, and chunkIds that no longer exist are deleted.
+    page_range = (first, last) limits all of that to one shard's pages (None = open end);
+    chunks are numbered per page, so a shard never needs the pages outside its range.
+    """
+    first, last = page_range
+    in_range = lambda p: (first is None or p >= first) and (last is None or p <= last)
+    existing = {c: v for c, v in existing_chunk_state(doc_id).items() if in_range(_chunk_page(c))}
+    seen = set()
+    stats = {"indexed": 0, "kept": 0, "deleted": 0}
+    label = f"docId={doc_id}" + (f" pages={first or 1}-{last or 'end'}" if page_range != (None, None) else "")
+
+    def shard_pages():
+        for page_obj in pages:
+            page_no = int(page_obj.get("page", 0))
+            if last is not None and page_no > last:
+                break   # pages arrive in document order: nothing further belongs to this shard
+            if in_range(page_no):
+                yield page_obj
+
+    def changed_chunks():
+        for page_no, chunk_index, chunk in iter_chunks(shard_pages()):
+            chunk_id = f"{page_no:04d}#{chunk_index:06d}"
+            seen.add(chunk_id)
+            prev = existing.get(chunk_id)
+            if prev and prev[:2] == (emb_hash(chunk), source_uri) and (not SENT_EMBED or prev[2] == MODEL_ID):
+                stats["kept"] += 1
+                continue
+            yield page_no, chunk_index, chunk
+
+    with _BatchWriter(label) as bw, _BatchWriter(f"{label} (sentences)", table_name=SENT_VEC_TABLE) as sw, \
+            _OsBulk(OS_DUAL_WRITE) as osb:
+        for page_no, chunk_index, chunk, emb, sent_vecs in embed_chunks(changed_chunks()):
+            item = {
+                "docId":   doc_id,
+                "chunkId": f"{page_no:04d}#{chunk_index:06d}",
+                "text":    chunk,
+                "page":    page_no,
+                "source":  source_uri,
+                "embHash": emb_hash(chunk),
+            }
+            key = {"docId": doc_id, "chunkId": item["chunkId"]}
+            marker = {"sentEmb": MODEL_ID} if sent_vecs is not None else {}
+            bw.put({**item, **sentence_index(chunk), **marker, **encode_vec(emb)})
+            if sent_vecs:
+                sw.put({**key, "embHash": item["embHash"], **encode_sent_vecs(sent_vecs)})
+            elif item["chunkId"] in existing:
+                sw.delete(key)   # the old text's sentence vectors
+            osb.index(item, emb, replace=item["chunkId"] in existing)
+            stats["indexed"] += 1
+        for chunk_id in sorted(existing.keys() - seen):
+            bw.delete({"docId": doc_id, "chunkId": chunk_id})
+            sw.delete({"docId": doc_id, "chunkId": chunk_id})
+            osb.delete({"docId": doc_id, "chunkId": chunk_id})
+            stats["deleted"] += 1
+
+    print(f"[IDE] {label} indexed={stats['indexed']} kept={stats['kept']} deleted={stats['deleted']}")
+    return stats
+
+# ---------- docIds ----------
+def is_reserved_doc_id(doc_id: str) -> bool:
+    # "__name__" partitions hold control rows (__manifest__, __corpus__, __shards__, __extracted__)
+    return doc_id.startswith("__") and doc_id.endswith("__")
+
+def doc_id_from_source(src_key: str) -> str:
+    base = os.path.basename(src_key)          # e.g. "Coffee Machine Program Requirements.pdf"
+    name, _ = os.path.splitext(base)          # "Coffee Machine Program Requirements"
+    doc_id = re.sub(r'[^A-Za-z0-9._-]', '-', name)[:200] or "doc"
+    return "doc-" + doc_id if is_reserved_doc_id(doc_id) else doc_id
+
+def iter_doc_keys(doc_id: str):
+    """Yields pages of {"docId", "chunkId"} keys for a document; vec/text are never read."""
+    kwargs = {"KeyConditionExpression": Key("docId").eq(doc_id), "ProjectionExpression": "docId, chunkId"}
+    resp = table.query(**kwargs)
+    yield resp.get("Items", [])
+    while "LastEvaluatedKey" in resp:
+        resp = table.query(ExclusiveStartKey=resp["LastEvaluatedKey"], **kwargs)
+        yield resp.get("Items", [])
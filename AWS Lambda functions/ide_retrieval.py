@@ -0,0 +1,723 @@
+# Shared retrieval code for ide-query (/search) and ide-answer (/answer): query embedding with
+# an in-process LRU + optional DynamoDB tier, the warm in-memory vector index (parallel segmented
+# cold load, manifest-driven refresh), request filters and the SEARCH_BACKEND retrieval backends.
+# Package it with both handlers (same zip, or a layer under python/). It reads the environment
+# variables listed in the handlers' headers; the clients below are module globals so local runs
+# can swap them (see bench/run_bench.py).
+
+# Layers
+# numpy (e.g. AWSSDKPandas-Python311, or a custom numpy layer)
+# faiss-cpu (only for SEARCH_BACKEND=ANN)
+
+import os, json, math, time, re, hashlib, boto3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import numpy as np
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+import urllib3
+from botocore.awsrequest import AWSRequest
+from botocore.auth import SigV4Auth
+from botocore.session import Session
+
+_http = urllib3.PoolManager()   # swap for a stub with .request() to test against a local fake
+_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION", "eu-west-2"))
+_os_endpoint = os.environ["OS_ENDPOINT"].rstrip("/") if os.environ.get("OS_ENDPOINT") else ""
+_os_index = os.environ.get("OS_INDEX","ide-rag")
+_sigv4_service = os.environ.get("OS_SIGV4_SERVICE","aoss")   # "none" → unsigned (local OpenSearch)
+_creds = None
+
+def _credentials():
+    global _creds
+    if _creds is None:
+        _creds = Session().get_credentials().get_frozen_credentials()
+    return _creds
+
+def _es(method: str, path: str, body=None, params: str=""):
+    if not _os_endpoint:
+        raise RuntimeError("OS_ENDPOINT not configured")
+    url = f"{_os_endpoint}{path}{('?' + params) if params else ''}"
+    data = json.dumps(body).encode("utf-8") if isinstance(body, dict) else (body or None)
+    headers = {"host": _os_endpoint.replace("https://","").replace("http://",""),
+               "content-type": "application/json"}
+    if _sigv4_service != "none":
+        req = AWSRequest(method=method, url=url, data=data, headers=headers)
+        SigV4Auth(_credentials(), _sigv4_service, _region).add_auth(req)
+        headers = dict(req.headers)
+    r = _http.request(method, url, body=data, headers=headers)
+    if r.status >= 300:
+        raise RuntimeError(f"OS {method} {path} -> {r.status} {r.data[:400]!r}")
+    if r.data and r.headers.get("content-type","").startswith("application/json"):
+        return json.loads(r.data.decode("utf-8"))
+    return None
+
+ddb = boto3.resource("dynamodb")
+table = ddb.Table(os.environ["TABLE_NAME"])
+bedrock = boto3.client("bedrock-runtime", region_name=os.environ.get("BEDROCK_REGION"))   # unset in ide-ann-build
+MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "amazon.titan-embed-text-v2:0")
+INDEX_TTL = int(os.environ.get("INDEX_TTL_SECONDS", "3600"))          # full reload bound
+EMBED_DIM = int(os.environ.get("EMBED_DIM", "1024"))                 # vector size of BEDROCK_MODEL_ID; rows of any other size are skipped
+CORPUS_REFRESH = int(os.environ.get("CORPUS_REFRESH_SECONDS", "30"))  # manifest re-check interval
+SCAN_SEGMENTS = max(1, int(os.environ.get("SCAN_SEGMENTS", "8")))    # parallel scan cap (cold load)
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "512"))
+QUERY_CACHE_TTL  = int(os.environ.get("QUERY_CACHE_TTL_SECONDS", "3600"))
+EMBED_CACHE_TABLE = os.environ.get("EMBED_CACHE_TABLE", "")
+cache_table = ddb.Table(EMBED_CACHE_TABLE) if EMBED_CACHE_TABLE else None
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "DDB").upper()   # DDB|MEMORY, DDB_SCAN, OPENSEARCH, ANN
+OS_NUM_CANDIDATES = int(os.environ.get("OS_NUM_CANDIDATES", "100"))
+ANN_BUCKET        = os.environ.get("ANN_BUCKET", "")
+ANN_PREFIX        = os.environ.get("ANN_PREFIX", "ann/")
+ANN_NPROBE        = int(os.environ.get("ANN_NPROBE", "16"))
+ANN_EF_SEARCH     = int(os.environ.get("ANN_EF_SEARCH", "64"))
+ANN_CHECK_SECONDS = int(os.environ.get("ANN_CHECK_SECONDS", "300"))
+s3 = boto3.client("s3")
+MANIFEST_DOC = "__manifest__"   # partition holding one {chunkId: <docId>, version} row per document
+
+def embed(q):
+    body = json.dumps({"inputText": q})
+    resp = bedrock.invoke_model(
+        modelId=MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=body
+    )
+    payload = json.loads(resp["body"].read())
+    return payload.get("embedding") or payload.get("embeddings") or []
+
+# ---------- Query-embedding cache: in-process LRU + optional shared DynamoDB tier ----------
+# Keyed by (model id, lower-cased whitespace-normalized query). The shared tier reuses the
+# indexers' EMBED_CACHE_TABLE (packed float32, "expiresAt" as the table's TTL attribute).
+_QCACHE = OrderedDict()   # key -> (expires_at, vec)
+_QSTATS = {"lru": 0, "ddb": 0, "miss": 0, "bedrock_ms": 0.0}
+
+def _query_key(q: str) -> str:
+    norm = re.sub(r"\s+", " ", (q or "").lower()).strip()
+    return hashlib.sha256(f"{MODEL_ID}\nquery\n{norm}".encode("utf-8")).hexdigest()
+
+def _qcache_ddb_get(key, now):
+    if cache_table is None:
+        return None
+    try:
+        it = cache_table.get_item(Key={"k": key}).get("Item")
+        if it and int(it.get("expiresAt", now + 1)) > now:
+            return np.frombuffer(it["vec"].value, dtype="<f4")
+    except Exception as e:
+        print("[IDE] query cache read failed:", repr(e))
+    return None
+
+def _qcache_ddb_put(key, vec, now):
+    if cache_table is None:
+        return
+    try:
+        cache_table.put_item(Item={"k": key, "model": MODEL_ID,
+                                   "vec": np.asarray(vec, dtype="<f4").tobytes(),
+                                   "expiresAt": int(now + QUERY_CACHE_TTL)})
+    except Exception as e:
+        print("[IDE] query cache write failed:", repr(e))
+
+def embed_query(q: str):
+    key, now = _query_key(q), time.time()
+    hit = _QCACHE.get(key)
+    if hit and hit[0] > now:
+        _QCACHE.move_to_end(key)
+        vec, tier = hit[1], "lru"
+    else:
+        vec, tier = _qcache_ddb_get(key, now), "ddb"
+        if vec is None:
+            t0 = time.time()
+            vec, tier = embed(q), "miss"
+            _QSTATS["bedrock_ms"] += (time.time() - t0) * 1000
+            _qcache_ddb_put(key, vec, now)
+        _QCACHE[key] = (now + QUERY_CACHE_TTL, vec)
+        _QCACHE.move_to_end(key)
+        while len(_QCACHE) > QUERY_CACHE_SIZE:
+            _QCACHE.popitem(last=False)
+    _QSTATS[tier] += 1
+
+    hits, misses = _QSTATS["lru"] + _QSTATS["ddb"], _QSTATS["miss"]
+    avg_ms = _QSTATS["bedrock_ms"] / misses if misses else 0.0
+    print(f"[IDE] query-embed cache {tier}: hit_ratio={hits / (hits + misses):.2f} "
+          f"lru={_QSTATS['lru']} ddb={_QSTATS['ddb']} miss={misses} "
+          f"saved_bedrock_ms~{hits * avg_ms:.0f}")
+    return vec
+
+def cosine(a, b):
+    if not a or not b or len(a) != len(b):
+        return -1.0
+    num = sum(x*y for x,y in zip(a,b))
+    da  = math.sqrt(sum(x*x for x in a))
+    db  = math.sqrt(sum(y*y for y in b))
+    return (num/(da*db)) if da and db else -1.0
+
+def to_float_list(vec):
+    return [float(v) for v in vec]
+
+# Vectors are stored either as a legacy List of Decimals or (VEC_FORMAT=f32|f16 on the
+# indexers) as packed little-endian Binary with the dtype in "vecFmt".
+_VEC_DTYPES = {"f32": "<f4", "f16": "<f2"}
+
+def decode_vec(it):
+    vec = it.get("vec")
+    if vec is None:
+        return None
+    if isinstance(vec, (Binary, bytes, bytearray)):
+        raw = vec.value if isinstance(vec, Binary) else vec
+        return np.frombuffer(raw, dtype=_VEC_DTYPES.get(it.get("vecFmt"), "<f4"))  # zero-copy view
+    return np.asarray(to_float_list(vec), dtype=np.float32)
+
+# ---------- Corpus cache + in-memory vector index (kept warm across invocations) ----------
+# Each document is cached as its own block: a float32 matrix of L2-normalized vectors plus the
+# (docId, chunkId) key of every row. The search matrix is the concatenation of all blocks. Rows whose vector is zero
+# or has an unexpected dimension are flagged invalid and are never returned, with or without
+# filters (searchable(): the same rule for every backend); a query vector that is not EMBED_DIM
+# wide returns nothing.
+#
+# Freshness: ide-embed-index / ide-ingest write a per-doc version row under MANIFEST_DOC.
+# Every CORPUS_REFRESH seconds the manifest is re-read and only docIds whose version changed
+# are re-fetched (Query by partition key). A full reload happens every INDEX_TTL seconds, which
+# also bounds staleness for documents indexed before the manifest existed.
+#
+# A full load is a parallel scan (Segment/TotalSegments, up to SCAN_SEGMENTS threads) that decodes
+# each page straight into a growable per-segment matrix; per-doc blocks are views into the index.
+_CORPUS = {"docs": {}, "versions": {}, "sources": {}, "loaded_at": 0.0, "checked_at": 0.0}
+_INDEX = {"mat": None, "valid": None, "keys": [], "pages": None}
+_CACHE_STATS = {"hit": 0, "miss": 0, "refresh": 0, "docs_refetched": 0}
+
+# Two-phase retrieval: scoring reads only keys + vectors (SCORE_PROJECTION); text, page and
+# source are fetched afterwards for the top-k winners only (hydrate → BatchGetItem).
+# Per-request read volume is tallied in _READS and logged by retrieve() (ide-answer logs its
+# sentence-vector reads, "sents", itself).
+SCORE_PROJECTION = {"ProjectionExpression": "docId, chunkId, vec, vecFmt"}
+_READS = {phase: {"items": 0, "bytes": 0, "rcu": 0.0} for phase in ("score", "fetch", "sents")}
+_READS_LOCK = threading.Lock()
+SCAN_ROWS_PER_SEGMENT = 2000   # cold load: one more segment per ~2000 manifest rows, up to SCAN_SEGMENTS
+
+def _item_bytes(it):
+    # approximate DynamoDB item size: attribute names + values (a Decimal is ~10 bytes on the wire)
+    n = 0
+    for k, v in it.items():
+        n += len(k)
+        if isinstance(v, Binary):
+            n += len(v.value)
+        elif isinstance(v, (str, bytes, bytearray)):
+            n += len(v)
+        elif isinstance(v, list):
+            n += 10 * len(v)
+        else:
+            n += 10
+    return n
+
+def _count_reads(phase, resp, items):
+    nbytes = sum(_item_bytes(it) for it in items)
+    cap = resp.get("ConsumedCapacity")
+    rcu = sum(float(c.get("CapacityUnits", 0)) for c in (cap if isinstance(cap, list) else [cap] if cap else []))
+    with _READS_LOCK:   # scan segments report from worker threads
+        stats = _READS[phase]
+        stats["items"] += len(items)
+        stats["bytes"] += nbytes
+        stats["rcu"] += rcu
+
+def scan_all_items(**kwargs):
+    items, resp = [], table.scan(ReturnConsumedCapacity="TOTAL", **kwargs)
+    _count_reads("score", resp, resp.get("Items", []))
+    items.extend(resp.get("Items", []))
+    while "LastEvaluatedKey" in resp:
+        resp = table.scan(ExclusiveStartKey=resp["LastEvaluatedKey"], ReturnConsumedCapacity="TOTAL", **kwargs)
+        _count_reads("score", resp, resp.get("Items", []))
+        items.extend(resp.get("Items", []))
+    return items
+
+def query_doc_items(doc_id, chunk_cond=None, **kwargs):
+    cond = Key("docId").eq(doc_id) if chunk_cond is None else Key("docId").eq(doc_id) & chunk_cond
+    resp = table.query(KeyConditionExpression=cond, ReturnConsumedCapacity="TOTAL", **kwargs)
+    _count_reads("score", resp, resp.get("Items", []))
+    items = resp.get("Items", [])
+    while "LastEvaluatedKey" in resp:
+        resp = table.query(KeyConditionExpression=cond,
+                           ExclusiveStartKey=resp["LastEvaluatedKey"], ReturnConsumedCapacity="TOTAL", **kwargs)
+        _count_reads("score", resp, resp.get("Items", []))
+        items.extend(resp.get("Items", []))
+    return items
+
+def load_manifest():
+    """→ ({docId: version}, {docId: source}) from the manifest partition."""
+    rows = query_doc_items(MANIFEST_DOC)
+    return {it["chunkId"]: int(it.get("version", 0)) for it in rows}, {it["chunkId"]: it.get("source") for it in rows}
+
+def searchable(vec):
+    """A stored vector can be scored: EMBED_DIM wide and not all zero."""
+    return vec is not None and vec.size == EMBED_DIM and bool(vec.any())
+
+def _row_meta(it):
+    # page may be Decimal from DynamoDB → cast to int when present; rows without it report the
+    # page of their chunkId, the one the "pages" filter matches on
+    page_val = it.get("page")
+    if not isinstance(page_val, (int, float, Decimal)):
+        page_val = chunk_page(it["chunkId"])
+    return {
+        "docId": it["docId"],
+        "chunkId": it["chunkId"],
+        "page": int(page_val) if page_val >= 0 else None,
+        "text": it.get("text",""),
+        "source": it.get("source")
+    }
+
+def _doc_block(items):
+    rows = [(it, v) for it, v in ((it, decode_vec(it)) for it in items) if v is not None and v.size]
+    mat = np.zeros((len(rows), EMBED_DIM), dtype=np.float32)
+    valid = np.zeros(len(rows), dtype=bool)
+    keys = []
+    for i, (it, vec) in enumerate(rows):
+        if vec.size == EMBED_DIM:
+            mat[i] = vec
+            valid[i] = True
+        keys.append((it["docId"], it["chunkId"]))
+    norms = np.linalg.norm(mat, axis=1)
+    valid &= norms > 0
+    mat[valid] /= norms[valid, None]
+    return {"mat": mat, "valid": valid, "keys": keys}
+
+class _RowBuffer:
+    """
+    Growable float32 matrix + valid mask + keys, filled one row at a time; capacity doubles.
+    Every segment is EMBED_DIM wide; a vector of another size keeps its key as an invalid row.
+    """
+
+    def __init__(self, capacity):
+        self.cap, self.n, self.dim, self.mismatched = max(16, capacity), 0, EMBED_DIM, 0
+        self.mat = self.valid = None
+        self.keys = []
+
+    def add(self, key, vec):
+        if self.mat is None:   # allocated on the first row: empty segments cost nothing
+            self.mat = np.zeros((self.cap, self.dim), dtype=np.float32)
+            self.valid = np.zeros(self.cap, dtype=bool)
+        if self.n == self.cap:
+            self.cap *= 2
+            mat = np.zeros((self.cap, self.dim), dtype=np.float32)
+            mat[:self.n] = self.mat[:self.n]
+            valid = np.zeros(self.cap, dtype=bool)
+            valid[:self.n] = self.valid[:self.n]
+            self.mat, self.valid = mat, valid
+        if vec.size == self.dim:
+            self.mat[self.n] = vec
+            self.valid[self.n] = True
+        else:
+            self.mismatched += 1
+        self.keys.append(key)
+        self.n += 1
+
+    def finish(self):
+        if self.mat is None:
+            return np.zeros((0, self.dim), dtype=np.float32), np.zeros(0, dtype=bool)
+        mat, valid = self.mat[:self.n], self.valid[:self.n]
+        norms = np.linalg.norm(mat, axis=1)
+        valid &= norms > 0
+        mat /= np.where(valid, norms, 1.0)[:, None]   # in place: no second copy of the segment
+        return mat, valid
+
+def _scan_segment(segment, total, capacity):
+    """One parallel-scan segment → (matrix, valid, keys, [[docId, start, end], ...] in scan order, mismatched)."""
+    buf, spans = _RowBuffer(capacity), []
+    kwargs = dict(SCORE_PROJECTION, Segment=segment, TotalSegments=total, ReturnConsumedCapacity="TOTAL")
+    resp = table.scan(**kwargs)
+    while True:
+        page = resp.get("Items", [])
+        _count_reads("score", resp, page)
+        for it in page:
+            vec = decode_vec(it)
+            if it["docId"] == MANIFEST_DOC or vec is None or not vec.size:
+                continue
+            if spans and spans[-1][0] == it["docId"]:
+                spans[-1][2] += 1
+            else:
+                spans.append([it["docId"], buf.n, buf.n + 1])
+            buf.add((it["docId"], it["chunkId"]), vec)
+        if "LastEvaluatedKey" not in resp:
+            break
+        resp = table.scan(ExclusiveStartKey=resp["LastEvaluatedKey"], **kwargs)
+    mat, valid = buf.finish()
+    return mat, valid, buf.keys, spans, buf.mismatched
+
+def _rebuild_index():
+    blocks = [b for b in _CORPUS["docs"].values() if b["keys"]]   # all EMBED_DIM wide
+    keys = [k for b in blocks for k in b["keys"]]
+    mat = np.concatenate([b["mat"] for b in blocks]) if blocks else np.zeros((0, EMBED_DIM), dtype=np.float32)
+    valid = np.concatenate([b["valid"] for b in blocks]) if blocks else np.zeros(0, dtype=bool)
+    off = 0
+    for b in blocks:
+        # re-point each block at its rows of the new index so older copies can be freed
+        n = len(b["keys"])
+        b["mat"], b["valid"] = mat[off:off + n], valid[off:off + n]
+        off += n
+    _INDEX.update(mat=mat, valid=valid, keys=keys, pages=None)
+
+def _full_load():
+    t0 = time.time()
+    # read the manifest first: a doc re-indexed during the scan is simply re-fetched next refresh
+    manifest = query_doc_items(MANIFEST_DOC)
+    versions = {it["chunkId"]: int(it.get("version", 0)) for it in manifest}
+    sources = {it["chunkId"]: it.get("source") for it in manifest}
+    expected = sum(int(it.get("chunks", 0)) for it in manifest)
+    segments = min(SCAN_SEGMENTS, max(1, expected // SCAN_ROWS_PER_SEGMENT)) if expected else SCAN_SEGMENTS
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        parts = list(pool.map(lambda seg: _scan_segment(seg, segments, expected // segments + 64), range(segments)))
+    docs, mismatched = {}, 0
+    for mat, valid, keys, spans, skipped in parts:
+        mismatched += skipped
+        for d, start, end in spans:
+            block = {"mat": mat[start:end], "valid": valid[start:end], "keys": keys[start:end]}
+            if d in docs:   # doc split across scan pages or segments: blocks share EMBED_DIM, so append
+                prev = docs[d]
+                block = {"mat": np.concatenate([prev["mat"], block["mat"]]),
+                         "valid": np.concatenate([prev["valid"], block["valid"]]),
+                         "keys": prev["keys"] + block["keys"]}
+            docs[d] = block
+    _CORPUS["docs"] = docs
+    _CORPUS["versions"], _CORPUS["sources"] = versions, sources
+    _CORPUS["loaded_at"] = _CORPUS["checked_at"] = time.time()
+    _rebuild_index()
+    if mismatched:
+        print(f"[IDE] corpus load: {mismatched} vectors are not {EMBED_DIM}-dim (EMBED_DIM); not searchable")
+    print(f"[IDE] corpus load: rows={len(_INDEX['keys'])} docs={len(docs)} segments={segments} "
+          f"in {(time.time() - t0) * 1000:.0f} ms")
+
+def _refresh():
+    versions, sources = load_manifest()
+    known = _CORPUS["versions"]
+    changed = [d for d, v in versions.items() if known.get(d) != v]
+    removed = [d for d in known if d not in versions]
+    for d in changed:
+        _CORPUS["docs"][d] = _doc_block(query_doc_items(d, **SCORE_PROJECTION))
+    for d in removed:
+        _CORPUS["docs"].pop(d, None)
+    _CORPUS["versions"], _CORPUS["sources"] = versions, sources
+    _CORPUS["checked_at"] = time.time()
+    if changed or removed:
+        _rebuild_index()
+    _CACHE_STATS["docs_refetched"] += len(changed)
+    return len(changed), len(removed)
+
+# A prefetch abandoned at ide-answer's budget keeps loading in the background; the lock makes the
+# next request wait for that load instead of starting a second one.
+_INDEX_LOCK = threading.Lock()
+
+def _get_index():
+    with _INDEX_LOCK:
+        now = time.time()
+        if _INDEX["mat"] is None or now - _CORPUS["loaded_at"] > INDEX_TTL:
+            _CACHE_STATS["miss"] += 1
+            _full_load()
+            state = "miss"
+        elif now - _CORPUS["checked_at"] > CORPUS_REFRESH:
+            _CACHE_STATS["refresh"] += 1
+            changed, removed = _refresh()
+            state = f"refresh(changed={changed} removed={removed})"
+        else:
+            _CACHE_STATS["hit"] += 1
+            state = "hit"
+    print(f"[IDE] corpus cache {state}: rows={len(_INDEX['keys'])} docs={len(_CORPUS['docs'])} "
+          f"hit={_CACHE_STATS['hit']} miss={_CACHE_STATS['miss']} refresh={_CACHE_STATS['refresh']} "
+          f"docs_refetched={_CACHE_STATS['docs_refetched']}")
+    return _INDEX
+
+def _top_k(qv, top_k):
+    """Phase 1 over the cached index → [(score, (docId, chunkId)), ...], best first."""
+    idx = _get_index()
+    mat, valid, keys = idx["mat"], idx["valid"], idx["keys"]
+    if min(max(top_k, 0), len(keys)) == 0:
+        return []
+
+    q = _query_unit(qv, mat.shape[1])
+    if q is None:
+        return []
+    scores = mat @ q
+    scores[~valid] = -np.inf   # dropped by _select
+    return _select(scores, keys, top_k)
+
+def _select(scores, keys, top_k):
+    """scores aligned with keys → the top_k [(score, key), ...], best first; -inf rows are never picked."""
+    n = len(keys)
+    k = min(max(top_k, 0), n)
+    if k == 0:
+        return []
+    # argpartition picks the k best in O(n); only those k are sorted (ties keep table order)
+    sel = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+    sel = sel[np.lexsort((sel, -scores[sel]))]
+    return [(float(scores[i]), keys[i]) for i in sel if scores[i] > -np.inf]
+
+def batch_get(table_name, keys, projection, names=None, phase="fetch"):
+    """BatchGetItem for [(docId, chunkId), ...] on any docId/chunkId table → {(docId, chunkId): item}."""
+    out = {}
+    for i in range(0, len(keys), 100):
+        spec = {"Keys": [{"docId": d, "chunkId": c} for d, c in keys[i:i + 100]], "ProjectionExpression": projection}
+        if names:
+            spec["ExpressionAttributeNames"] = names
+        request = {table_name: spec}
+        while request:
+            resp = ddb.batch_get_item(RequestItems=request, ReturnConsumedCapacity="TOTAL")
+            got = resp.get("Responses", {}).get(table_name, [])
+            _count_reads(phase, resp, got)
+            for it in got:
+                out[(it["docId"], it["chunkId"])] = it
+            request = resp.get("UnprocessedKeys") or None
+    return out
+
+def get_items(keys, extra=()):
+    """BatchGetItem for [(docId, chunkId), ...] → {(docId, chunkId): item} (text, page, source + extra)."""
+    return batch_get(table.name, keys, ", ".join(["docId, chunkId, page, #t, #src", *extra]),
+                     {"#t": "text", "#src": "source"})
+
+def hydrate(picked, extra=()):
+    """
+    Phase 2: [(score, (docId, chunkId)), ...] → hits with text, page and source, same order.
+    `extra` attributes (e.g. ide-answer's sentence index) are copied into each hit as stored.
+    """
+    items = get_items(list(dict.fromkeys(k for _, k in picked)), extra)
+    # chunks deleted since they were scored are simply dropped
+    return [{"score": s, **_row_meta(items[k]), **{a: items[k].get(a) for a in extra}}
+            for s, k in picked if k in items]
+
+# ---------- Request filters ----------
+# Optional "filters" in the request body, applied before scoring:
+#   {"doc_ids": ["<docId>", ...], "source_prefix": "s3://bucket/uploads/", "pages": [from, to]}
+# doc_ids / source_prefix (matched against the manifest's per-doc source) select whole per-doc
+# partitions; pages is an inclusive range (either end may be null) on the chunkId sort key
+# "<page:04d>#<chunk:06d>", so rows whose chunkId carries no page never match it. Only the
+# selected blocks of the in-memory index are scored; DDB_SCAN and ANN read just the selected
+# partitions with one DynamoDB Query per docId (the ANN snapshot has no per-doc partitions).
+def parse_filters(data):
+    """Request body → normalized filters (sorted, so they can be part of a cache key) or None."""
+    raw = data.get("filters") or {}
+    if not isinstance(raw, dict):
+        raise ValueError("filters must be an object")
+    flt = {}
+    if raw.get("doc_ids") is not None:
+        ids = raw["doc_ids"]
+        flt["doc_ids"] = sorted({str(d) for d in ([ids] if isinstance(ids, str) else ids)})
+    if raw.get("source_prefix"):
+        flt["source_prefix"] = str(raw["source_prefix"])
+    if raw.get("pages") is not None:
+        pages = raw["pages"]
+        lo, hi = (list(pages) + [None, None])[:2] if isinstance(pages, (list, tuple)) else (pages, pages)
+        flt["pages"] = [None if lo is None else int(lo), None if hi is None else int(hi)]
+    return flt or None
+
+def chunk_page(chunk_id):
+    head, sep, _ = str(chunk_id).partition("#")
+    return int(head) if sep and head.isdigit() else -1
+
+def filter_doc_ids(flt, sources):
+    """→ set of docIds allowed by doc_ids / source_prefix, or None when neither is set (every doc)."""
+    ids = set(flt["doc_ids"]) if "doc_ids" in flt else None
+    if "source_prefix" in flt:
+        matched = {d for d, src in sources.items() if (src or "").startswith(flt["source_prefix"])}
+        ids = matched if ids is None else ids & matched
+    return ids
+
+def _page_mask(part, pages):
+    # per-row page numbers, derived from the chunkIds once per block / index and kept with it
+    if part.get("pages") is None:
+        part["pages"] = np.fromiter((chunk_page(c) for _, c in part["keys"]), dtype=np.int32, count=len(part["keys"]))
+    lo, hi = pages
+    mask = part["pages"] >= max(lo or 0, 0)
+    if hi is not None:
+        mask &= part["pages"] <= hi
+    return mask
+
+def _page_condition(pages):
+    lo, hi = pages
+    return Key("chunkId").between(f"{max(lo or 0, 0):04d}#", f"{9999 if hi is None else hi:04d}#~")
+
+def _query_unit(qv, dim):
+    q = np.asarray(qv, dtype=np.float32)
+    qn = float(np.linalg.norm(q)) if q.ndim == 1 else 0.0
+    return q / qn if q.shape == (dim,) and qn else None
+
+def _top_k_filtered(qv, top_k, flt):
+    """Phase 1 over the filtered rows only: the selected per-doc blocks, or masked rows of the index."""
+    idx = _get_index()
+    ids = filter_doc_ids(flt, _CORPUS["sources"])
+    parts = [idx] if ids is None else [_CORPUS["docs"][d] for d in sorted(ids) if d in _CORPUS["docs"]]
+    q = _query_unit(qv, EMBED_DIM)
+    scores, keys = [], []
+    for part in parts if q is not None else []:
+        rows = part["valid"] & _page_mask(part, flt["pages"]) if "pages" in flt else part["valid"]
+        sel = np.flatnonzero(rows)
+        if sel.size:
+            scores.append(part["mat"][sel] @ q)
+            keys.extend(part["keys"][i] for i in sel)
+    print(f"[IDE] filtered scoring: rows={len(keys)} of {len(idx['keys'])} docs={len(parts)}")
+    return _select(np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32), keys, top_k)
+
+def _search_partitions(qv, top_k, flt, extra=()):
+    """Filtered retrieval straight from DynamoDB: one Query per selected docId (pages as a sort-key range)."""
+    sources = None
+    if "source_prefix" in flt or "doc_ids" not in flt:
+        sources = {it["chunkId"]: it.get("source") for it in query_doc_items(MANIFEST_DOC)}
+    ids = filter_doc_ids(flt, sources or {})
+    ids = sorted(sources if ids is None else ids)
+    cond = _page_condition(flt["pages"]) if "pages" in flt else None
+    workers = max(1, min(SCAN_SEGMENTS, len(ids)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(lambda d: _doc_block(query_doc_items(d, cond, **SCORE_PROJECTION)), ids))
+    q = _query_unit(qv, EMBED_DIM)
+    scores, keys = [], []
+    for part in parts if q is not None else []:
+        sel = np.flatnonzero(part["valid"])
+        if sel.size:
+            scores.append(part["mat"][sel] @ q)
+            keys.extend(part["keys"][i] for i in sel)
+    print(f"[IDE] partition scoring: rows={len(keys)} docs={len(ids)}")
+    return hydrate(_select(np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32), keys, top_k), extra)
+
+def _os_filter(flt):
+    clauses = []
+    if "doc_ids" in flt:
+        clauses.append({"terms": {"docId": flt["doc_ids"]}})
+    if "source_prefix" in flt:
+        clauses.append({"prefix": {"source": flt["source_prefix"]}})
+    if "pages" in flt:
+        lo, hi = flt["pages"]
+        clauses.append({"range": {"page": {k: v for k, v in (("gte", lo), ("lte", hi)) if v is not None}}})
+    return {"bool": {"filter": clauses}}
+
+# ---------- Retrieval backends (selected by SEARCH_BACKEND) ----------
+# Every backend takes (query vector, top_k, filters or None, extra attributes) and returns hits
+# shaped like _row_meta() + "score" (+ the extra attributes where the backend reads DynamoDB
+# items), best first. Scores are always exact cosine so MIN_SCORE-style thresholds mean the
+# same thing.
+def _search_memory(qv, top_k, flt=None, extra=()):
+    return hydrate(_top_k_filtered(qv, top_k, flt) if flt else _top_k(qv, top_k), extra)
+
+def _search_ddb_scan(qv, top_k, flt=None, extra=()):
+    if flt:
+        return _search_partitions(qv, top_k, flt, extra)
+    # Historical path: full (keys + vectors) table scan per request, pure-Python cosine
+    q = [float(x) for x in qv]
+    if _query_unit(qv, EMBED_DIM) is None:
+        return []
+    scored = []
+    for it in scan_all_items(**SCORE_PROJECTION):
+        vec = decode_vec(it)
+        if it["docId"] == MANIFEST_DOC or not searchable(vec):
+            continue
+        scored.append((float(cosine(q, vec.tolist())), (it["docId"], it["chunkId"])))
+    return hydrate(sorted(scored, key=lambda x: x[0], reverse=True)[:top_k], extra)
+
+# k-NN _score → cosine depends on the index's "vec" mapping, read once per container. Only
+# cosinesimil scores map back to exact cosine: lucene / faiss report (1 + cos) / 2, nmslib
+# 1 / (2 - cos). Any other space type (l2, innerproduct, ...) is refused rather than mis-scored.
+_OS_SCORE = {}
+
+def _os_score_to_cosine():
+    if "fn" not in _OS_SCORE:
+        mapping = _es("GET", f"/{_os_index}/_mapping") or {}
+        field = next(iter(mapping.values()), {}).get("mappings", {}).get("properties", {}).get("vec", {})
+        method = field.get("method", {})
+        space = method.get("space_type") or field.get("space_type") or "l2"   # l2 is OpenSearch's default
+        engine = method.get("engine", "")
+        if space != "cosinesimil":
+            raise RuntimeError(f"OpenSearch index {_os_index}: vec space_type={space}; "
+                               "only cosinesimil scores can be reported as cosine")
+        _OS_SCORE["fn"] = (lambda s: 2.0 - 1.0 / s if s else -1.0) if engine == "nmslib" else (lambda s: 2.0 * s - 1.0)
+        print(f"[IDE] OpenSearch index {_os_index}: space_type={space} engine={engine or 'default'}")
+    return _OS_SCORE["fn"]
+
+def _search_opensearch(qv, top_k, flt=None, extra=()):
+    to_cosine = _os_score_to_cosine()
+    knn = {"vector": [float(x) for x in qv], "k": max(top_k, OS_NUM_CANDIDATES)}
+    if flt:
+        knn["filter"] = _os_filter(flt)   # efficient k-NN filtering (lucene / faiss engines)
+    body = {
+        "size": top_k,
+        "_source": ["docId", "chunkId", "page", "text", "source"],   # never the vectors
+        "query": {"knn": {"vec": knn}}
+    }
+    resp = _es("POST", f"/{_os_index}/_search", body) or {}
+    hits, seen = [], set()
+    for h in resp.get("hits", {}).get("hits", []):
+        src = h.get("_source", {})
+        key = (src.get("docId"), src.get("chunkId"))
+        if key in seen:
+            continue   # Serverless: a re-embedded chunk's old copy can linger until its delete is visible
+        seen.add(key)
+        hits.append({"score": to_cosine(float(h.get("_score") or 0.0)), **_row_meta(src)})
+    return hits
+
+# ---------- ANN snapshot (SEARCH_BACKEND=ANN, built offline by ide-ann-build) ----------
+# The faiss index is downloaded to /tmp once per container and memory-mapped when the index
+# type allows it; the LATEST pointer is re-checked every ANN_CHECK_SECONDS. Chunks indexed
+# after the snapshot was built are not visible until the next build.
+_ANN = {"index": None, "keys": None, "version": None, "checked_at": 0.0}
+
+_ANN_LOCK = threading.Lock()   # same reason as _INDEX_LOCK
+
+def _load_ann():
+    with _ANN_LOCK:
+        return _load_ann_locked()
+
+def _load_ann_locked():
+    now = time.time()
+    if _ANN["index"] is not None and now - _ANN["checked_at"] < ANN_CHECK_SECONDS:
+        return _ANN
+    import faiss   # only needed by this backend (faiss-cpu layer)
+    latest = json.loads(s3.get_object(Bucket=ANN_BUCKET, Key=f"{ANN_PREFIX}LATEST.json")["Body"].read())
+    _ANN["checked_at"] = now
+    if latest["version"] == _ANN["version"]:
+        return _ANN
+    path = f"/tmp/ann-{latest['version']}.faiss"
+    if not os.path.exists(path):
+        s3.download_file(ANN_BUCKET, latest["prefix"] + "index.faiss", path)
+    try:
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        index = faiss.read_index(path)   # e.g. HNSW cannot be memory-mapped
+    params = faiss.ParameterSpace()
+    for knob, value in (("nprobe", ANN_NPROBE), ("efSearch", ANN_EF_SEARCH)):
+        try:
+            params.set_index_parameter(index, knob, value)
+        except RuntimeError:
+            pass   # knob does not apply to this index type
+    keys = json.loads(s3.get_object(Bucket=ANN_BUCKET, Key=latest["prefix"] + "keys.json")["Body"].read())
+    old = _ANN["version"]
+    _ANN.update(index=index, keys=keys, version=latest["version"])
+    if old and os.path.exists(f"/tmp/ann-{old}.faiss"):
+        os.remove(f"/tmp/ann-{old}.faiss")
+    print(f"[IDE] ANN snapshot loaded: version={latest['version']} index={latest.get('index')} rows={len(keys)}")
+    return _ANN
+
+def _search_ann(qv, top_k, flt=None, extra=()):
+    if flt:
+        return _search_partitions(qv, top_k, flt, extra)
+    ann = _load_ann()
+    q = np.asarray(qv, dtype=np.float32).reshape(1, -1)
+    qn = float(np.linalg.norm(q))
+    if not qn or q.shape[1] != ann["index"].d or top_k <= 0:
+        return []
+    scores, rows = ann["index"].search(q / qn, top_k)
+    # chunks deleted since the snapshot was built are dropped by hydrate()
+    return hydrate([(float(s), tuple(ann["keys"][r])) for s, r in zip(scores[0], rows[0]) if r >= 0], extra)
+
+_BACKENDS = {
+    "DDB":        _search_memory,     # in-memory index loaded from DynamoDB (default)
+    "MEMORY":     _search_memory,
+    "DDB_SCAN":   _search_ddb_scan,
+    "OPENSEARCH": _search_opensearch,
+    "ANN":        _search_ann,
+}
+
+def retrieve(qv, top_k, filters=None, extra=()):
+    """Query vector → top_k hits from SEARCH_BACKEND; `extra` item attributes ride along (see hydrate)."""
+    backend = _BACKENDS.get(SEARCH_BACKEND)
+    if backend is None:
+        raise RuntimeError(f"Unknown SEARCH_BACKEND={SEARCH_BACKEND}; expected one of {sorted(_BACKENDS)}")
+    for stats in _READS.values():
+        stats.update(items=0, bytes=0, rcu=0.0)
+    hits = backend(qv, top_k, filters, extra)
+    sc, fe = _READS["score"], _READS["fetch"]
+    print(f"[IDE] reads: score items={sc['items']} bytes={sc['bytes']} rcu={sc['rcu']:.1f} | "
+          f"fetch items={fe['items']} bytes={fe['bytes']} rcu={fe['rcu']:.1f}")
+    return hits
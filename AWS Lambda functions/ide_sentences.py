@@ -0,0 +1,56 @@
+# Sentence rules shared by the indexers (ide_indexing.sentence_index writes "sents") and
+# ide-answer (reads "sents", or splits chunks itself when an item has none / an older "sentVer").
+# Package this file with ide-embed-index, ide-ingest, ide-delete-doc and ide-answer (same zip,
+# or a layer under python/). Bump SENT_VERSION whenever the rules below change: ide-answer then
+# recomputes the sentences of items indexed with the older rules until they are re-indexed.
+
+import re, itertools
+
+SENT_VERSION = 1
+SENT_NOISE   = 1   # flag bit in "sents": is_heading_or_noise() was true for that sentence
+EXCLUDE_PREFIXES = ("contents","glossary","faq","ingredients","serves","prep","cook")
+
+def split_sentences(text):
+    return [s.strip() for s in re.split(r"(?<=[.!?])\s+", text or "") if s and s.strip()]
+
+def sentence_spans(text: str):
+    """(start, end) of every sentence, the same sentences split_sentences() gives."""
+    spans, start = [], 0
+    for m in itertools.chain(re.finditer(r"(?<=[.!?])\s+", text), [None]):
+        end = m.start() if m else len(text)
+        seg = text[start:end]
+        body = seg.strip()
+        if body:
+            lead = len(seg) - len(seg.lstrip())
+            spans.append((start + lead, start + lead + len(body)))
+        start = m.end() if m else end
+    return spans
+
+def is_heading_or_noise(s: str) -> bool:
+    ls = (s or "").lower().strip()
+
+    # obvious headings / sections
+    if any(ls.startswith(p) for p in EXCLUDE_PREFIXES):
+        return True
+
+    # drop question-only stubs like "Tips Too thin?"
+    if ls.endswith("?") and (ls.startswith("tips") or len(ls.split()) <= 4):
+        return True
+
+    # lines that contain section meta very early (e.g., "... Serves 4 Prep 10 ...")
+    if re.search(r"\b(serves|prep|cook|ingredients)\b", ls[:60] or ""):
+        return True
+
+    # enumerated section headers like "3) Weeknight Chicken Curry ..."
+    if re.match(r"^\d+\)\s+[A-Za-z]", ls or ""):
+        return True
+
+    # raw "Ingredients ..." lists or lines with lots of commas (likely ingredient enumerations)
+    if "ingredients" in ls or (ls.count(",") >= 6 and "tip" not in ls):
+        return True
+
+    # very short / formatting noise
+    if len(ls) < 5:
+        return True
+
+    return False
@@ -0,0 +1,65 @@
+"""
+Fixtures for the bench/test_*.py tests: the real Lambda files loaded through
+run_bench.load_lambda with every AWS client pointed at the stubs in stubs.py.
+
+    python -m pytest bench
+"""
+import os, io, json, contextlib
+import pytest
+
+import run_bench as rb
+from stubs import StubTable, StubDynamo, StubS3, StubBedrock, StubOpenSearchHttp
+
+
+class Stack:
+    """One table / bucket / OpenSearch / Bedrock set of stubs shared by the Lambdas a test loads."""
+    dim = 16
+    bucket = "ide-test"
+
+    def __init__(self):
+        self.table = StubTable("ide-rag")
+        self.ddb, self.s3 = StubDynamo(self.table), StubS3()
+        self.http, self.bedrock = StubOpenSearchHttp(), StubBedrock(self.dim)
+
+    def env(self, backend="DDB", llm=False, **extra):
+        rb._env(self.table.name, backend, llm, extra=[f"{k}={v}" for k, v in extra.items()], dim=self.dim)
+        os.environ["BUCKET"] = self.bucket
+
+    def load(self, filename):
+        return rb.load_lambda(filename, self.ddb, self.bedrock, self.s3, self.http)
+
+    def put_extracted(self, source_key, pages, key=None):
+        """Writes an ide-pages/1 document (one list of lines per page) for source_key; → its S3 key."""
+        key = key or f"extracted/2026/01/01/{source_key}.json"
+        header = {"format": "ide-pages/1", "source_bucket": self.bucket, "source_key": source_key,
+                  "page_count": len(pages)}
+        records = [header] + [{"page": p, "lines": lines} for p, lines in enumerate(pages, 1)]
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body="\n".join(json.dumps(r) for r in records) + "\n")
+        return key
+
+    def s3_event(self, key):
+        return {"Records": [{"s3": {"bucket": {"name": self.bucket}, "object": {"key": key.replace(" ", "+")}}}]}
+
+    def rows(self, doc_id):
+        return {c: it for (d, c), it in self.table.items.items() if d == doc_id}
+
+    def os_docs(self):
+        return self.http.indices.get("ide-rag", {})
+
+    @staticmethod
+    def quiet(fn, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn(*args, **kwargs)
+
+    @staticmethod
+    def pages(n, lines_per_page=6, topic="espresso machines"):
+        return [[f"Page {p} sentence {i} explains how {topic} heat water." for i in range(lines_per_page)]
+                for p in range(1, n + 1)]
+
+
+@pytest.fixture
+def stack():
+    saved = dict(os.environ)
+    yield Stack()
+    os.environ.clear()
+    os.environ.update(saved)
@@ -0,0 +1,408 @@
+"""
+Latency / memory benchmark for the ide-query (/search) and ide-answer (/answer) Lambdas.
+
+Builds a synthetic corpus of N chunks (random unit vectors + filler recipe text) in an
+in-process DynamoDB stand-in, loads the real Lambda modules from "AWS Lambda functions/"
+with their AWS clients swapped for the stubs in bench/stubs.py, and drives lambda_handler
+with API Gateway v2 events. Every (size, backend, handler) combination runs in its own
+subprocess so peak RSS is not shared between runs.
+
+Reported per run: cold (first request) latency, warm p50/p95/p99/mean latency,
+sequential throughput, peak RSS and the RSS of the corpus stand-in alone; for /answer
+also how many answers came from the vector vs the keyword sentence ranking (with --sent-vecs
+plus the sentence-vector store's reads; --compare against a run without --sent-vecs for what
+the rerank costs in latency), and with
+--stream the time to the first NDJSON event (citations + answer_raw), and with
+--paraphrases the exact / semantic answer-cache hit rates (plus the hit rate each
+candidate SEM_CACHE_THRESHOLD would have given). Synthetic
+text and random vectors say nothing about answer quality: compare the two rankings on
+test/ide-demo-queries.txt against real Bedrock for that.
+
+    python bench/run_bench.py                                   # 1k, 10k, 100k chunks
+    python bench/run_bench.py --sizes 1000000 --queries 50      # ~10 GB RAM at dim 1024
+    python bench/run_bench.py --backends DDB,DDB_SCAN --out bench_output.json
+    python bench/run_bench.py --compare old.json --out new.json
+    python bench/run_bench.py --ddb-ms 20 --env SCAN_SEGMENTS=1    # cold load vs scan parallelism
+    python bench/run_bench.py --handlers answer --no-sentence-index   # per-request sentence splitting
+    python bench/run_bench.py --handlers answer --sent-vecs --env SENT_MIN_SCORE=-1   # vector sentence rerank
+    python bench/run_bench.py --handlers answer --stream --llm-ms 800   # time to citations vs to the full answer
+    python bench/run_bench.py --handlers answer --paraphrases 0.3 --paraphrase-noise 0.5   # semantic cache
+    python bench/run_bench.py --filters '{"doc_ids": ["bench-doc-00001"], "pages": [1, 20]}'   # scoped retrieval
+
+Bedrock calls return immediately unless --embed-ms / --llm-ms add a fixed delay, so
+the numbers isolate the Lambdas' own retrieval and answer-building cost.
+"""
+import os, sys, json, time, argparse, platform, resource, subprocess, importlib.util, contextlib, io
+from datetime import datetime, timezone
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+LAMBDA_DIR = os.path.join(ROOT, "AWS Lambda functions")
+sys.path.insert(0, HERE)
+sys.path.insert(1, LAMBDA_DIR)   # shared modules packaged with the Lambdas (ide_indexing, ide_sentences)
+from stubs import StubTable, StubDynamo, StubBedrock, StubS3, StubOpenSearchHttp, StubResponseStream   # noqa: E402
+
+from boto3.dynamodb.types import Binary   # noqa: E402
+
+HANDLERS = {"query": "ide-query.py", "answer": "ide-answer.py"}
+SHARED_MODULES = ("ide_indexing", "ide_sentences", "ide_retrieval")
+MANIFEST_DOC = "__manifest__"
+BUCKET = "ide-bench"
+
+_WORDS = ("stir the sauce over low heat until it thickens slightly add a splash of stock "
+          "season with salt and pepper simmer gently for ten minutes freeze in portions "
+          "for up to three months whisk the eggs with milk and flour rest the batter "
+          "roast the vegetables until golden serve with rice or pasta and fresh herbs").split()
+
+# ---------- synthetic corpus ----------
+
+def _text(rng, chars):
+    out, n = [], 0
+    while n < chars:
+        words = rng.choice(_WORDS, size=int(rng.integers(8, 18)))
+        s = " ".join(words).capitalize() + "."
+        out.append(s)
+        n += len(s) + 1
+    return " ".join(out)
+
+def build_corpus(table, n, dim, vec_format="f32", chunks_per_doc=200, chunks_per_page=4,
+                 text_chars=700, seed=0, row_attrs=None, sent_table=None, sent_row=None):
+    """
+    Fills `table` with n chunk rows + per-doc manifest rows; returns the normalized vectors.
+    `row_attrs(text)` adds the indexers' per-text attributes (sentence index, sentence-vector
+    marker); `sent_row(text)` is the text's sentence-vector store row, written to `sent_table`.
+    """
+    rng = np.random.default_rng(seed)
+    vecs = np.empty((n, dim), dtype=np.float32)
+    texts = [_text(rng, text_chars) for _ in range(64)]   # reused: text content does not affect scoring cost
+    sents = [{k: Binary(v) if isinstance(v, bytes) else v for k, v in row_attrs(t).items()}
+             for t in texts] if row_attrs else [{}] * len(texts)
+    sent_rows = [{k: Binary(v) if isinstance(v, bytes) else v for k, v in sent_row(t).items()}
+                 for t in texts] if sent_table is not None else None
+    dtype = {"f32": "<f4", "f16": "<f2"}.get(vec_format)
+    for start in range(0, n, 10_000):
+        block = rng.standard_normal((min(10_000, n - start), dim)).astype(np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        vecs[start:start + len(block)] = block
+
+    docs = {}
+    for i in range(n):
+        d, c = divmod(i, chunks_per_doc)
+        doc_id = f"bench-doc-{d:05d}"
+        page = c // chunks_per_page + 1
+        item = {
+            "docId": doc_id,
+            "chunkId": f"{page:04d}#{c % chunks_per_page:06d}",
+            "page": page,
+            "text": texts[i % len(texts)],
+            "source": f"s3://{BUCKET}/uploads/{doc_id}.pdf",
+            **sents[i % len(texts)],
+        }
+        if dtype:
+            item["vec"] = Binary(vecs[i].astype(dtype).tobytes())
+            item["vecFmt"] = vec_format
+        else:
+            item["vec"] = [float(x) for x in vecs[i]]
+        table.items[(item["docId"], item["chunkId"])] = item
+        if sent_rows:
+            sent_table.items[(item["docId"], item["chunkId"])] = {"docId": doc_id, "chunkId": item["chunkId"],
+                                                                  **sent_rows[i % len(texts)]}
+        docs[doc_id] = docs.get(doc_id, 0) + 1
+    for doc_id, chunks in docs.items():
+        table.items[(MANIFEST_DOC, doc_id)] = {"docId": MANIFEST_DOC, "chunkId": doc_id, "version": 1,
+                                               "chunks": chunks, "source": f"s3://{BUCKET}/uploads/{doc_id}.pdf"}
+    return vecs
+
+def make_queries(vecs, count, seed=1, noise=0.3):
+    """Query texts mapped to perturbed corpus vectors, so every query has a true nearest neighbour."""
+    base = []
+    with open(os.path.join(ROOT, "test", "ide-demo-queries.txt"), encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.strip()
+            if ln.startswith("{"):
+                base.append(json.loads(ln)["query"])
+    rng = np.random.default_rng(seed)
+    out = {}
+    for i in range(count):
+        v = vecs[rng.integers(len(vecs))] + noise * rng.standard_normal(vecs.shape[1]).astype(np.float32) / np.sqrt(vecs.shape[1])
+        out[f"{base[i % len(base)]} (#{i})"] = (v / np.linalg.norm(v)).astype(np.float32)
+    return out
+
+def add_paraphrases(queries, share, noise, seed=2):
+    """
+    Re-asks a `share` of the warm queries as near-duplicates of an earlier one: new text, the
+    earlier vector plus noise (noise 0.3 ≈ cosine 0.96, 0.5 ≈ 0.89, 1.0 ≈ 0.71 at any dim).
+    """
+    rng = np.random.default_rng(seed)
+    texts, out = list(queries), dict(queries)
+    order = texts[:2]
+    for i, q in enumerate(texts[2:], 2):
+        if rng.random() < share:
+            src = texts[1 + rng.integers(i - 1)]   # never the cold query
+            v = queries[src] + noise * rng.standard_normal(len(queries[src])).astype(np.float32) / np.sqrt(len(queries[src]))
+            q = f"{src} (paraphrase #{i})"
+            out[q] = (v / np.linalg.norm(v)).astype(np.float32)
+        order.append(q)
+    return out, order
+
+# ---------- Lambda loading ----------
+
+def _env(table_name, backend, llm, extra=(), dim=None):
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_DEFAULT_REGION": "eu-west-2",
+        "TABLE_NAME": table_name, "BEDROCK_REGION": "eu-west-2",
+        "SEARCH_BACKEND": backend, "QA_LLM_ENABLE": "true" if llm else "false",
+        "OS_ENDPOINT": "http://bench-opensearch.local", "OS_SIGV4_SERVICE": "none",
+        "ANN_BUCKET": BUCKET, "ANN_PREFIX": "ann/",
+    })
+    os.environ.pop("EMBED_CACHE_TABLE", None)
+    if dim:
+        os.environ["EMBED_DIM"] = str(dim)
+    os.environ.update(kv.split("=", 1) for kv in extra)
+
+def load_lambda(filename, ddb, bedrock, s3, http=None):
+    """Imports a Lambda file under a fresh module name and points its AWS clients at the stubs."""
+    name = "bench_" + filename.replace("-", "_").replace(".py", "")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(LAMBDA_DIR, filename))
+    mod = importlib.util.module_from_spec(spec)
+    for shared in SHARED_MODULES:   # re-import so they read this run's environment
+        sys.modules.pop(shared, None)
+    spec.loader.exec_module(mod)
+    for m in (mod, sys.modules.get("ide_indexing"), sys.modules.get("ide_retrieval")):
+        if m is None:
+            continue
+        m.ddb, m.table, m.bedrock = ddb, ddb.Table(os.environ["TABLE_NAME"]), bedrock
+        if hasattr(m, "bedrock_llm"):
+            m.bedrock_llm = bedrock
+        if s3 is not None:
+            m.s3 = s3
+        if http is not None:
+            m._http = http
+        m.cache_table = None
+    return mod
+
+def _seed_opensearch(http, table):
+    idx = http.indices.setdefault("ide-rag", {})
+    http.mappings["ide-rag"] = http.COSINE_MAPPING
+    for (doc_id, chunk_id), it in table.items.items():
+        if doc_id == MANIFEST_DOC:
+            continue
+        raw = it["vec"].value if isinstance(it["vec"], Binary) else None
+        vec = np.frombuffer(raw, dtype={"f16": "<f2"}.get(it.get("vecFmt"), "<f4")) if raw else it["vec"]
+        idx[f"{doc_id}|{chunk_id}"] = {"docId": doc_id, "chunkId": chunk_id, "page": it["page"],
+                                       "text": it["text"], "source": it["source"],
+                                       "vec": [float(x) for x in vec]}
+
+def _build_ann(ddb, s3):
+    os.environ.update({"ANN_KIND": "ivf", "ANN_EVAL_QUERIES": "50"})
+    builder = load_lambda("ide-ann-build.py", ddb, None, s3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        builder.lambda_handler({}, None)
+
+# ---------- one run (subprocess) ----------
+
+def _rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _pct(xs, p):
+    return round(float(np.percentile(xs, p)), 3) if xs else None
+
+def run_one(size, backend, handler, args):
+    table = StubTable("ide-rag", latency_ms=args.ddb_ms)
+    sent_table = StubTable("ide-rag-sentvecs", latency_ms=args.ddb_ms) if args.sent_vecs else None
+    ddb, s3 = StubDynamo(*(t for t in (table, sent_table) if t is not None)), StubS3()
+    extra = [*args.env, *([f"SENT_VEC_TABLE={sent_table.name}"] if sent_table else [])]
+    _env(table.name, backend, llm=args.llm_ms >= 0, extra=extra, dim=args.dim)
+    load_lambda("ide-embed-index.py", ddb, None, s3)
+    indexer, sent_bedrock = sys.modules["ide_indexing"], StubBedrock(args.dim)
+
+    def row_attrs(text):
+        attrs = {} if args.no_sentence_index else indexer.sentence_index(text)
+        if args.sent_vecs:
+            attrs.update(embHash=indexer.emb_hash(text), sentEmb=indexer.MODEL_ID)
+        return attrs
+
+    def sent_row(text):
+        vecs = [sent_bedrock.vector(s) for s in indexer.usable_sentences(text)]
+        return {"embHash": indexer.emb_hash(text), **indexer.encode_sent_vecs(vecs)}
+
+    t0 = time.perf_counter()
+    vecs = build_corpus(table, size, args.dim, args.vec_format, seed=args.seed, row_attrs=row_attrs,
+                        sent_table=sent_table, sent_row=sent_row)
+    build_s = time.perf_counter() - t0
+    queries = make_queries(vecs, args.queries + 1, seed=args.seed + 1)
+    texts = list(queries)
+    if args.paraphrases > 0:
+        queries, texts = add_paraphrases(queries, args.paraphrases, args.paraphrase_noise, seed=args.seed + 2)
+    del vecs
+    corpus_rss = _rss_mb()
+
+    bedrock = StubBedrock(args.dim, queries, embed_ms=args.embed_ms, llm_ms=args.llm_ms)
+    http = None
+    if backend == "OPENSEARCH":
+        http = StubOpenSearchHttp()
+        _seed_opensearch(http, table)
+    if backend == "ANN":
+        _build_ann(ddb, s3)
+    mod = load_lambda(HANDLERS[handler], ddb, bedrock, s3, http)
+
+    stream = args.stream and handler == "answer"
+    lat, first, errors = [], [], 0
+    sink = io.StringIO()
+    for i, q in enumerate(texts):
+        event = {"requestContext": {"http": {"method": "POST"}},
+                 "body": json.dumps({"query": q, "top_k": args.top_k, "filters": args.filters})}
+        t = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            if stream:
+                out = StubResponseStream()
+                mod.stream_handler(event, out, None)
+                ok = bool(out.writes) and out.events()[-1].get("type") == "done"
+                first.append((out.writes[0][0] + (out.t0 - t) * 1000) if out.writes else 0.0)
+            else:
+                ok = mod.lambda_handler(event, None).get("statusCode") == 200
+        ms = (time.perf_counter() - t) * 1000
+        if not ok:
+            errors += 1
+        lat.append(ms)
+        sink.seek(0)
+        sink.truncate()
+    cold, warm = lat[0], lat[1:]
+    return {
+        "size": size, "backend": backend, "handler": handler, "dim": args.dim, "vec_format": args.vec_format,
+        "queries": len(warm), "errors": errors, "filters": args.filters,
+        "cold_ms": round(cold, 3),
+        "p50_ms": _pct(warm, 50), "p95_ms": _pct(warm, 95), "p99_ms": _pct(warm, 99),
+        "mean_ms": round(float(np.mean(warm)), 3) if warm else None,
+        "qps": round(len(warm) / (sum(warm) / 1000), 2) if warm else None,
+        "peak_rss_mb": _rss_mb(), "corpus_rss_mb": corpus_rss,
+        "corpus_build_s": round(build_s, 2),
+        "ddb_calls": dict(table.calls), "bedrock_calls": dict(bedrock.calls),
+        "sentence_ranking": dict(getattr(mod, "_SENT_STATS", {})),
+        **({"sent_vec_calls": dict(sent_table.calls)} if sent_table is not None else {}),
+        **({"answer_cache": dict(mod._ACACHE_STATS), "semantic_cache": _sem_report(mod._SEM_STATS)}
+           if handler == "answer" else {}),
+        **({"first_event_p50_ms": _pct(first[1:], 50), "first_event_p95_ms": _pct(first[1:], 95)} if stream else {}),
+    }
+
+def _sem_report(stats):
+    lookups = stats["hit"] + stats["miss"]
+    return {"hit": stats["hit"], "miss": stats["miss"],
+            "would_hit_ratio": {str(t): round(n / lookups, 3) if lookups else None
+                                for t, n in stats["would_hit"].items()}}
+
+# ---------- driver ----------
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+_COMPARED = ("cold_ms", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb")
+
+def compare(old_path, new):
+    with open(old_path, encoding="utf-8") as f:
+        old = {(r["size"], r["backend"], r["handler"]): r for r in json.load(f)["results"]}
+    print(f"\nvs {old_path}:")
+    for r in new["results"]:
+        o = old.get((r["size"], r["backend"], r["handler"]))
+        if not o:
+            continue
+        deltas = []
+        for m in _COMPARED:
+            if o.get(m) and r.get(m) is not None:
+                deltas.append(f"{m} {o[m]}→{r[m]} ({(r[m] - o[m]) / o[m] * 100:+.0f}%)")
+        print(f"  {r['handler']:6} {r['backend']:10} n={r['size']:<8} " + ", ".join(deltas))
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--sizes", default="1000,10000,100000", help="comma-separated corpus sizes (chunks)")
+    ap.add_argument("--backends", default="DDB", help="comma-separated SEARCH_BACKEND values")
+    ap.add_argument("--handlers", default="query,answer", help="comma-separated: query, answer")
+    ap.add_argument("--queries", type=int, default=100, help="warm requests per run (plus one cold)")
+    ap.add_argument("--dim", type=int, default=1024)
+    ap.add_argument("--vec-format", default="f32", choices=["f32", "f16", "decimal"])
+    ap.add_argument("--top-k", type=int, default=5)
+    ap.add_argument("--embed-ms", type=float, default=0.0, help="simulated Bedrock embedding latency")
+    ap.add_argument("--llm-ms", type=float, default=-1.0,
+                    help="simulated polish latency; negative disables QA_LLM_ENABLE")
+    ap.add_argument("--ddb-ms", type=float, default=0.0, help="simulated DynamoDB latency per scan/query page")
+    ap.add_argument("--no-sentence-index", action="store_true",
+                    help="corpus rows without the stored sentence index (ide-answer splits per request)")
+    ap.add_argument("--stream", action="store_true",
+                    help="drive ide-answer's stream_handler and also report time to the first NDJSON event")
+    ap.add_argument("--sent-vecs", action="store_true",
+                    help="SENT_EMBED sentence vectors in a SENT_VEC_TABLE store (ide-answer reranks sentences by "
+                         "vector); reports the store reads, --compare against a run without it for latency")
+    ap.add_argument("--paraphrases", type=float, default=0.0,
+                    help="share of warm /answer requests that re-ask an earlier question in other words")
+    ap.add_argument("--paraphrase-noise", type=float, default=0.3,
+                    help="vector noise of a paraphrase (0.3 ≈ cosine 0.96 to the original)")
+    ap.add_argument("--filters", type=json.loads, default=None, metavar="JSON",
+                    help="request filters sent with every query (bench docIds are bench-doc-00000, ..., "
+                         "200 chunks / 50 pages each)")
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                    help="extra Lambda environment variable (repeatable), e.g. --env SCAN_SEGMENTS=4")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="write results JSON here (default: stdout only)")
+    ap.add_argument("--compare", help="previous results JSON to diff against")
+    ap.add_argument("--worker", help=argparse.SUPPRESS)   # "size,backend,handler": run one combination in-process
+    args = ap.parse_args()
+
+    if args.worker:
+        size, backend, handler = args.worker.split(",")
+        print(json.dumps(run_one(int(size), backend, handler, args)))
+        return
+
+    passthrough = _strip_values(sys.argv[1:], ("--out", "--compare", "--sizes", "--backends", "--handlers"))
+    results = []
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        for backend in [b.strip().upper() for b in args.backends.split(",") if b.strip()]:
+            for handler in [h.strip() for h in args.handlers.split(",") if h.strip()]:
+                cmd = [sys.executable, os.path.abspath(__file__), "--worker", f"{size},{backend},{handler}", *passthrough]
+                proc = subprocess.run(cmd, capture_output=True, text=True)
+                if proc.returncode != 0:
+                    print(f"[bench] {handler}/{backend}/n={size} failed:\n{proc.stderr[-2000:]}", file=sys.stderr)
+                    continue
+                r = json.loads(proc.stdout.strip().splitlines()[-1])
+                results.append(r)
+                print(f"[bench] {handler:6} {backend:10} n={size:<8} cold={r['cold_ms']:.1f}ms "
+                      f"p50={r['p50_ms']:.2f} p95={r['p95_ms']:.2f} p99={r['p99_ms']:.2f}ms "
+                      f"qps={r['qps']} rss={r['peak_rss_mb']}MB", file=sys.stderr)
+
+    out = {
+        "meta": {"git": _git_rev(), "python": platform.python_version(), "numpy": np.__version__,
+                 "machine": platform.machine(), "cpus": os.cpu_count(),
+                 "at": datetime.now(timezone.utc).isoformat(), "args": vars(args)},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+    else:
+        print(json.dumps(out, indent=2))
+    if args.compare:
+        compare(args.compare, out)
+
+def _strip_values(argv, flags):
+    """argv minus the driver-only flags (both "--flag value" and "--flag=value" forms)."""
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = False
+            continue
+        if a in flags:
+            skip = True
+            continue
+        if a.split("=", 1)[0] in flags:
+            continue
+        out.append(a)
+    return out
+
+if __name__ == "__main__":
+    main()
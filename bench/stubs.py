@@ -0,0 +1,524 @@
+"""
+In-process stand-ins for the AWS services the Lambdas talk to, used by run_bench.py.
+
+They implement only the calls (and call shapes) made by the functions in
+"AWS Lambda functions/", backed by plain dicts and NumPy arrays so that large
+synthetic corpora stay cheap to hold in memory. The bench/test_*.py tests run
+the indexers and ide-answer against them too.
+"""
+import io, json, time, hashlib
+from datetime import datetime, timezone
+import botocore.exceptions
+import numpy as np
+
+
+class _Body(io.BytesIO):
+    """Minimal botocore StreamingBody."""
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            c = self.read(chunk_size)
+            if not c:
+                return
+            yield c
+
+    def iter_lines(self, chunk_size=1024, keepends=False):
+        for ln in self:
+            yield ln if keepends else ln.rstrip(b"\r\n")
+
+
+def _client_error(code, op):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, op)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _key_value(cond):
+    # boto3.dynamodb.conditions.Key("docId").eq(x) → x
+    return cond.get_expression()["values"][1]
+
+
+def _key_conditions(cond):
+    # Key("docId").eq(x) [& Key("chunkId").between(lo, hi)] → (x, (lo, hi) or None)
+    expr = cond.get_expression()
+    if expr["operator"] != "AND":
+        return _key_value(cond), None
+    eq, rng = expr["values"]
+    return _key_value(eq), tuple(rng.get_expression()["values"][1:3])
+
+
+def _os_match(doc, flt):
+    # the bool/filter clauses ide-query / ide-answer send (terms docId, prefix source, range page)
+    # and _OsBulk's _delete_by_query (term docId + terms chunkId)
+    for c in flt.get("bool", {}).get("filter", []):
+        if "term" in c and any(doc.get(f) != v for f, v in c["term"].items()):
+            return False
+        if "terms" in c and any(doc.get(f) not in v for f, v in c["terms"].items()):
+            return False
+        if "prefix" in c and not (doc.get("source") or "").startswith(c["prefix"]["source"]):
+            return False
+        if "range" in c:
+            r, page = c["range"]["page"], doc.get("page")
+            if page is None or page < r.get("gte", page) or page > r.get("lte", page):
+                return False
+    return True
+
+
+class StubTable:
+    """DynamoDB Table: put/get/delete/scan/query with paging, projections and parallel scan segments."""
+
+    def __init__(self, name="ide-rag", page_bytes=1 << 20, latency_ms=0.0):
+        self.name = name
+        self.items = {}           # (docId, chunkId) -> item
+        self.page_bytes = page_bytes
+        self.latency_ms = latency_ms   # simulated round trip per scan/query page and BatchGetItem
+        self.calls = {"scan": 0, "query": 0, "get_item": 0, "put_item": 0, "batch_get": 0}
+        self._sorted = None
+
+    # -- writes --
+    def put_item(self, Item, **kw):
+        self.calls["put_item"] += 1
+        self.items[(Item["docId"], Item["chunkId"])] = dict(Item)
+        self._sorted = None
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kw):
+        self._check(self.items.get((Key["docId"], Key["chunkId"])) or {}, ConditionExpression,
+                    ExpressionAttributeNames or {}, ExpressionAttributeValues or {}, "DeleteItem")
+        self.items.pop((Key["docId"], Key["chunkId"]), None)
+        self._sorted = None
+
+    def batch_writer(self, **kw):
+        table = self
+
+        class _BW:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *a):
+                return False
+
+            def put_item(self, Item):
+                table.put_item(Item=Item)
+
+            def delete_item(self, Key):
+                table.delete_item(Key=Key)
+        return _BW()
+
+    @staticmethod
+    def _check(it, expr, names, values, op):
+        """Conditions "a = :v", "a < :v", "attribute_exists(a)", "attribute_not_exists(a)",
+        joined by AND / OR (AND binds tighter); raises ConditionalCheckFailedException."""
+        if not expr:
+            return
+
+        def term(cond):
+            cond = cond.strip()
+            for fn, want in (("attribute_not_exists(", False), ("attribute_exists(", True)):
+                if cond.startswith(fn):
+                    return (names.get(cond[len(fn):-1], cond[len(fn):-1]) in it) == want
+            op_ = "<" if "<" in cond else "="
+            a, v = (x.strip() for x in cond.split(op_))
+            cur = it.get(names.get(a, a))
+            return cur is not None and (cur < values[v] if op_ == "<" else cur == values[v])
+        if not any(all(term(c) for c in alt.split(" AND ")) for alt in expr.split(" OR ")):
+            raise _client_error("ConditionalCheckFailedException", op)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ConditionExpression=None, ReturnValues="NONE", **kw):
+        """Subset of UpdateItem: SET a = :v / SET m.k = :v, ADD a :n, DELETE set :s, REMOVE a;
+        conditions as in _check()."""
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        key = (Key["docId"], Key["chunkId"])
+        it = dict(self.items.get(key) or Key)
+        path = lambda p: [names.get(x, x) for x in p.strip().split(".")]
+        self._check(it, ConditionExpression, names, values, "UpdateItem")
+        clauses, cur = {}, None
+        for tok in UpdateExpression.replace(",", " , ").split():
+            if tok in ("SET", "ADD", "DELETE", "REMOVE"):
+                cur = clauses.setdefault(tok, [[]])
+            elif tok == ",":
+                cur.append([])
+            else:
+                cur[-1].append(tok)
+        for a in clauses.get("SET", []):
+            *p, v = [x for x in a if x != "="]
+            *parents, leaf = path(p[0])
+            target = it
+            for x in parents:
+                target = target[x]
+            target[leaf] = values[v]
+        for a, v in clauses.get("ADD", []):
+            (name,) = path(a)
+            val = values[v]
+            it[name] = (it.get(name, set()) | val) if isinstance(val, set) else it.get(name, 0) + val
+        for a, v in clauses.get("DELETE", []):
+            (name,) = path(a)
+            remaining = set(it.get(name, set())) - values[v]
+            if remaining:
+                it[name] = remaining
+            else:
+                it.pop(name, None)   # DynamoDB drops empty sets
+        for (a,) in clauses.get("REMOVE", []):
+            it.pop(path(a)[0], None)
+        self.items[key] = it
+        self._sorted = None
+        return {"Attributes": dict(it)} if ReturnValues == "ALL_NEW" else {}
+
+    # -- reads --
+    def get_item(self, Key, **kw):
+        self.calls["get_item"] += 1
+        it = self.items.get((Key["docId"], Key["chunkId"]))
+        return {"Item": dict(it)} if it else {}
+
+    def _keys(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.items)
+        return self._sorted
+
+    @staticmethod
+    def project(it, expr, names=None):
+        if not expr:
+            return dict(it)
+        names = names or {}
+        out = {}
+        for a in expr.split(","):
+            a = names.get(a.strip(), a.strip())
+            if a in it:
+                out[a] = it[a]
+        return out
+
+    @staticmethod
+    def _size(it):
+        n = 0
+        for k, v in it.items():
+            if isinstance(v, (bytes, bytearray)):
+                n += len(v)
+            elif hasattr(v, "value") and isinstance(v.value, bytes):
+                n += len(v.value)
+            elif isinstance(v, list):
+                n += 8 * len(v)
+            else:
+                n += len(str(v))
+            n += len(k)
+        return n
+
+    def _page(self, keys, start, expr, names, limit):
+        time.sleep(self.latency_ms / 1000)
+        out, used, i = [], 0, start
+        while i < len(keys):
+            it = self.items[keys[i]]
+            used += self._size(it)
+            out.append(self.project(it, expr, names))
+            i += 1
+            if used >= self.page_bytes or (limit and len(out) >= limit):
+                break
+        resp = {"Items": out, "Count": len(out), "ScannedCount": len(out),
+                "ConsumedCapacity": {"TableName": self.name, "CapacityUnits": used / 8192}}
+        if i < len(keys):
+            last = keys[i - 1]
+            resp["LastEvaluatedKey"] = {"docId": last[0], "chunkId": last[1]}
+        return resp
+
+    def scan(self, ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+             Segment=None, TotalSegments=None, Limit=None, **kw):
+        self.calls["scan"] += 1
+        keys = self._keys()
+        if TotalSegments:
+            keys = keys[Segment::TotalSegments]
+        start = 0
+        if ExclusiveStartKey:
+            start = keys.index((ExclusiveStartKey["docId"], ExclusiveStartKey["chunkId"])) + 1
+        return self._page(keys, start, ProjectionExpression, ExpressionAttributeNames, Limit)
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, ProjectionExpression=None,
+              ExpressionAttributeNames=None, Limit=None, **kw):
+        self.calls["query"] += 1
+        doc, rng = _key_conditions(KeyConditionExpression)
+        keys = [k for k in self._keys() if k[0] == doc and (rng is None or rng[0] <= k[1] <= rng[1])]
+        start = 0
+        if ExclusiveStartKey:
+            start = keys.index((ExclusiveStartKey["docId"], ExclusiveStartKey["chunkId"])) + 1
+        return self._page(keys, start, ProjectionExpression, ExpressionAttributeNames, Limit)
+
+
+class StubDynamo:
+    """DynamoDB service resource: Table() plus the batch_* actions."""
+
+    def __init__(self, *tables):
+        self.tables = {t.name: t for t in tables}
+        self.unprocessed = 0   # next N batch_write_item calls hand their last request back (throttling)
+
+    def Table(self, name):
+        return self.tables.setdefault(name, StubTable(name))
+
+    def batch_write_item(self, RequestItems, **kw):
+        left = {}
+        for name, reqs in RequestItems.items():
+            t = self.Table(name)
+            if self.unprocessed:
+                self.unprocessed -= 1
+                reqs, left[name] = reqs[:-1], reqs[-1:]
+            for r in reqs:
+                if "PutRequest" in r:
+                    t.put_item(Item=r["PutRequest"]["Item"])
+                else:
+                    t.delete_item(Key=r["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": left}
+
+    def batch_get_item(self, RequestItems, **kw):
+        out, consumed = {}, []
+        for name, spec in RequestItems.items():
+            t = self.Table(name)
+            t.calls["batch_get"] += 1
+            if t.latency_ms:
+                time.sleep(t.latency_ms / 1000)
+            got = []
+            for k in spec["Keys"]:
+                it = t.items.get((k["docId"], k["chunkId"]))
+                if it:
+                    got.append(t.project(it, spec.get("ProjectionExpression"), spec.get("ExpressionAttributeNames")))
+            out[name] = got
+            consumed.append({"TableName": name, "CapacityUnits": float(len(spec["Keys"]))})
+        return {"Responses": out, "UnprocessedKeys": {}, "ConsumedCapacity": consumed}
+
+
+class StubBedrock:
+    """
+    bedrock-runtime: Titan embeddings and Titan Text. Query texts registered through
+    `queries` embed to a fixed vector (e.g. a perturbed corpus vector); anything else
+    gets a deterministic pseudo-random unit vector.
+    """
+
+    def __init__(self, dim, queries=None, embed_ms=0.0, llm_ms=0.0):
+        self.dim, self.queries = dim, queries or {}
+        self.embed_ms, self.llm_ms = embed_ms, llm_ms
+        self.calls = {"embed": 0, "text": 0}
+
+    def vector(self, text):
+        if text in self.queries:
+            return self.queries[text]
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        v = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return v / np.linalg.norm(v)
+
+    def invoke_model(self, modelId, body, **kw):
+        req = json.loads(body)
+        if modelId.startswith("amazon.titan-embed"):
+            self.calls["embed"] += 1
+            time.sleep(self.embed_ms / 1000)
+            out = {"embedding": [float(x) for x in self.vector(req["inputText"])]}
+        else:
+            self.calls["text"] += 1
+            time.sleep(self.llm_ms / 1000)
+            out = {"results": [{"outputText": "Summary: Benchmark answer.\n- Point one\n- Point two"}]}
+        return {"body": _Body(json.dumps(out).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kw):
+        """Titan Text style event stream: the canned answer in a few chunks, llm_ms spread across them."""
+        self.calls["text"] += 1
+        pieces = ["Summary: Benchmark", " answer.\n- Point", " one\n- Point", " two"]
+
+        def events():
+            for p in pieces:
+                time.sleep(self.llm_ms / 1000 / len(pieces))
+                yield {"chunk": {"bytes": json.dumps({"outputText": p, "index": 0}).encode("utf-8")}}
+        return {"body": events(), "contentType": "application/json"}
+
+
+class StubResponseStream:
+    """Writable response stream handed to a streaming handler; records when each write happened."""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.writes = []   # (ms since creation, bytes)
+
+    def write(self, data):
+        self.writes.append(((time.perf_counter() - self.t0) * 1000, bytes(data)))
+
+    def events(self):
+        return [json.loads(ln) for _, d in self.writes for ln in d.decode("utf-8").splitlines() if ln.strip()]
+
+
+class StubS3:
+    """Objects plus the headers they were written with (ContentType, ContentEncoding, ...)."""
+
+    def __init__(self):
+        self.objects = {}
+        self.headers = {}     # (bucket, key) -> put / multipart kwargs
+        self.modified = {}    # (bucket, key) -> LastModified (tests may set it to order objects)
+        self.uploads = {}     # upload id -> (bucket, key, kwargs, {part number: bytes})
+
+    def put_object(self, Bucket, Key, Body, **kw):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        self.headers[(Bucket, Key)] = kw
+        self.modified[(Bucket, Key)] = _now()
+        return {}
+
+    def get_object(self, Bucket, Key, **kw):
+        return {"Body": _Body(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key, **kw):
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("404", "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)]),
+                "LastModified": self.modified.get((Bucket, Key)) or _now(),
+                **self.headers.get((Bucket, Key), {})}
+
+    def create_multipart_upload(self, Bucket, Key, **kw):
+        upload_id = f"upload-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = (Bucket, Key, kw, {})
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kw):
+        self.uploads[UploadId][3][PartNumber] = bytes(Body)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kw):
+        bucket, key, headers, parts = self.uploads.pop(UploadId)
+        self.objects[(bucket, key)] = b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+        self.headers[(bucket, key)] = headers
+        self.modified[(bucket, key)] = _now()
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kw):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kw):
+        gone = [o for o in Delete["Objects"] if self.objects.pop((Bucket, o["Key"]), None) is not None]
+        for o in gone:
+            self.modified.pop((Bucket, o["Key"]), None)
+        return {"Deleted": gone}
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix="", **kw):
+        keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), 1000):
+            yield {"Contents": [{"Key": k, "Size": len(self.objects[(Bucket, k)]),
+                                 "LastModified": self.modified.get((Bucket, k)) or _now()}
+                                for k in keys[i:i + 1000]]}
+
+    def upload_file(self, path, Bucket, Key):
+        with open(path, "rb") as f:
+            self.objects[(Bucket, Key)] = f.read()
+        self.modified[(Bucket, Key)] = _now()
+
+    def download_file(self, Bucket, Key, path):
+        with open(path, "wb") as f:
+            f.write(self.objects[(Bucket, Key)])
+
+
+class StubTextract:
+    """
+    get_document_text_detection for finished jobs, {job id: [[line, ...] per page]}, paginated
+    `page_size` blocks per response; unknown job ids raise InvalidJobIdException.
+    """
+
+    def __init__(self, jobs=None, page_size=4):
+        self.jobs, self.page_size = jobs or {}, page_size
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        if JobId not in self.jobs:
+            raise _client_error("InvalidJobIdException", "GetDocumentTextDetection")
+        pages = self.jobs[JobId]
+        blocks = [{"BlockType": "PAGE", "Page": p} for p in range(1, len(pages) + 1)]
+        blocks += [{"BlockType": "LINE", "Page": p, "Text": ln} for p, lines in enumerate(pages, 1) for ln in lines]
+        blocks.sort(key=lambda b: b["Page"])
+        start = int(NextToken or 0)
+        resp = {"DocumentMetadata": {"Pages": len(pages)}, "Blocks": blocks[start:start + self.page_size]}
+        if start + self.page_size < len(blocks):
+            resp["NextToken"] = str(start + self.page_size)
+        return resp
+
+
+class StubOpenSearchHttp:
+    """
+    Stand-in for the urllib3 pool behind _es(): handles index creation, GET _mapping, _bulk (with
+    or without _id, as on Serverless), _delete_by_query and k-NN _search (exact, brute force, scored
+    like the mapping's cosinesimil engine) so SEARCH_BACKEND=OPENSEARCH can run locally.
+    """
+    COSINE_MAPPING = {"properties": {"vec": {"type": "knn_vector", "method": {
+        "name": "hnsw", "space_type": "cosinesimil", "engine": "lucene"}}}}
+
+    class _Resp:
+        def __init__(self, status, obj=None):
+            self.status = status
+            self.data = json.dumps(obj).encode("utf-8") if obj is not None else b""
+            self.headers = {"content-type": "application/json"}
+
+    def __init__(self):
+        self.indices = {}   # name -> {_id: doc}
+        self.mappings = {}  # name -> "mappings" body of the PUT that created it
+        self._mats = {}     # name -> (docs, normalized matrix), dropped on every write
+        self._next_id = 0
+
+    def request(self, method, url, body=None, headers=None):
+        path = url.split("://", 1)[-1].split("/", 1)[1].split("?", 1)[0]
+        parts = path.split("/")
+        if method == "HEAD":
+            return self._Resp(200 if parts[0] in self.indices else 404)
+        if method == "PUT":
+            if parts[0] in self.indices:
+                return self._Resp(400, {"error": "resource_already_exists_exception"})
+            self.indices[parts[0]] = {}
+            self.mappings[parts[0]] = json.loads(body).get("mappings", {}) if body else {}
+            return self._Resp(200, {"acknowledged": True})
+        if method == "GET" and len(parts) > 1 and parts[1] == "_mapping":
+            if parts[0] not in self.indices:
+                return self._Resp(404, {"error": "index_not_found_exception"})
+            return self._Resp(200, {parts[0]: {"mappings": self.mappings.get(parts[0], {})}})
+        if parts[0] == "_bulk":
+            self._mats.clear()
+            lines, items, i = body.decode("utf-8").strip().split("\n"), [], 0
+            while i < len(lines):
+                op, meta = next(iter(json.loads(lines[i]).items()))
+                idx = self.indices.setdefault(meta["_index"], {})
+                if op == "index":
+                    if "_id" not in meta:
+                        self._next_id += 1
+                    idx[meta.get("_id", f"auto-{self._next_id}")] = json.loads(lines[i + 1])
+                    items.append({"index": {"status": 201}})
+                    i += 2
+                else:
+                    found = idx.pop(meta["_id"], None) is not None
+                    items.append({"delete": {"status": 200 if found else 404,
+                                             "result": "deleted" if found else "not_found"}})
+                    i += 1
+            return self._Resp(200, {"errors": False, "items": items})
+        if len(parts) > 1 and parts[1] == "_delete_by_query":
+            if parts[0] not in self.indices:
+                return self._Resp(404, {"error": "index_not_found_exception"})
+            self._mats.clear()
+            idx, should = self.indices[parts[0]], json.loads(body)["query"]["bool"]["should"]
+            doomed = [i for i, d in idx.items() if any(_os_match(d, c) for c in should)]
+            for i in doomed:
+                del idx[i]
+            return self._Resp(200, {"deleted": len(doomed), "failures": []})
+        if len(parts) > 1 and parts[1] == "_search":
+            req = json.loads(body)
+            q = np.asarray(req["query"]["knn"]["vec"]["vector"], dtype=np.float32)
+            if parts[0] not in self._mats:
+                docs = list(self.indices.get(parts[0], {}).values())
+                mat = np.asarray([d["vec"] for d in docs], dtype=np.float32).reshape(len(docs), -1)
+                mat /= np.linalg.norm(mat, axis=1, keepdims=True) + 1e-12
+                self._mats[parts[0]] = (docs, mat)
+            docs, mat = self._mats[parts[0]]
+            if not docs:
+                return self._Resp(200, {"hits": {"hits": []}})
+            sims = mat @ (q / (np.linalg.norm(q) + 1e-12))
+            flt = req["query"]["knn"]["vec"].get("filter")
+            if flt:
+                sims = np.where([_os_match(d, flt) for d in docs], sims, -np.inf)
+            order = [i for i in np.argsort(-sims)[:req.get("size", 10)] if np.isfinite(sims[i])]
+            fields = req.get("_source")
+            project = (lambda d: {k: d[k] for k in fields if k in d}) if isinstance(fields, list) else dict
+            method = self.mappings.get(parts[0], {}).get("properties", {}).get("vec", {}).get("method", {})
+            score = (lambda c: 1 / (2 - c)) if method.get("engine") == "nmslib" else (lambda c: (1 + c) / 2)
+            return self._Resp(200, {"hits": {"hits": [
+                {"_score": float(score(sims[i])), "_source": project(docs[i])} for i in order]}})
+        return self._Resp(400, {"error": f"unsupported {method} {path}"})
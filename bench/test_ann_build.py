@@ -0,0 +1,23 @@
+"""ide-ann-build's load_vectors: segmented scan into one preallocated, normalized matrix."""
+import numpy as np
+from boto3.dynamodb.types import Binary
+
+import run_bench as rb
+
+
+def test_load_vectors_skips_other_dims_and_zero_rows(stack):
+    vecs = rb.build_corpus(stack.table, 300, stack.dim, "f32", chunks_per_doc=100)
+    items = stack.table.items
+    items[("bench-doc-00000", "0001#000000")]["vec"] = Binary(np.ones(8, dtype="<f4").tobytes())
+    items[("bench-doc-00001", "0001#000000")]["vec"] = Binary(np.zeros(stack.dim, dtype="<f4").tobytes())
+    stack.env(ANN_BUCKET=stack.bucket, SCAN_SEGMENTS="3")
+    mat, keys = stack.quiet(stack.load("ide-ann-build.py").load_vectors)
+
+    assert mat.shape == (298, stack.dim) and mat.dtype == np.float32 and len(keys) == 298
+    assert ["bench-doc-00000", "0001#000000"] not in keys and ["bench-doc-00001", "0001#000000"] not in keys
+    assert np.allclose(np.linalg.norm(mat, axis=1), 1.0, atol=1e-5)
+    row = {tuple(k): i for i, k in enumerate(keys)}
+    for i in (1, 150, 299):
+        d, c = divmod(i, 100)
+        key = (f"bench-doc-{d:05d}", f"{c // 4 + 1:04d}#{c % 4:06d}")
+        assert np.allclose(mat[row[key]], vecs[i], atol=1e-6)
@@ -0,0 +1,74 @@
+"""ide-answer's caches: the key covers every setting that shapes an answer, not just the question;
+the semantic tier reuses an answer only above SEM_CACHE_THRESHOLD."""
+import json
+
+import numpy as np
+import pytest
+
+import run_bench as rb
+
+QUERY = "How long should the sauce simmer?"
+
+
+def answer_lambda(stack, **env):
+    rb.build_corpus(stack.table, 400, stack.dim, "f32", chunks_per_doc=100)
+    stack.env(llm=True, **env)
+    return stack.load("ide-answer.py")
+
+
+def ask(stack, mod):
+    ev = {"requestContext": {"http": {"method": "POST"}}, "body": json.dumps({"query": QUERY, "debug": True})}
+    resp = stack.quiet(mod.lambda_handler, ev, None)
+    assert resp["statusCode"] == 200
+    return json.loads(resp["body"])
+
+
+@pytest.mark.parametrize("name,value", [
+    ("MAX_SNIPPETS", 1), ("MAX_ANSWER", 80), ("SENT_RERANK", True), ("SENT_MIN_SCORE", 0.9),
+    ("SENT_VERSION", 99), ("QA_LLM_TEMP", 0.9), ("QA_LLM_MAXTOK", 50), ("EMBED_DIM", 32),
+    ("OS_NUM_CANDIDATES", 7), ("ANN_NPROBE", 1), ("ANN_EF_SEARCH", 1),
+])
+def test_each_setting_changes_the_key(stack, name, value):
+    mod = answer_lambda(stack)
+    before = mod.answer_settings_key(5, "v1")
+    setattr(mod, name, value)
+    assert mod.answer_settings_key(5, "v1") != before
+
+
+def test_polish_settings_ignored_when_polish_is_off(stack):
+    mod = answer_lambda(stack)
+    mod.QA_LLM_ENABLE = False
+    before = mod.answer_settings_key(5, "v1")
+    mod.QA_LLM_TEMP, mod.QA_LLM_MAXTOK = 0.9, 50
+    assert mod.answer_settings_key(5, "v1") == before
+
+
+def test_changed_snippet_cap_misses_the_cache(stack):
+    mod = answer_lambda(stack)
+    ask(stack, mod)
+    assert ask(stack, mod)["debug"]["cache"] != "miss"
+    mod.MAX_SNIPPETS = 1
+    assert ask(stack, mod)["debug"]["cache"] == "miss"
+
+
+def _rotated(v, cos, seed):
+    """Unit vector at cosine `cos` to unit vector v."""
+    u = np.random.default_rng(seed).standard_normal(v.size).astype(np.float32)
+    u -= (u @ v) * v
+    u /= np.linalg.norm(u)
+    return cos * v + np.sqrt(1 - cos * cos) * u
+
+
+@pytest.mark.parametrize("cos,reused", [(0.97, True), (0.93, True), (0.90, False), (0.5, False)])
+def test_semantic_cache_reuses_answers_above_the_threshold(stack, cos, reused):
+    mod = answer_lambda(stack, SEM_CACHE_THRESHOLD=0.92)
+    base = stack.bedrock.vector(QUERY)
+    paraphrase = "How long does the sauce need to simmer?"
+    stack.bedrock.queries[paraphrase] = _rotated(base, cos, seed=3)
+    first = ask(stack, mod)
+    ev = {"requestContext": {"http": {"method": "POST"}}, "body": json.dumps({"query": paraphrase, "debug": True})}
+    body = json.loads(stack.quiet(mod.lambda_handler, ev, None)["body"])
+    assert body["debug"]["semantic"]["similarity"] == pytest.approx(cos, abs=1e-4)
+    assert (body["debug"]["cache"] == "semantic") == reused
+    if reused:
+        assert body["answer_md"] == first["answer_md"] and body["debug"]["semantic"]["matched_query"] == QUERY
@@ -0,0 +1,65 @@
+"""ide-extracted-reconcile: the source → extracted-keys manifest rebuilt from a listing of extracted/."""
+from datetime import datetime, timedelta, timezone
+
+T0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+OLD = "extracted/2026/01/01/uploads/Coffee Guide-0a1b2c3d.pdf.json"
+NEW = "extracted/2026/01/02/uploads/Coffee Guide-4e5f6a7b.pdf.json"
+GONE = "extracted/2026/01/03/uploads/Coffee Guide-8c9d0e1f.pdf.json"
+
+
+def ms(days):
+    return int((T0 + timedelta(days=days)).timestamp() * 1000)
+
+
+def put(stack, key, days):
+    stack.s3.put_object(Bucket=stack.bucket, Key=key, Body="{}")
+    stack.s3.modified[(stack.bucket, key)] = T0 + timedelta(days=days)
+
+
+def manifest(stack):
+    return {c: it for (d, c), it in stack.table.items.items() if d == "__extracted__"}
+
+
+def reconcile(stack, **env):
+    stack.env(**env)
+    mod = stack.load("ide-extracted-reconcile.py")
+    return stack.quiet(mod.lambda_handler, {}, None)
+
+
+def test_backfills_merges_and_drops_stale_rows(stack):
+    put(stack, OLD, 0)
+    put(stack, NEW, 1)
+    put(stack, "extracted/2026/01/01/uploads/Menu.pdf.json", 0)
+    put(stack, "extracted/notes.txt", 0)   # not extracted output: skipped
+    stack.table.put_item(Item={"docId": "__extracted__", "chunkId": "uploads/Coffee Guide.pdf",
+                               "keys": {OLD, GONE}, "latest": GONE, "latestAt": ms(2)})
+    stack.table.put_item(Item={"docId": "__extracted__", "chunkId": "uploads/Removed.pdf",
+                               "keys": {"extracted/2025/12/01/uploads/Removed.pdf.json"}})
+
+    out = reconcile(stack)
+    assert (out["sources"], out["objects"], out["staleDeleted"]) == (2, 3, 1)
+    rows = manifest(stack)
+    assert set(rows) == {"uploads/Coffee Guide.pdf", "uploads/Menu.pdf"}
+    coffee = rows["uploads/Coffee Guide.pdf"]
+    # the hand-deleted latest is replaced by the newest listed object
+    assert coffee["keys"] == {OLD, NEW} and coffee["latest"] == NEW
+    assert rows["uploads/Menu.pdf"]["latest"] == "extracted/2026/01/01/uploads/Menu.pdf.json"
+
+
+def test_never_moves_latest_back_to_an_older_object(stack):
+    put(stack, OLD, 0)
+    put(stack, NEW, 1)
+    reconcile(stack)
+    stack.s3.modified[(stack.bucket, NEW)] = T0 - timedelta(days=1)   # listing now says NEW is older
+    stack.table.update_item(Key={"docId": "__extracted__", "chunkId": "uploads/Coffee Guide.pdf"},
+                            UpdateExpression="SET #at = :at", ExpressionAttributeNames={"#at": "latestAt"},
+                            ExpressionAttributeValues={":at": ms(5)})   # a newer callback write
+    reconcile(stack)
+    row = manifest(stack)["uploads/Coffee Guide.pdf"]
+    assert row["latest"] == NEW and row["latestAt"] == ms(5) and row["keys"] == {OLD, NEW}
+
+
+def test_dry_run_writes_nothing(stack):
+    put(stack, OLD, 0)
+    out = reconcile(stack, DRY_RUN="true")
+    assert out["dryRun"] and out["updates"] == 0 and not manifest(stack)
@@ -0,0 +1,111 @@
+"""Request filters and bad input on /search and /answer: the same rows and errors on every path."""
+import json
+
+import numpy as np
+import pytest
+from boto3.dynamodb.types import Binary
+
+import run_bench as rb
+
+BAD_DIM = ("bench-doc-00000", "0001#000001")
+ZERO = ("bench-doc-00000", "0001#000002")
+NO_PAGE = ("bench-doc-00000", "0002#000000")
+
+
+@pytest.fixture
+def corpus(stack):
+    """200 rows in 2 docs; one row with an 8-dim vector, one all-zero, one without a "page" attribute."""
+    stack.vecs = rb.build_corpus(stack.table, 200, stack.dim, "f32", chunks_per_doc=100)
+    items = stack.table.items
+    items[BAD_DIM]["vec"] = Binary(np.ones(8, dtype="<f4").tobytes())
+    items[ZERO]["vec"] = Binary(np.zeros(stack.dim, dtype="<f4").tobytes())
+    del items[NO_PAGE]["page"]
+    return stack
+
+
+def search(stack, backend, filters=None, top_k=200):
+    stack.env(backend)
+    query = stack.load("ide-query.py")
+    return stack.quiet(query.retrieve, stack.vecs[0], top_k, query.parse_filters({"filters": filters}))
+
+
+@pytest.mark.parametrize("backend", ["DDB", "DDB_SCAN"])
+@pytest.mark.parametrize("filters", [None, {"doc_ids": ["bench-doc-00000"]}, {"pages": [1, 2]}])
+def test_unsearchable_rows_are_never_returned(corpus, backend, filters):
+    keys = {(h["docId"], h["chunkId"]) for h in search(corpus, backend, filters)}
+    assert keys and not keys & {BAD_DIM, ZERO}
+
+
+@pytest.mark.parametrize("backend", ["DDB", "DDB_SCAN"])
+def test_row_without_page_reports_its_chunk_page(corpus, backend):
+    for filters in (None, {"pages": [2, 2]}):
+        hit = next(h for h in search(corpus, backend, filters) if (h["docId"], h["chunkId"]) == NO_PAGE)
+        assert hit["page"] == 2
+
+
+@pytest.mark.parametrize("backend", ["DDB", "DDB_SCAN"])
+def test_query_vector_of_another_size_returns_nothing(corpus, backend):
+    corpus.env(backend)
+    query = corpus.load("ide-query.py")
+    assert corpus.quiet(query.retrieve, np.ones(8), 5) == []
+    assert corpus.quiet(query.retrieve, np.ones(8), 5, {"doc_ids": ["bench-doc-00000"]}) == []
+
+
+@pytest.mark.parametrize("body,error", [
+    ({"filters": {"pages": "all"}}, "Invalid filters"),
+    ({"filters": ["bench-doc-00000"]}, "Invalid filters"),
+    ({"top_k": "five"}, "top_k must be an integer"),
+])
+def test_console_and_http_reject_bad_input_alike(corpus, body, error):
+    corpus.env()
+    query = corpus.load("ide-query.py")
+    console = corpus.quiet(query.lambda_handler, {"query": "water", **body}, None)
+    http = corpus.quiet(query.lambda_handler, {"requestContext": {"http": {"method": "POST"}},
+                                               "body": json.dumps({"query": "water", **body})}, None)
+    assert console["error"].startswith(error)
+    assert http["statusCode"] == 400 and json.loads(http["body"]) == console
+    answer = corpus.load("ide-answer.py")
+    resp = corpus.quiet(answer.lambda_handler, {"requestContext": {"http": {"method": "POST"}},
+                                                "body": json.dumps({"query": "water", **body})}, None)
+    assert resp["statusCode"] == 400 and json.loads(resp["body"])["error"].startswith(error)
+
+
+def test_parse_filters_normalizes_and_rejects(corpus):
+    corpus.env()
+    query = corpus.load("ide-query.py")
+    assert query.parse_filters({}) is None and query.parse_filters({"filters": {}}) is None
+    assert query.parse_filters({"filters": {"doc_ids": "b", "pages": 3}}) == {"doc_ids": ["b"], "pages": [3, 3]}
+    assert query.parse_filters({"filters": {"doc_ids": ["b", "a", "b"], "pages": [2], "source_prefix": "s3://x/"}}) \
+        == {"doc_ids": ["a", "b"], "pages": [2, None], "source_prefix": "s3://x/"}
+    for bad in ({"filters": {"pages": ["x"]}}, {"filters": "bench-doc-00000"}):
+        with pytest.raises(ValueError):
+            query.parse_filters(bad)
+
+
+def brute_force(stack, flt):
+    """Keys of the valid rows the filters select, best first against stack.vecs[0]."""
+    q = stack.vecs[0]
+    rows = []
+    for (doc, chunk), it in stack.table.items.items():
+        if doc == rb.MANIFEST_DOC or (doc, chunk) in (BAD_DIM, ZERO):
+            continue
+        page = int(chunk.split("#")[0])
+        lo, hi = flt.get("pages", [None, None])
+        if (doc not in flt.get("doc_ids", [doc]) or not it["source"].startswith(flt.get("source_prefix", ""))
+                or (lo is not None and page < lo) or (hi is not None and page > hi)):
+            continue
+        rows.append((float(np.frombuffer(it["vec"].value, dtype="<f4") @ q), (doc, chunk)))
+    return [k for _, k in sorted(rows, key=lambda r: -r[0])]
+
+
+@pytest.mark.parametrize("backend", ["DDB", "DDB_SCAN"])
+@pytest.mark.parametrize("filters", [
+    {"doc_ids": ["bench-doc-00001"]},
+    {"pages": [3, 5]},
+    {"source_prefix": f"s3://{rb.BUCKET}/uploads/bench-doc-00000"},
+    {"doc_ids": ["bench-doc-00000", "bench-doc-00001"], "pages": [None, 2]},
+    {"doc_ids": ["no-such-doc"]},
+])
+def test_filtered_search_matches_brute_force(corpus, backend, filters):
+    hits = search(corpus, backend, filters, top_k=10)
+    assert [(h["docId"], h["chunkId"]) for h in hits] == brute_force(corpus, filters)[:10]
@@ -0,0 +1,89 @@
+"""ide_indexing: diff-based index_pages (chunk numbering, kept / re-embedded / deleted chunks),
+the batch writer and key-only deletes."""
+import sys
+
+import pytest
+
+DOC_ID = "Coffee-Guide"
+SOURCE_URI = "s3://ide-test/uploads/Coffee Guide.pdf"
+
+
+def indexer(stack):
+    stack.env()
+    stack.load("ide-embed-index.py")
+    return sys.modules["ide_indexing"]
+
+
+def page_objs(pages):
+    return [{"page": p, "lines": lines} for p, lines in enumerate(pages, 1)]
+
+
+def test_one_page_edit_rewrites_only_that_page(stack):
+    idx = indexer(stack)
+    pages = stack.pages(5, lines_per_page=30)   # ~3 chunks per page
+    stack.quiet(idx.index_pages, page_objs(pages), DOC_ID, SOURCE_URI)
+    before = dict(stack.rows(DOC_ID))
+    assert len({c.split("#")[0] for c in before}) == 5 and len(before) > 5
+
+    pages[1] = [f"New paragraph line {i} about descaling the boiler." for i in range(20)] + pages[1]
+    stats = stack.quiet(idx.index_pages, page_objs(pages), DOC_ID, SOURCE_URI)
+    after = stack.rows(DOC_ID)
+
+    page2 = {c for c in after if c.startswith("0002#")}
+    assert stats["indexed"] == len(page2) and stats["kept"] == len(after) - len(page2)
+    assert len(page2) > len({c for c in before if c.startswith("0002#")})   # page two grew a chunk
+    assert stats["deleted"] == 0
+    for c, it in after.items():
+        if not c.startswith("0002#"):
+            assert it is before[c]   # never rewritten
+
+
+def test_reindex_keeps_unchanged_and_deletes_vanished_chunks(stack):
+    idx = indexer(stack)
+    pages = stack.pages(4, lines_per_page=30)
+    first = stack.quiet(idx.index_pages, page_objs(pages), DOC_ID, SOURCE_URI)
+    n, embeds = len(stack.rows(DOC_ID)), stack.bedrock.calls["embed"]
+    assert first == {"indexed": n, "kept": 0, "deleted": 0}
+
+    assert stack.quiet(idx.index_pages, page_objs(pages), DOC_ID, SOURCE_URI) == {"indexed": 0, "kept": n, "deleted": 0}
+    assert stack.bedrock.calls["embed"] == embeds   # nothing re-embedded
+
+    gone = {c for c in stack.rows(DOC_ID) if c.startswith("0004#")}
+    stats = stack.quiet(idx.index_pages, page_objs(pages[:3]), DOC_ID, SOURCE_URI)
+    assert stats == {"indexed": 0, "kept": n - len(gone), "deleted": len(gone)}
+    assert not gone & set(stack.rows(DOC_ID))
+
+    moved = stack.quiet(idx.index_pages, page_objs(pages[:3]), DOC_ID, "s3://ide-test/uploads/renamed.pdf")
+    assert moved["indexed"] == n - len(gone) and moved["kept"] == 0   # new source: every row is rewritten
+    assert stack.bedrock.calls["embed"] == embeds   # ... from the embedding cache
+
+
+def test_batch_writer_retries_unprocessed_items(stack):
+    idx = indexer(stack)
+    stack.ddb.unprocessed = 3
+    with idx._BatchWriter("test") as bw:
+        for i in range(60):
+            bw.put({"docId": DOC_ID, "chunkId": f"0001#{i:06d}"})
+    assert len(stack.rows(DOC_ID)) == 60
+    assert (bw.items, bw.retried, bw.requests) == (60, 3, 6)   # 3 batches, each sent twice
+
+
+def test_batch_writer_gives_up_after_write_max_retries(stack):
+    stack.env(WRITE_MAX_RETRIES=1)
+    stack.load("ide-embed-index.py")
+    idx = sys.modules["ide_indexing"]
+    stack.ddb.unprocessed = 2
+    with pytest.raises(RuntimeError, match="1 unprocessed items after 1 retries"):
+        with idx._BatchWriter("test") as bw:
+            bw.put({"docId": DOC_ID, "chunkId": "0001#000000"})
+
+
+def test_deletes_read_keys_only(stack):
+    idx = indexer(stack)
+    stack.quiet(idx.index_pages, page_objs(stack.pages(3, lines_per_page=30)), DOC_ID, SOURCE_URI)
+    pages = list(idx.iter_doc_keys(DOC_ID))
+    assert sum(len(p) for p in pages) == len(stack.rows(DOC_ID))
+    assert all(set(k) == {"docId", "chunkId"} for p in pages for k in p)
+
+    resp = stack.quiet(stack.load("ide-delete-doc.py").lambda_handler, {"docId": DOC_ID}, None)
+    assert resp["statusCode"] == 200 and not stack.rows(DOC_ID)
@@ -0,0 +1,103 @@
+"""OpenSearch dual-write (ide-embed-index / ide-ingest), delete (ide-delete-doc) and k-NN search."""
+import json
+import sys
+import numpy as np
+import pytest
+
+SOURCE = "uploads/Coffee Guide.pdf"
+DOC_ID = "Coffee-Guide"
+
+
+@pytest.fixture(params=["none", "aoss"])
+def indexed(request, stack):
+    """Coffee Guide indexed by ide-embed-index with OS_DUAL_WRITE=true; OS_SIGV4_SERVICE per param."""
+    stack.env(OS_DUAL_WRITE="true", OS_SIGV4_SERVICE=request.param)
+    stack.key = stack.put_extracted(SOURCE, stack.pages(4))
+    stack.quiet(stack.load("ide-embed-index.py").lambda_handler, stack.s3_event(stack.key), None)
+    stack.sigv4 = request.param
+    return stack
+
+
+def os_keys(stack):
+    return sorted((d["docId"], d["chunkId"]) for d in stack.os_docs().values())
+
+
+def test_dual_write_mirrors_every_row(indexed):
+    rows = indexed.rows(DOC_ID)
+    assert len(rows) == 4
+    assert os_keys(indexed) == sorted((DOC_ID, c) for c in rows)
+    for _id, doc in indexed.os_docs().items():
+        row = rows[doc["chunkId"]]
+        assert (doc["page"], doc["text"], doc["source"]) == (row["page"], row["text"], row["source"])
+        assert len(doc["vec"]) == indexed.dim
+        if indexed.sigv4 == "aoss":
+            assert "|" not in _id   # Serverless: generated ids only
+        else:
+            assert _id == f"{DOC_ID}|{doc['chunkId']}"
+
+
+def test_reindex_replaces_changed_chunks_without_duplicates(indexed):
+    pages = indexed.pages(4)
+    pages[1] = ["Descaling the boiler keeps the steam wand clean."]
+    pages = pages[:3]   # the last page is gone
+    indexed.put_extracted(SOURCE, pages, key=indexed.key)
+    indexed.table.put_item(Item={"docId": "__extracted__", "chunkId": SOURCE, "latest": indexed.key,
+                                 "keys": {indexed.key}})
+    ingest = indexed.load("ide-ingest.py")
+    ingest.BUCKET = indexed.bucket
+    resp = indexed.quiet(ingest.lambda_handler, {"source": f"s3://{indexed.bucket}/{SOURCE}"}, None)
+    assert json.loads(resp["body"])["indexed"] == 1 and json.loads(resp["body"])["deleted"] == 1
+    assert os_keys(indexed) == sorted((DOC_ID, c) for c in indexed.rows(DOC_ID))
+    assert [d["text"] for d in indexed.os_docs().values() if d["page"] == 2] == \
+        ["Descaling the boiler keeps the steam wand clean."]
+
+
+def test_delete_doc_removes_rows_and_documents(indexed):
+    indexed.table.put_item(Item={"docId": "__extracted__", "chunkId": SOURCE, "keys": {indexed.key}})
+    resp = indexed.quiet(indexed.load("ide-delete-doc.py").lambda_handler, {"docId": DOC_ID}, None)
+    body = json.loads(resp["body"])
+    assert (body["ddbDeleted"], body["osDeleted"], body["s3ExtractedDeleted"]) == (4, 4, 1)
+    assert indexed.rows(DOC_ID) == {} and indexed.os_docs() == {}
+    assert ("__manifest__", DOC_ID) not in indexed.table.items
+
+
+def test_search_returns_exact_cosine_without_vectors(indexed):
+    indexed.env("OPENSEARCH", OS_SIGV4_SERVICE=indexed.sigv4)
+    query = indexed.load("ide-query.py")
+    qv = indexed.bedrock.vector("how is the water heated")
+    hits = indexed.quiet(query.retrieve, qv, 3)
+    assert len(hits) == 3 and all("vec" not in h for h in hits)
+    for h in hits:
+        doc = next(d for d in indexed.os_docs().values() if d["chunkId"] == h["chunkId"])
+        v = np.asarray(doc["vec"])
+        assert h["score"] == pytest.approx(float(v @ qv / np.linalg.norm(v)), abs=1e-5)
+    assert [h["score"] for h in hits] == sorted((h["score"] for h in hits), reverse=True)
+
+
+def test_search_converts_nmslib_scores_to_cosine(indexed):
+    indexed.http.mappings["ide-rag"]["properties"]["vec"]["method"]["engine"] = "nmslib"
+    indexed.env("OPENSEARCH", OS_SIGV4_SERVICE=indexed.sigv4)
+    qv = indexed.bedrock.vector("how is the water heated")
+    hits = indexed.quiet(indexed.load("ide-query.py").retrieve, qv, 2)
+    for h in hits:
+        doc = next(d for d in indexed.os_docs().values() if d["chunkId"] == h["chunkId"])
+        v = np.asarray(doc["vec"])
+        assert h["score"] == pytest.approx(float(v @ qv / np.linalg.norm(v)), abs=1e-5)
+
+
+def test_search_refuses_a_non_cosine_index(indexed):
+    indexed.http.mappings["ide-rag"]["properties"]["vec"]["method"]["space_type"] = "l2"
+    indexed.env("OPENSEARCH", OS_SIGV4_SERVICE=indexed.sigv4)
+    query = indexed.load("ide-query.py")
+    with pytest.raises(RuntimeError, match="space_type=l2"):
+        indexed.quiet(query.retrieve, indexed.bedrock.vector("water"), 2)
+
+
+def test_indexer_refuses_an_existing_index_with_another_space_type(stack):
+    stack.http.indices["ide-rag"] = {}
+    stack.http.mappings["ide-rag"] = {"properties": {"vec": {
+        "type": "knn_vector", "dimension": stack.dim, "method": {"name": "hnsw", "space_type": "innerproduct"}}}}
+    stack.env(OS_DUAL_WRITE="true", OS_SIGV4_SERVICE="none")
+    stack.load("ide-embed-index.py")
+    with pytest.raises(RuntimeError, match="space_type=innerproduct"):
+        sys.modules["ide_indexing"]._ensure_os_index(stack.dim)
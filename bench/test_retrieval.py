@@ -0,0 +1,63 @@
+"""ide_retrieval's in-memory top-k and the packed vector formats the indexers write."""
+import sys
+
+import numpy as np
+import pytest
+
+import run_bench as rb
+
+
+def retrieval(stack, vec_format="f32", n=500):
+    stack.vecs = rb.build_corpus(stack.table, n, stack.dim, vec_format, chunks_per_doc=100)
+    stack.env()
+    stack.load("ide-query.py")
+    return sys.modules["ide_retrieval"]
+
+
+def brute_force(stack, ret, q):
+    """(score, key) of every chunk row, best first, from the stored vectors."""
+    q = q / np.linalg.norm(q)
+    rows = [(float(ret.decode_vec(it).astype(np.float32) @ q), key)
+            for key, it in stack.table.items.items() if key[0] != rb.MANIFEST_DOC]
+    return sorted(rows, key=lambda r: -r[0])
+
+
+@pytest.mark.parametrize("top_k", [0, 1, 7, 499, 500, 600])
+def test_top_k_matches_brute_force(stack, top_k):
+    ret = retrieval(stack)
+    q = stack.vecs[3] + 0.3 * np.random.default_rng(0).standard_normal(stack.dim).astype(np.float32)
+    got = stack.quiet(ret._top_k, q, top_k)
+    want = brute_force(stack, ret, q)[:top_k]
+    assert [k for _, k in got] == [k for _, k in want]
+    assert np.allclose([s for s, _ in got], [s for s, _ in want], atol=1e-5)
+
+
+def test_select_keeps_table_order_on_ties_and_drops_invalid_rows(stack):
+    ret = retrieval(stack, n=10)
+    scores = np.array([1.0, 3.0, 3.0, -np.inf, 2.0], dtype=np.float32)
+    assert ret._select(scores, list("abcde"), 3) == [(3.0, "b"), (3.0, "c"), (2.0, "e")]
+    assert [k for _, k in ret._select(scores, list("abcde"), 5)] == ["b", "c", "e", "a"]
+
+
+@pytest.mark.parametrize("fmt,atol", [("f32", 0.0), ("f16", 1e-3), ("decimal", 1e-6)])
+def test_vector_formats_round_trip(stack, fmt, atol):
+    stack.env(VEC_FORMAT=fmt)
+    stack.load("ide-embed-index.py")
+    indexer = sys.modules["ide_indexing"]
+    ret = retrieval(stack, n=10)
+    v = np.random.default_rng(1).standard_normal(stack.dim).astype(np.float32)
+    v /= np.linalg.norm(v)
+    item = indexer.encode_vec([float(x) for x in v])
+    assert item.get("vecFmt") == (fmt if fmt != "decimal" else None)
+    back = ret.decode_vec(item)
+    assert back.shape == (stack.dim,) and np.allclose(back, v, rtol=0, atol=atol)
+
+
+def test_f16_corpus_ranks_like_f32(stack):
+    ret = retrieval(stack, "f16")
+    q = stack.vecs[42] + 0.2 * np.random.default_rng(2).standard_normal(stack.dim).astype(np.float32)
+    got = stack.quiet(ret._top_k, q, 5)
+    exact = sorted(((float(v @ (q / np.linalg.norm(q))), i) for i, v in enumerate(stack.vecs)), reverse=True)
+    d, c = divmod(exact[0][1], 100)   # build_corpus: 100 chunks per doc, 4 per page
+    assert got[0][1] == (f"bench-doc-{d:05d}", f"{c // 4 + 1:04d}#{c % 4:06d}")
+    assert np.allclose([s for s, _ in got], [s for s, _ in exact[:5]], atol=2e-3)
@@ -0,0 +1,87 @@
+"""SENT_EMBED sentence vectors: kept in the SENT_VEC_TABLE store, read by ide-answer for its answer chunks only."""
+import json, sys
+
+DOC_ID = "Coffee-Guide"
+SOURCE_URI = "s3://ide-test/uploads/Coffee Guide.pdf"
+SENT_TABLE = "ide-rag-sentvecs"
+
+
+def index(stack, pages, **env):
+    stack.env(**{"SENT_EMBED": "true", "SENT_VEC_TABLE": SENT_TABLE, **env})
+    stack.load("ide-embed-index.py")
+    idx = sys.modules["ide_indexing"]
+    stack.quiet(idx.index_pages, [{"page": p, "lines": lines} for p, lines in enumerate(pages, 1)],
+                DOC_ID, SOURCE_URI)
+    stack.quiet(idx.put_manifest, DOC_ID, len(stack.rows(DOC_ID)), SOURCE_URI)
+    return idx
+
+
+def store(stack):
+    return {c: it for (d, c), it in stack.ddb.Table(SENT_TABLE).items.items() if d == DOC_ID}
+
+
+def ask(stack, mod):
+    ev = {"requestContext": {"http": {"method": "POST"}},
+          "body": json.dumps({"query": "How do espresso machines heat water?", "debug": True})}
+    resp = stack.quiet(mod.lambda_handler, ev, None)
+    assert resp["statusCode"] == 200
+    return json.loads(resp["body"])
+
+
+def test_chunk_rows_carry_only_the_marker(stack):
+    idx = index(stack, stack.pages(3))
+    rows, sv = stack.rows(DOC_ID), store(stack)
+    assert rows and set(rows) == set(sv)
+    for c, it in rows.items():
+        assert "sentVecs" not in it and it["sentEmb"] == idx.MODEL_ID
+        n = len(idx.usable_sentences(it["text"]))
+        assert sv[c]["embHash"] == it["embHash"] and len(sv[c]["sentVecs"]) == n * stack.dim * 2   # float16
+
+
+def test_sentence_cap_and_repeats_bound_the_embedding_calls(stack):
+    pages = [["Descale the boiler every month."] * 6, ["Grind the beans just before brewing."] * 2]
+    idx = index(stack, pages, SENT_EMBED_MAX="3")
+    rows, sv = stack.rows(DOC_ID), store(stack)
+    # page 1 has too many sentences: marker, no store row; page 2's repeated sentence is embedded once
+    assert all(it["sentEmb"] == idx.MODEL_ID for it in rows.values())
+    assert not any(c.startswith("0001#") for c in sv) and any(c.startswith("0002#") for c in sv)
+    assert stack.bedrock.calls["embed"] == len(rows) + 1
+
+
+def test_without_store_table_no_sentence_vectors_are_embedded(stack):
+    index(stack, stack.pages(2), SENT_VEC_TABLE="")
+    assert not store(stack)
+    assert not any("sentEmb" in it for it in stack.rows(DOC_ID).values())
+    assert stack.bedrock.calls["embed"] == len(stack.rows(DOC_ID))
+
+
+def test_answer_reads_the_store_for_its_chunks_only(stack):
+    index(stack, stack.pages(4, lines_per_page=30))
+    mod = stack.load("ide-answer.py")
+    mod.SENT_MIN_SCORE = -1.0
+    body = ask(stack, mod)
+    assert body["debug"]["ranking"] == "semantic"
+    assert stack.ddb.Table(SENT_TABLE).calls["batch_get"] == 1
+    assert mod._READS["sents"]["items"] == len(body["citations"]) < len(stack.rows(DOC_ID))
+
+
+def test_answer_ignores_rows_of_an_older_text(stack):
+    index(stack, stack.pages(2))
+    for it in store(stack).values():
+        it["embHash"] = "older-text"
+    mod = stack.load("ide-answer.py")
+    mod.SENT_MIN_SCORE = -1.0
+    assert ask(stack, mod)["debug"]["ranking"] == "keyword"
+
+
+def test_reindex_and_delete_keep_the_store_in_step(stack):
+    pages = stack.pages(3, lines_per_page=30)
+    index(stack, pages)
+    pages[1] = pages[1][:5]   # page two shrinks to one chunk
+    index(stack, pages)
+    rows, sv = stack.rows(DOC_ID), store(stack)
+    assert set(rows) == set(sv) and all(sv[c]["embHash"] == it["embHash"] for c, it in rows.items())
+
+    resp = stack.quiet(stack.load("ide-delete-doc.py").lambda_handler, {"docId": DOC_ID}, None)
+    assert resp["statusCode"] == 200
+    assert not stack.rows(DOC_ID) and not store(stack)
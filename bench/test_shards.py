@@ -0,0 +1,64 @@
+"""Sharded fan-out in ide-embed-index (INDEX_QUEUE_URL="local:" drains the queue in-process)."""
+import json
+
+SOURCE = "uploads/Big Manual.pdf"
+DOC_ID = "Big-Manual"
+
+
+def load_sharded(stack, pages=7):
+    stack.env(INDEX_QUEUE_URL="local:", SHARD_PAGES="3")
+    key = stack.put_extracted(SOURCE, stack.pages(pages))
+    return stack.load("ide-embed-index.py"), key
+
+
+def test_shards_drain_tracker_and_write_manifest_once(stack):
+    indexer, key = load_sharded(stack)
+    manifests = []
+    put_manifest = indexer.put_manifest
+    indexer.put_manifest = lambda *a: (manifests.append(a), put_manifest(*a))
+    stack.quiet(indexer.lambda_handler, stack.s3_event(key), None)
+
+    tracker = stack.table.items[("__shards__", DOC_ID)]
+    assert "pending" not in tracker   # every shard removed its id; DynamoDB drops the empty set
+    assert tracker["total"] == 3
+    assert sorted(tracker["stats"]) == ["0000", "0001", "0002"]
+    assert sum(st["indexed"] for st in tracker["stats"].values()) == 7
+    assert not indexer._LOCAL_QUEUE
+    assert len(stack.rows(DOC_ID)) == 7
+    assert manifests == [(DOC_ID, 7, f"s3://{stack.bucket}/{SOURCE}")]
+    assert stack.table.items[("__manifest__", DOC_ID)]["chunks"] == 7
+
+
+def test_shard_of_superseded_run_is_dropped(stack):
+    indexer, key = load_sharded(stack)
+    indexer._send_shards = lambda messages: None   # keep the shards of the first run undelivered
+    stack.quiet(indexer.enqueue_shards, stack.bucket, key, DOC_ID, f"s3://{stack.bucket}/{SOURCE}", 7)
+    old_run = stack.table.items[("__shards__", DOC_ID)]["run"]
+    stack.table.items[("__shards__", DOC_ID)]["run"] = str(int(old_run) + 1)   # re-extracted meanwhile
+
+    msg = {"bucket": stack.bucket, "key": key, "docId": DOC_ID, "source": f"s3://{stack.bucket}/{SOURCE}",
+           "run": old_run, "shard": "0000", "first": None, "last": 3}
+    out = stack.quiet(indexer.handle_shard_batch, [{"messageId": "m1", "body": json.dumps(msg)}])
+    assert out == {"batchItemFailures": []}
+    tracker = stack.table.items[("__shards__", DOC_ID)]
+    assert tracker["pending"] == {"0000", "0001", "0002"} and tracker["stats"] == {}
+    assert ("__manifest__", DOC_ID) not in stack.table.items
+
+
+def test_failed_shard_is_reported_and_retried(stack):
+    indexer, key = load_sharded(stack)
+    failures = {"left": 1}
+    index_pages = indexer.index_pages
+
+    def flaky(pages, doc_id, source, page_range=(None, None)):
+        if page_range[0] == 4 and failures["left"]:
+            failures["left"] -= 1
+            raise RuntimeError("throttled")
+        return index_pages(pages, doc_id, source, page_range)
+    indexer.index_pages = flaky
+    stack.quiet(indexer.lambda_handler, stack.s3_event(key), None)
+
+    assert failures["left"] == 0
+    assert "pending" not in stack.table.items[("__shards__", DOC_ID)]
+    assert len(stack.rows(DOC_ID)) == 7
+    assert stack.table.items[("__manifest__", DOC_ID)]["chunks"] == 7
@@ -0,0 +1,99 @@
+"""NDJSON event sequence of ide-answer's stream_handler and of the buffered "stream": true body."""
+import json
+import time
+
+import run_bench as rb
+from stubs import StubTable, StubDynamo, StubResponseStream
+
+QUERY = "How long should the sauce simmer?"
+
+
+def answer_lambda(stack, llm=True, **env):
+    rb.build_corpus(stack.table, 400, stack.dim, "f32", chunks_per_doc=100)
+    stack.env(llm=llm, **env)
+    return stack.load("ide-answer.py")
+
+
+def event(**body):
+    return {"requestContext": {"http": {"method": "POST"}}, "body": json.dumps({"query": QUERY, **body})}
+
+
+def stream(stack, mod, ev):
+    out = StubResponseStream()
+    stack.quiet(mod.stream_handler, ev, out, None)
+    assert all(d.endswith(b"\n") for _, d in out.writes)   # one complete NDJSON line per write
+    return out.events()
+
+
+def test_stream_sends_answer_then_deltas_then_done(stack):
+    mod = answer_lambda(stack)
+    events = stream(stack, mod, event())
+    types = [e["type"] for e in events]
+    assert types == ["answer", "delta", "delta", "delta", "delta", "done"]
+    first, done = events[0], events[-1]
+    assert first["query"] == QUERY and first["citations"] and first["answer_raw"]
+    assert "".join(e["text"] for e in events[1:-1]) == "Summary: Benchmark answer.\n- Point one\n- Point two"
+    assert done["polish"] == "ok" and "Benchmark answer" in done["answer_md"]
+
+
+def test_cached_answer_streams_without_deltas(stack):
+    mod = answer_lambda(stack)
+    first = stream(stack, mod, event())
+    again = stream(stack, mod, event())
+    assert [e["type"] for e in again] == ["answer", "done"]
+    assert again[0]["citations"] == first[0]["citations"]
+    assert again[1]["polish"] == "cached" and again[1]["answer_md"] == first[-1]["answer_md"]
+
+
+def test_polish_disabled_streams_answer_and_done(stack):
+    mod = answer_lambda(stack, llm=False)
+    events = stream(stack, mod, event())
+    assert [e["type"] for e in events] == ["answer", "done"]
+    assert events[1]["polish"] == "disabled" and events[1]["answer_md"] == events[0]["answer_raw"]
+
+
+def test_buffered_body_has_the_same_sequence(stack):
+    mod = answer_lambda(stack)
+    resp = stack.quiet(mod.lambda_handler, event(stream=True), None)
+    assert resp["statusCode"] == 200 and resp["headers"]["content-type"] == "application/x-ndjson"
+    events = [json.loads(ln) for ln in resp["body"].splitlines()]
+    assert [e["type"] for e in events] == ["answer", "delta", "delta", "delta", "delta", "done"]
+
+
+def test_bad_request_is_a_single_error_event(stack):
+    mod = answer_lambda(stack)
+    events = stream(stack, mod, event(filters={"pages": "all"}))
+    assert len(events) == 1 and events[0]["type"] == "error" and "filters" in events[0]["error"]
+
+
+def test_corpus_load_over_budget_is_a_single_error_event(stack):
+    stack.table = StubTable("ide-rag", latency_ms=50)   # every scan page costs 50 ms
+    stack.ddb = StubDynamo(stack.table)
+    mod = answer_lambda(stack, llm=False, ANSWER_BUDGET_MS="30", SCAN_SEGMENTS="1")
+    events = stream(stack, mod, event())
+    assert len(events) == 1 and events[0]["type"] == "error"
+
+
+class _StallingLlm:
+    """Polish stream that sends one delta, then stalls for `stall_s` (a hung Bedrock read)."""
+
+    def __init__(self, stall_s):
+        self.stall_s = stall_s
+
+    def invoke_model_with_response_stream(self, **kw):
+        def events():
+            yield {"chunk": {"bytes": json.dumps({"outputText": "Summary: partial"}).encode("utf-8")}}
+            time.sleep(self.stall_s)
+            yield {"chunk": {"bytes": json.dumps({"outputText": " late"}).encode("utf-8")}}
+        return {"body": events()}
+
+
+def test_stalled_polish_stream_ends_at_the_budget(stack):
+    mod = answer_lambda(stack, ANSWER_BUDGET_MS="500", POLISH_MIN_MS="0")
+    mod._get_index()   # warm, so the budget is left for polish
+    mod.bedrock_llm = _StallingLlm(stall_s=2.0)
+    t0 = time.perf_counter()
+    events = stream(stack, mod, event())
+    assert time.perf_counter() - t0 < 1.0
+    assert [e["type"] for e in events] == ["answer", "delta", "done"]
+    assert events[-1]["polish"] == "timeout" and events[-1]["answer_md"] == events[0]["answer_raw"]
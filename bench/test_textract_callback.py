@@ -0,0 +1,90 @@
+"""ide-textract-callback: extracted ide-pages/1 objects on S3, read back by ide_indexing.read_extracted."""
+import gzip, json, sys
+
+import pytest
+
+from stubs import StubTextract
+
+SOURCE_KEY = "uploads/Coffee Guide.pdf"
+PAGES = [["Espresso basics.", "Grind the beans fine."], ["Steam the milk."], ["Clean the group head daily."]]
+
+
+def callback(stack, **env):
+    stack.env(OUTPUT_BUCKET=stack.bucket, **env)
+    return stack.load("ide-textract-callback.py")
+
+
+def record(msg_id, job_id, status="SUCCEEDED"):
+    msg = {"JobId": job_id, "Status": status, "API": "StartDocumentTextDetection",
+           "DocumentLocation": {"S3Bucket": "ide-test", "S3ObjectName": SOURCE_KEY}}
+    return {"messageId": msg_id, "body": json.dumps({"Type": "Notification", "Message": json.dumps(msg)})}
+
+
+def run(stack, mod, *records):
+    mod.textract = StubTextract({"0123456789abcdef": PAGES})
+    return stack.quiet(mod.lambda_handler, {"Records": list(records)}, None)
+
+
+def extracted_keys(stack):
+    return [k for b, k in stack.s3.objects if b == stack.bucket and k.startswith("extracted/")]
+
+
+@pytest.mark.parametrize("part_bytes", [1 << 20, 64])   # one put_object / multipart upload
+def test_compressed_output_carries_its_content_encoding(stack, part_bytes):
+    mod = callback(stack, OUTPUT_COMPRESSION="gzip")
+    mod.PART_BYTES = part_bytes
+    compress, flush = mod._compressor()
+    with mod._S3StreamWriter(stack.bucket, "extracted/x.pdf.json", "application/x-ndjson", mod.CONTENT_ENCODING) as out:
+        for i in range(50):
+            out.write(compress(b'{"page": %d, "lines": ["some text"]}\n' % i))
+        out.write(flush())
+    head = stack.s3.head_object(Bucket=stack.bucket, Key="extracted/x.pdf.json")
+    assert (head["ContentType"], head["ContentEncoding"]) == ("application/x-ndjson", "gzip")
+    body = gzip.decompress(stack.s3.objects[(stack.bucket, "extracted/x.pdf.json")])
+    assert body.count(b"\n") == 50
+
+
+def test_uncompressed_output_sets_no_content_encoding(stack):
+    mod = callback(stack)
+    with mod._S3StreamWriter(stack.bucket, "extracted/x.pdf.json", "application/x-ndjson", mod.CONTENT_ENCODING) as out:
+        out.write(b'{"page": 1, "lines": []}\n')
+    assert "ContentEncoding" not in stack.s3.head_object(Bucket=stack.bucket, Key="extracted/x.pdf.json")
+
+
+def test_only_failed_records_are_reported(stack):
+    mod = callback(stack)
+    out = run(stack, mod, record("ok", "0123456789abcdef"), record("unknown-job", "ffffffffffffffff"),
+              record("job-failed", "0123456789abcdef", status="FAILED"))
+    assert out == {"batchItemFailures": [{"itemIdentifier": "unknown-job"}]}
+    (key,) = extracted_keys(stack)
+    row = stack.table.items[("__extracted__", SOURCE_KEY)]
+    assert row["latest"] == key and row["keys"] == {key}
+
+    body = stack.s3.objects[(stack.bucket, key)]
+    assert run(stack, mod, record("redelivered", "0123456789abcdef")) == {"batchItemFailures": []}
+    assert extracted_keys(stack) == [key] and stack.s3.objects[(stack.bucket, key)] == body
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd"])
+def test_read_extracted_reads_every_compression(stack, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    mod = callback(stack, OUTPUT_COMPRESSION=compression)
+    assert run(stack, mod, record("ok", "0123456789abcdef")) == {"batchItemFailures": []}
+    (key,) = extracted_keys(stack)
+    stack.load("ide-embed-index.py")
+    header, pages = sys.modules["ide_indexing"].read_extracted(stack.bucket, key)
+    assert header["format"] == "ide-pages/1" and header["page_count"] == len(PAGES)
+    assert header["source_key"] == SOURCE_KEY
+    assert list(pages) == [{"page": p, "lines": lines} for p, lines in enumerate(PAGES, 1)]
+
+
+def test_read_extracted_reads_legacy_single_object(stack):
+    stack.env()
+    stack.load("ide-embed-index.py")
+    legacy = {"source_bucket": stack.bucket, "source_key": SOURCE_KEY,
+              "pages": [{"page": p, "lines": lines} for p, lines in enumerate(PAGES, 1)]}
+    stack.s3.put_object(Bucket=stack.bucket, Key="extracted/legacy.pdf.json", Body=json.dumps(legacy, indent=2))
+    header, pages = sys.modules["ide_indexing"].read_extracted(stack.bucket, "extracted/legacy.pdf.json")
+    assert header == {"source_bucket": stack.bucket, "source_key": SOURCE_KEY}
+    assert list(pages) == legacy["pages"]